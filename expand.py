@@ -1,85 +1,273 @@
 #!/usr/bin/env python
-import ast
 import io
-import operator
 import os
 import re
 import sys
 
 expand_path = []
 
+# When this is a set, myopen() adds the name of every file it opens to it, so
+# that callers can find out which files (includes, mostly) an expansion used.
+opened_files = None
+
+# Likewise, when this is a set, myopen() adds every name it tried and couldn't
+# open on its way through expand_path, so that callers can tell when a file
+# turning up would change which one is used.
+missed_files = None
+
+# When this is a set, expand_file() adds the name of every file it writes.
+written_files = None
+
+# When set (by expand --replay), a directory holding a copy of the files a
+# run used at their absolute paths: absolute file names are looked up under
+# it, and the current directory is taken to be the one we are in, without it.
+file_root = None
+
+# When set, a mapping from $$INCLUDE file names to files that have already
+# been read (see expand_store.py), consulted before opening anything.
+include_store = None
+
+# When set (see --telemetry), the expand_telemetry.recorder that counts loop
+# iterations and includes and keeps a record of each output.
+telemetry = None
+
+
+class lazy_re:
+    """
+    A regular expression that is compiled the first time it is used.
+
+    Most invocations (expand -c X.cfg RELEASE, for instance) only ever touch
+    a handful of the patterns below, so we don't pay to compile all of them
+    at startup.  On first use the module-level name is rebound to the real
+    compiled pattern, so the hot loops see a plain re.Pattern afterwards.
+    """
+
+    def __init__(self, name, pattern):
+        self.name = name
+        self.pattern = pattern
+
+    def __getattr__(self, attr):
+        rx = re.compile(self.pattern)
+        globals()[self.name] = rx
+        return getattr(rx, attr)
+
+
 # Predefine some regular expressions!
-w = re.compile(r"^[ \t]*([^ \t=]+)")
-wq = re.compile(r'^[ \t]*"([^"]*)"')
-wqq = re.compile(r"^[ \t]*'([^']*)'")
-assign = re.compile(r"^[ \t]*=")
-sp = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+(.+?)[ \t]*$")
-spq = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+"([^"]*)"[ \t]*$')
-spqq = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+'([^']*)'[ \t]*$")
-eq = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$")
-eqq = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*"([^"]*)"[ \t]*$')
-eqqq = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*'([^']*)'[ \t]*$")
-inst = re.compile(
-    r"^[ \t]*(([A-Za-z_][A-Za-z0-9_]*):[ \t]*)?([A-Za-z_][A-Za-z0-9_]*)\((.*)\)[ \t]*$"
+w = lazy_re("w", r"^[ \t]*([^ \t=]+)")
+wq = lazy_re("wq", r'^[ \t]*"([^"]*)"')
+wqq = lazy_re("wqq", r"^[ \t]*'([^']*)'")
+assign = lazy_re("assign", r"^[ \t]*=")
+sp = lazy_re("sp", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+(.+?)[ \t]*$")
+spq = lazy_re("spq", r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+"([^"]*)"[ \t]*$')
+spqq = lazy_re("spqq", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]+'([^']*)'[ \t]*$")
+eq = lazy_re("eq", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$")
+eqq = lazy_re("eqq", r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*"([^"]*)"[ \t]*$')
+eqqq = lazy_re("eqqq", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*'([^']*)'[ \t]*$")
+inst = lazy_re(
+    "inst",
+    r"^[ \t]*(([A-Za-z_][A-Za-z0-9_]*):[ \t]*)?([A-Za-z_][A-Za-z0-9_]*)\((.*)\)[ \t]*$",
 )
-inst2 = re.compile(
-    r"^[ \t]*INSTANCE[ \t]+([A-Za-z_][A-Za-z0-9_]*)[ \t]*([A-Za-z0-9_]*)[ \t]*$"
+inst2 = lazy_re(
+    "inst2",
+    r"^[ \t]*INSTANCE[ \t]+([A-Za-z_][A-Za-z0-9_]*)[ \t]*([A-Za-z0-9_]*)[ \t]*$",
 )
-prminst = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)(,)")
-prmidx = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*?)([0-9_]+)(,)")
-prmeq = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)=([^,]*)(,)")
-prmeqq = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)="([^"]*)"(,)')
-prmeqqq = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)='([^']*)'(,)")
-inc = re.compile(r"^\$\$INCLUDE\((.*)\)")
-idxre = re.compile(r"^INDEX([0-9]*)")
-doubledollar = re.compile(r"^(.*?)\$\$")
-keyword = re.compile(
-    r"^(ROOT|SUBSTR|UP|LOOP|IF|INCLUDE|TRANSLATE|COUNT|NAME)\(|^(ASSIGN|CALC|IFCALC)\{"
+prminst = lazy_re("prminst", r"^([A-Za-z_][A-Za-z0-9_]*)(,)")
+prmidx = lazy_re("prmidx", r"^([A-Za-z_][A-Za-z0-9_]*?)([0-9_]+)(,)")
+prmeq = lazy_re("prmeq", r"^([A-Za-z_][A-Za-z0-9_]*)=([^,]*)(,)")
+prmeqq = lazy_re("prmeqq", r'^([A-Za-z_][A-Za-z0-9_]*)="([^"]*)"(,)')
+prmeqqq = lazy_re("prmeqqq", r"^([A-Za-z_][A-Za-z0-9_]*)='([^']*)'(,)")
+inc = lazy_re("inc", r"^\$\$INCLUDE\((.*)\)")
+idxre = lazy_re("idxre", r"^INDEX([0-9]*)")
+ident = lazy_re("ident", r"^[A-Za-z_][A-Za-z0-9_]*$")
+lazydef = lazy_re(
+    "lazydef", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)([ \t]*=|[ \t]+[^ \t\n$])"
 )
-parens = re.compile(r"^\(([^)]*?)\)")
-brackets = re.compile(r"^\{([^}]*?)\}")
-trargs = re.compile(r'^\(([^,]*?),"([^"]*?)","([^"]*?)"\)')
-dbargs = re.compile(r"^\(([^,)]*?),([^,)]*?)\)")
-ifargs = re.compile(r"^\(([^,)]*?),([^,)]*?),([^,)]*?)\)")
-word = re.compile(r"^([A-Za-z0-9_]*)")
-
-operators = {
-    ast.Add: operator.add,
-    ast.Sub: operator.sub,
-    ast.Mult: operator.mul,
-    ast.Mod: operator.mod,
-    ast.Div: operator.truediv,
-    ast.Pow: operator.pow,
-    ast.LShift: operator.lshift,
-    ast.RShift: operator.rshift,
-    ast.BitOr: operator.or_,
-    ast.BitAnd: operator.and_,
-    ast.BitXor: operator.xor,
-    ast.USub: operator.neg,
-    ast.Invert: operator.not_,
-}
+lazyinst = lazy_re(
+    "lazyinst", r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*:[ \t]*)?[A-Za-z_][A-Za-z0-9_]*\("
+)
+lazyinc = lazy_re("lazyinc", r"^\$\$INCLUDE\(([^)$]*)\)[ \t]*\n?$")
+doubledollar = lazy_re("doubledollar", r"^(.*?)\$\$")
+keyword = lazy_re(
+    "keyword",
+    r"^(ROOT|SUBSTR|UP|LOOP|IF|INCLUDE|RAWINCLUDE|TRANSLATE|COUNT|LOOKUP|NAME|OUTPUT)\("
+    r"|^(ASSIGN|CALC|IFCALC)\{",
+)
+parens = lazy_re("parens", r"^\(([^)]*?)\)")
+brackets = lazy_re("brackets", r"^\{([^}]*?)\}")
+trargs = lazy_re("trargs", r'^\(([^,]*?),"([^"]*?)","([^"]*?)"\)')
+dbargs = lazy_re("dbargs", r"^\(([^,)]*?),([^,)]*?)\)")
+ifargs = lazy_re("ifargs", r"^\(([^,)]*?),([^,)]*?),([^,)]*?)\)")
+word = lazy_re("word", r"^([A-Za-z0-9_]*)")
+
+# Bound by load_ast() the first time a $$CALC/$$ASSIGN needs them, so that
+# templates without arithmetic never import ast or operator.  Everything that
+# is handed a parsed expression can then use the module global.
+ast = None
+operators = {}
+
+
+def load_ast():
+    global ast
+    if ast is None:
+        import ast as ast_module
+        import operator
+
+        ast = ast_module
+        operators.update(
+            {
+                ast.Add: operator.add,
+                ast.Sub: operator.sub,
+                ast.Mult: operator.mul,
+                ast.Mod: operator.mod,
+                ast.Div: operator.truediv,
+                ast.Pow: operator.pow,
+                ast.LShift: operator.lshift,
+                ast.RShift: operator.rshift,
+                ast.BitOr: operator.or_,
+                ast.BitAnd: operator.and_,
+                ast.BitXor: operator.xor,
+                ast.USub: operator.neg,
+                ast.Invert: operator.not_,
+            }
+        )
+    return ast
+
+
+def calc_atom(n):
+    """
+    The value of a variable in a $$CALC expression: hex if it starts with 0x,
+    octal if it starts with 0, decimal otherwise.
+    """
+    if n[:2] == "0x":
+        return int(n, 16)
+    elif n[0] == "0":
+        return int(n, 8)
+    else:
+        return int(n, 10)
+
+
+def rooted(path):
+    """
+    The file to open for path: path itself, or the copy of it under
+    file_root if there is one and path is absolute.
+    """
+    if file_root is not None and path[:1] == "/":
+        return file_root + path
+    return path
 
 
 def myopen(file):
     if file == "-":
         return sys.stdin
     try:
-        fp = open(file)
+        fp = open(rooted(file))
+        if opened_files is not None:
+            opened_files.add(file)
         return fp
     except Exception:
-        pass
+        if missed_files is not None:
+            missed_files.add(file)
     if file[0] == "/":
         return None
     for f in expand_path:
         fn = f + "/" + file
         try:
-            fp = open(fn)
+            fp = open(rooted(fn))
+            if opened_files is not None:
+                opened_files.add(fn)
             return fp
         except Exception:
-            pass
+            if missed_files is not None:
+                missed_files.add(fn)
     return None
 
 
+def read_include(fn):
+    """
+    Read the lines of an $$INCLUDE file, returning them along with the file's
+    (st_dev, st_ino) identity.  Raises an exception if it can't be read.
+    """
+    if include_store is not None:
+        found = include_store.get(fn)
+        if found is not None:
+            lines, path, identity = found
+            if opened_files is not None:
+                opened_files.add(path)
+            return lines, identity
+    fp = myopen(fn)
+    lines = fp.readlines()
+    st = os.fstat(fp.fileno())
+    if fp is not sys.stdin:
+        fp.close()
+    return lines, (st.st_dev, st.st_ino)
+
+
+# The base_configs made so far, by the text of their file.
+base_configs = {}
+
+
+class base_config:
+    """
+    A config file that cfgs start with $$INCLUDE of (a common hutch config,
+    say), parsed by itself once and shared by every cfg that includes it.
+
+    This is only made for files with no $$ in them, since those come out of
+    the expansion just as they are, whatever the including cfg defines.  Its
+    variables and instances then don't depend on anything before them
+    either, so they can be copied into the dictionaries of each cfg that
+    starts with it, which go on to parse their own lines on top.  Nothing
+    here is changed once it is made, and the instance dictionaries are
+    shared by all of those cfgs.
+    """
+
+    def __init__(self, cfg, text):
+        import contextlib
+
+        lines = text.split("\n")
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            d = {"_failed_include": []}
+            self.complete = True  # No new-style INSTANCE to stop at.
+            for L in lines:
+                if not cfg.process_config_line(L, d):
+                    self.complete = False
+                    break
+            del d["_failed_include"]
+            self.prelim = d
+            self.prelim_printed = printed.getvalue()
+            printed.truncate(0)
+            printed.seek(0)
+            self.i = {}
+            self.d = {}
+            self.nd = {}
+            self.state = cfg.parse_lines(
+                lines, self.i, self.d, self.nd, False, False, "", {}, "0"
+            )
+            self.printed = printed.getvalue()
+
+    def preliminary(self, d):
+        """
+        Add the variables of the preliminary pass of read_config() to d,
+        returning False if it should stop there.
+        """
+        sys.stdout.write(self.prelim_printed)
+        d.update(self.prelim)
+        return self.complete
+
+    def overlay(self, i, d, nd):
+        """
+        Add the variables, instances and instance names to those of a cfg
+        being parsed, returning where parse_lines() should carry on from.
+        """
+        sys.stdout.write(self.printed)
+        d.update(self.d)
+        for t, insts in self.i.items():
+            i[t] = i.get(t, []) + insts
+        nd.update(self.nd)
+        newstyle, ininst, iname, dd, n = self.state
+        return newstyle, ininst, iname, dict(dd), n
+
+
 class config:
     """
     This is the class that handles the configuration namespace.
@@ -109,11 +297,24 @@ class config:
 
     def __init__(self):
         self.path = os.getcwd()
+        if file_root is not None and self.path.startswith(file_root + "/"):
+            self.path = self.path[len(file_root) :]
         self.dirname = self.path.split("/")[-1]
         self.ddict = {}
         self.idict = {}
         self.assigns = [set()]
 
+    def copy(self):
+        """
+        Return a copy of this configuration for expanding another template
+        into, since $$ASSIGN modifies the ddict as it goes.
+        """
+        new = config.__new__(config)
+        new.__dict__.update(self.__dict__)
+        new.ddict = self.ddict.copy()
+        new.assigns = [set()]
+        return new
+
     def create_instance(self, iname, id, idict, ndict):
         try:
             allinst = idict[iname]
@@ -186,12 +387,17 @@ class config:
         return True
 
     def read_config(self, file, extra):
+        if telemetry is not None:
+            import time
+
+            start = time.perf_counter()
         fp = myopen(file)
         if not fp:
             raise IOError("File %s not found!" % (file))
         lines = [L + "\n" for L in extra] + fp.readlines()
         fp.close()
         origlines = lines
+        base = self.find_base(lines, len(extra))
 
         # Do the preliminary config expansion!  The weirdness here is we might
         # have defines that determine the value of the $$INCLUDE parameter.
@@ -199,18 +405,20 @@ class config:
         # in 2 or 3.
         fi = ["all"]
         cnt = 0
+        passes = 1
         while len(fi) != 0 and cnt < 5:
             lines = origlines
             cnt += 1
-            output = io.StringIO()
-            expand(self, lines, output, True)  # Leave failed $$INCLUDE in the output!
-            value = output.getvalue()
-            output.close()
-            lines = value.split("\n")
+            passes += 1
+            # Leave failed $$INCLUDE in the output!
+            lines = self.expand_config(lines, file, len(extra), True, base)
 
             d = {"DIRNAME": self.dirname, "PATH": self.path, "_failed_include": []}
             for L in lines:
-                if not self.process_config_line(L, d):
+                if type(L) is base_config:
+                    if not L.preliminary(d):
+                        break
+                elif not self.process_config_line(L, d):
                     break
             fi = d["_failed_include"]
             del d["_failed_include"]
@@ -219,21 +427,95 @@ class config:
 
         # Now that we have the aliases, reprocess the config!
 
-        lines = origlines
-        output = io.StringIO()
-        expand(self, lines, output)
-        value = output.getvalue()
-        output.close()
-        lines = value.split("\n")
+        lines = self.expand_config(origlines, file, len(extra), False, base)
 
         i = {}
         d = {"DIRNAME": self.dirname, "PATH": self.path}
         nd = {}
-        newstyle = False
-        ininst = False
-        iname = ""
-        dd = {}
+        state = (False, False, "", {}, "0")  # newstyle, ininst, iname, dd, n
+        start_line = 0
+        for n, L in enumerate(lines):
+            if type(L) is base_config:
+                state = self.parse_lines(lines[start_line:n], i, d, nd, *state)
+                state = L.overlay(i, d, nd)
+                start_line = n + 1
+        newstyle, ininst, iname, dd, n = self.parse_lines(
+            lines[start_line:], i, d, nd, *state
+        )
+        if ininst:
+            self.finish_instance(iname, i, dd)
+        for k, v in list(nd.items()):
+            d[k + ":TYPE"] = v[0]
+            d[k + ":INDEX"] = v[1]
+        self.idict = i
+        self.ddict = d
+        if telemetry is not None:
+            telemetry.config_read(time.perf_counter() - start, passes)
+
+    def find_base(self, lines, nextra):
+        """
+        If the config lines (after the nextra ADDITIONAL_STATEMENTS) start
+        with $$INCLUDE(FILE) of a file that needs no expanding, return the
+        index of that line, FILE and the base_config for it, or None.
+
+        The lines before it may only be comments, blank lines and
+        statements that define a variable, without any $$.
+
+        Always returns None if any budget is set, so that the $$INCLUDE is
+        read by read_config like any other, and the budgets see it.
+        """
+        if budget is not None:
+            return None
+        for k, L in enumerate(lines):
+            if k >= nextra and lazyinc.search(L):
+                break
+            stripped = L.strip()
+            if "$$" in L or inst.search(stripped) or inst2.search(stripped):
+                return None
+            if k >= nextra and stripped != "" and stripped[0] != "#":
+                return None
+        else:
+            return None
+        m = lazyinc.search(L)
+        name = m.group(1)
+        try:
+            newlines, identity = read_include(name.strip())
+        except Exception:
+            return None
+        text = "".join(newlines)
+        if "$$" in text or not text.endswith("\n"):
+            return None
+        try:
+            found = base_configs[text]
+        except KeyError:
+            if len(base_configs) >= 64:
+                base_configs.clear()  # Old versions of a file being edited.
+            found = base_configs[text] = base_config(self, text)
+        return (k, name, found)
 
+    def expand_config(self, lines, file, nextra, isfirst, base):
+        """
+        Expand the lines of config file into a list of lines to parse.  If
+        base (from find_base()) can be used, the lines of its file are
+        replaced by the base_config itself.
+        """
+        output = io.StringIO()
+        if base is None or base[1] in self.ddict:
+            expand(self, lines, output, isfirst, name=file, line=-nextra)
+            return output.getvalue().split("\n")
+        k, name, found = base
+        expand(self, lines[k + 1 :], output, isfirst, name=file, line=k + 1 - nextra)
+        if telemetry is not None:
+            telemetry.includes += 1
+        return lines[:k] + [found] + output.getvalue().split("\n")
+
+    def parse_lines(self, lines, i, d, nd, newstyle, ininst, iname, dd, n):
+        """
+        Parse expanded config lines into the instances i, the variables d and
+        the instance names nd, which are added to.  newstyle, ininst, iname,
+        dd and n are where the lines before left off (in a new-style INSTANCE,
+        and which), and the same is returned for the lines after.
+        """
         for L in lines:
             L = L.strip()
             m = inst2.search(L)
@@ -371,17 +653,238 @@ class config:
                 continue
             if L != "" and L[0] != "#":
                 print("Skipping unknown line: %s" % L)
-        if ininst:
-            self.finish_instance(iname, i, dd)
-        for k, v in list(nd.items()):
-            d[k + ":TYPE"] = v[0]
-            d[k + ":INDEX"] = v[1]
-        self.idict = i
-        self.ddict = d
+        return newstyle, ininst, iname, dd, n
+
+    def read_value(self, file, name):
+        """
+        Find the value of name in the config file, as read_config would, but
+        only looking at the lines it could depend on.  This is used to answer
+        "expand -c CONFIG NAME" without resolving the whole config.
+
+        Returns None if this can't be done safely, in which case the caller
+        should fall back to read_config.  That is the case for:
+            - names that could be defined by an instance (ending in a digit,
+              or not a plain identifier),
+            - any $$ keyword in the config other than a whole-line
+              $$INCLUDE(FILE) of a literal file name, where FILE exists and
+              ends with a newline,
+            - lines that could turn into an instance or a definition of
+              something else once they are expanded,
+            - lines that read_config would complain about.
+
+        Otherwise, only lines before the first INSTANCE can define name, and
+        the preliminary pass of read_config runs exactly once with an empty
+        dictionary, so the value is the last definition of name expanded with
+        the preliminary values of just the variables it refers to.
+
+        Diagnostics about instance lines, which aren't read here, are not
+        printed.
+        """
+        if file == "-" or not ident.search(name) or name[-1].isdigit():
+            return None
+        fp = myopen(file)
+        if not fp:
+            return None
+        stack = [iter(fp.readlines())]
+        fp.close()
+        lastdef = {}  # name -> the line with its last definition
+        while stack:
+            try:
+                L = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            if "$$" not in L:
+                s = L.strip()
+                if inst2.search(s):
+                    break
+                if s == "" or s[0] == "#" or inst.search(s):
+                    continue
+                m = eqqq.search(s) or eqq.search(s) or eq.search(s)
+                m = m or spqq.search(s) or spq.search(s) or sp.search(s)
+                if m is None:
+                    return None
+                lastdef[m.group(1)] = L
+                continue
+            m = lazyinc.search(L)
+            if m is not None:
+                fn = m.group(1)
+                if ident.search(fn) or len(stack) > 20:
+                    return None
+                fp = myopen(fn.strip())
+                if not fp:
+                    return None
+                newlines = fp.readlines()
+                fp.close()
+                if len(newlines) > 0 and not newlines[-1].endswith("\n"):
+                    return None
+                stack.append(iter(newlines))
+                continue
+            if L.lstrip().startswith("$$") or L.rstrip("\n").endswith("$$"):
+                return None
+            pos = L.find("$$")
+            while pos >= 0:
+                if keyword.search(L[pos + 2 :]):
+                    return None
+                pos = L.find("$$", pos + 1)
+            if L.lstrip().startswith("#") or lazyinst.search(L):
+                continue
+            m = lazydef.search(L)
+            if m is None or m.group(1) == "INSTANCE":
+                return None
+            lastdef[m.group(1)] = L
+
+        initial = {"DIRNAME": self.dirname, "PATH": self.path}
+        blank = config.__new__(config)
+        blank.__dict__.update(self.__dict__)
+        blank.ddict = {}
+
+        def parse(cfg, key):
+            output = io.StringIO()
+            expand(cfg, [lastdef[key]], output, cfg is blank)
+            d = {"_failed_include": []}
+            self.process_config_line(output.getvalue(), d)
+            return d[key]
+
+        def prelim(key):
+            if key in lastdef:
+                return parse(blank, key)
+            return initial[key]
+
+        if name not in lastdef:
+            return initial.get(name, "")
+        self.ddict = lazy_dict(prelim)
+        try:
+            return parse(self, name)
+        finally:
+            self.ddict = {}
+
+    def loop_view(self, iname, spec):
+        """
+        Return the list of instance dictionaries that $$LOOP(iname, spec)
+        runs over, where spec is a comma-separated list of FIELD=VALUE
+        filters, and SORT=FIELD.  Each is a copy of an instance, with
+        LOOPINDEX set to its place in the loop (INDEX is left alone).
+
+        The lists for instance loops are kept until the instances change
+        (see derived()).
+        """
+        if "$$" in spec:
+            output = io.StringIO()
+            expand(self, [spec], output)
+            spec = output.getvalue()
+        cacheable = iname in self.idict
+        if cacheable:
+            try:
+                return self.derived()[("view", iname, spec)]
+            except KeyError:
+                pass
+        filters = []
+        sort = None
+        for arg in spec.split(","):
+            field, eq, value = arg.partition("=")
+            field = field.strip()
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            if not eq or field == "":
+                raise ExpandError("Bad $$LOOP(%s,%s)" % (iname, spec))
+            if field == "SORT":
+                sort = value
+            else:
+                filters.append((field, value))
+        ilist = [
+            inst
+            for inst in self.loop_instances(iname)
+            if all(inst.get(field, "") == value for field, value in filters)
+        ]
+        if sort is not None:
+            keys = [inst.get(sort, "") for inst in ilist]
+            try:
+                keys = [float(k) for k in keys]
+            except (TypeError, ValueError):
+                pass
+            order = sorted(range(len(ilist)), key=keys.__getitem__)
+            ilist = [ilist[n] for n in order]
+        ilist = [dict(inst, LOOPINDEX=str(n)) for n, inst in enumerate(ilist)]
+        if cacheable:
+            self.derived()[("view", iname, spec)] = ilist
+        return ilist
+
+    def derived(self):
+        """
+        Return the dictionary of things worked out from the instances (loop
+        views and lookup indexes), emptied whenever the instances change.
+        """
+        if getattr(self, "derived_of", None) is not self.idict:
+            self.derived_data = {}
+            self.derived_of = self.idict
+        return self.derived_data
+
+    def lookup(self, iname, keyfield, keyvalue, outfield):
+        """
+        Return outfield of the first iname instance whose keyfield is
+        keyvalue, or None.  The index of iname by keyfield is made the first
+        time it is needed, and kept with the config.
+        """
+        if iname not in self.idict:
+            return None
+        cache = self.derived()
+        try:
+            index = cache[("index", iname, keyfield)]
+        except KeyError:
+            index = {}
+            for inst in self.idict[iname]:
+                key = inst.get(keyfield)
+                if key is not None:
+                    index.setdefault(str(key), inst)
+            cache[("index", iname, keyfield)] = index
+        inst = index.get(keyvalue)
+        if inst is None:
+            return None
+        return inst.get(outfield)
+
+    def loop_count(self, iname):
+        """
+        Return how many times $$LOOP(iname) runs, without making the list.
+        """
+        if iname[0] >= "0" and iname[0] <= "9":
+            value = iname
+        elif iname in self.idict:
+            return len(self.idict[iname])
+        else:
+            value = self.ddict.get(iname)
+        try:
+            return max(0, int(value))
+        except Exception:
+            return 0
+
+    def loop_instances(self, iname):
+        """
+        Return the list of instance dictionaries that $$LOOP(iname) runs over:
+        the iname instances, or iname (or its value) {"INDEX": n} dicts.
+        """
+        if iname[0] >= "0" and iname[0] <= "9":
+            try:
+                cnt = int(iname)
+            except Exception:
+                cnt = 0
+            return [{"INDEX": str(n)} for n in range(cnt)]
+        elif iname in self.idict:
+            try:
+                return self.idict[iname]
+            except Exception:
+                return []
+        else:
+            try:
+                cnt = int(self.ddict[iname])
+            except Exception:
+                cnt = 0
+            return [{"INDEX": str(n)} for n in range(cnt)]
 
     def eval_expr(self, expr):
         return self.eval_(
-            ast.parse(expr).body[0].value
+            load_ast().parse(expr).body[0].value
         )  # Module(body=[Expr(value=...)])
 
     def eval_(self, node):
@@ -389,16 +892,9 @@ class config:
             return node.n
         elif isinstance(node, ast.Name):
             try:
-                n = self.ddict[node.id]
-                if n[:2] == "0x":
-                    x = int(self.ddict[node.id], 16)
-                elif n[0] == "0":
-                    x = int(self.ddict[node.id], 8)
-                else:
-                    x = int(self.ddict[node.id], 10)
+                return calc_atom(self.ddict[node.id])
             except Exception:
-                x = 0
-            return x
+                return 0
         elif isinstance(node, ast.operator):
             return operators[type(node)]
         elif isinstance(node, ast.BinOp):
@@ -414,6 +910,466 @@ class config:
             raise TypeError(node)
 
 
+class lazy_dict(dict):
+    """
+    A dictionary that fills in missing entries by calling func(key), which
+    raises KeyError if there is no such entry.
+    """
+
+    def __init__(self, func):
+        dict.__init__(self)
+        self.func = func
+
+    def __missing__(self, key):
+        value = self.func(key)
+        self[key] = value
+        return value
+
+
+class recording_dict(dict):
+    """
+    A dictionary that notes the name of every key looked up in it.
+
+    iteration_cache swaps these in for cfg.ddict and cfg.idict while it expands a
+    loop iteration, to find out which variables the iteration depends on.
+    Copies (made by nested $$LOOPs) share the same log.
+    """
+
+    def __init__(self, data, log):
+        dict.__init__(self, data)
+        self.log = log
+
+    def __getitem__(self, key):
+        self.log.add(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.log.add(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.log.add(key)
+        return dict.get(self, key, default)
+
+    def copy(self):
+        return recording_dict(self, self.log)
+
+
+def digest(*parts):
+    import hashlib
+
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode("utf-8", "surrogateescape"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def file_digest(fn):
+    try:
+        with open(fn, "rb") as fp:
+            return digest(fp.read())
+    except OSError:
+        return None
+
+
+class iteration_cache:
+    """
+    A persistent cache of the output of individual $$LOOP iterations.
+
+    When a single instance in a large cfg changes, the iterations for all of
+    the other instances produce exactly the same text as last time.  This
+    cache (enabled with --loop-cache FILE or EXPAND_LOOP_CACHE=FILE) stores
+    each iteration's output keyed by the loop body, the instance's fields and
+    the enclosing loop indices.  Along with the output, each entry records
+    the "read-set" of the iteration: the value of every variable it looked
+    up, the contents of every instance list it used and the contents of
+    every file it included.  An entry is only reused if all of those still
+    match, so the output is always the same as expanding from scratch.
+
+    Loops whose body contains $$ASSIGN, or whose iterations turn out to
+    $$ASSIGN something (in an $$INCLUDE, say), are not cached, since their
+    output can depend on the previous iterations.  Loops nested inside an
+    iteration that is being recorded are expanded normally.
+
+    Only the entries used by this run are written back, so the cache file
+    doesn't grow without bound.
+    """
+
+    version = 1
+    max_variants = 4  # Entries kept for the same key, newest first.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.used = {}
+        self.recording = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            import json
+
+            with open(filename) as fp:
+                data = json.load(fp)
+            if data.get("version") == self.version:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def body(self, lines):
+        """
+        Return the cache key for a loop body, or None if the loop shouldn't be
+        cached.
+        """
+        if self.recording:
+            return None
+        text = "".join(lines)
+        if "$$ASSIGN" in text or "$$OUTPUT(" in text:
+            return None
+        return digest(text)
+
+    def lookup(self, key, cfg):
+        for entry in self.entries.get(key, []):
+            if (
+                all(cfg.ddict.get(k) == v for k, v in entry["reads"])
+                and all(digest(cfg.idict.get(k)) == v for k, v in entry["instances"])
+                and all(file_digest(fn) == v for fn, v in entry["files"])
+            ):
+                return entry
+        return None
+
+    def expand_iteration(self, cfg, lines, f, body, inst):
+        """
+        Expand one iteration of a loop with the given body key and instance,
+        with cfg.ddict already set up for the iteration.
+        """
+        global opened_files
+
+        indices = sorted((k, v) for k, v in cfg.ddict.items() if idxre.search(k))
+        key = digest(body, sorted(inst.items()), indices)
+        entry = self.lookup(key, cfg)
+        if entry is not None:
+            self.hits += 1
+            self.used.setdefault(key, [])
+            if entry not in self.used[key]:
+                self.used[key].append(entry)
+            f.write(entry["output"])
+            return
+
+        self.misses += 1
+        base = cfg.ddict
+        idict = cfg.idict
+        reads = set()
+        instances = set()
+        output = io.StringIO()
+        old_files = opened_files
+        opened_files = set()
+        self.recording = True
+        try:
+            cfg.ddict = recording_dict(base, reads)
+            cfg.idict = recording_dict(idict, instances)
+            expand(cfg, lines, output)
+            files = opened_files
+        finally:
+            self.recording = False
+            if old_files is not None:
+                old_files |= opened_files
+            opened_files = old_files
+            # Hand back a plain dictionary holding whatever the body left.
+            cfg.ddict = dict(cfg.ddict)
+            cfg.idict = idict
+            # Pass on what was written even if the body failed part way.
+            value = output.getvalue()
+            f.write(value)
+        if cfg.assigns[-1]:
+            return  # It $$ASSIGNed something, so the order matters.
+        entry = {
+            "reads": sorted((k, base.get(k)) for k in reads),
+            "instances": sorted((k, digest(idict.get(k))) for k in instances),
+            "files": sorted((fn, file_digest(fn)) for fn in files),
+            "output": value,
+        }
+        variants = [entry] + self.used.get(key, [])
+        self.used[key] = variants[: self.max_variants]
+
+    def save(self):
+        import json
+
+        tmp = "%s.%d.tmp" % (self.filename, os.getpid())
+        try:
+            with open(tmp, "w") as fp:
+                json.dump({"version": self.version, "entries": self.used}, fp)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            print("Cannot write loop cache %s: %s" % (self.filename, e))
+
+
+def compile_calc(node):
+    """
+    Turn a parsed $$CALC expression into a function of a dictionary of atom
+    values that computes what config.eval_() would, raising the same way.
+    """
+    if isinstance(node, ast.Num):
+        n = node.n
+        return lambda env: n
+    elif isinstance(node, ast.Name):
+        name = node.id
+        return lambda env: env[name]
+    elif isinstance(node, ast.BinOp):
+        # eval_() looks operators up only if they are ast.operators, so unary
+        # operators (ast.unaryop) always fail, and so does anything else.
+        op = operators.get(type(node.op))
+        left = compile_calc(node.left)
+        right = compile_calc(node.right)
+        if op is not None:
+            return lambda env: op(left(env), right(env))
+    elif isinstance(node, ast.IfExp):
+        test = compile_calc(node.test)
+        body = compile_calc(node.body)
+        orelse = compile_calc(node.orelse)
+        return lambda env: body(env) if test(env) else orelse(env)
+
+    def fail(env):
+        raise TypeError(node)
+
+    return fail
+
+
+# Array versions of the operators, for the ones where int64 arithmetic gives
+# the same answer as Python's as long as nothing overflows or divides by 0.
+numpy_operators = {
+    "Add": "add",
+    "Sub": "subtract",
+    "Mult": "multiply",
+    "Mod": "remainder",
+    "BitOr": "bitwise_or",
+    "BitAnd": "bitwise_and",
+    "BitXor": "bitwise_xor",
+}
+
+
+def numpy_calc(np, node, columns):
+    """
+    Evaluate a parsed $$CALC expression over int64 columns of atom values.
+
+    Returns (array, bound), where bound is an upper limit on the magnitude
+    of the results, or None if the expression isn't one that NumPy computes
+    exactly like Python.
+    """
+    if isinstance(node, ast.Num) and type(node.n) is int:
+        return np.int64(node.n), abs(node.n)
+    elif isinstance(node, ast.Name):
+        return columns[node.id]
+    elif isinstance(node, ast.BinOp):
+        opname = numpy_operators.get(type(node.op).__name__)
+        left = numpy_calc(np, node.left, columns)
+        right = numpy_calc(np, node.right, columns)
+        if opname is None or left is None or right is None:
+            return None
+        if opname == "remainder" and np.any(right[0] == 0):
+            return None
+        if opname == "multiply":
+            bound = left[1] * right[1]
+        else:
+            bound = 2 * max(left[1], right[1]) + 1
+        if bound >= 2**62:
+            return None
+        return getattr(np, opname)(left[0], right[0]), bound
+    return None
+
+
+def import_numpy():
+    try:
+        import numpy
+
+        return numpy
+    except ImportError:
+        return None
+
+
+class simple_loop:
+    """
+    A $$LOOP body that is only text, variable references and $$CALC{EXPR} or
+    $$CALC{EXPR,FORMAT} with no $$ inside EXPR.  Long loops over such bodies
+    are rendered for all iterations at once rather than expanding the body
+    once per iteration: each variable reference and $$CALC becomes a column
+    of values, the $$CALC expressions are compiled once (and computed with
+    NumPy array arithmetic, when it is available and the loop is long
+    enough), and each iteration is a single % of a precompiled format string.
+
+    The output is exactly what expand() would write.  Anything that would
+    make it differ (say, an overflow, or a format that doesn't fit the
+    value) makes render() return False without writing anything, and the
+    loop is expanded the usual way instead.
+    """
+
+    threshold = 32  # Shorter loops are expanded the usual way.
+    numpy_threshold = 256
+    bodies = {}  # tuple(lines) -> simple_loop, or None if it isn't one
+    max_bodies = 256
+    numpy = False  # Not imported yet.
+
+    def __init__(self, fmt, tokens):
+        self.fmt = fmt
+        self.tokens = tokens
+
+    @classmethod
+    def get(cls, lines):
+        key = tuple(lines)
+        try:
+            return cls.bodies[key]
+        except KeyError:
+            pass
+        if len(cls.bodies) >= cls.max_bodies:
+            cls.bodies.clear()  # Old versions of templates being edited.
+        body = cls.bodies[key] = cls.parse(lines)
+        return body
+
+    @classmethod
+    def parse(cls, lines):
+        """
+        Split the body into a format string and a list of ("var", name) and
+        ("calc", expression, format) tokens, following what expand() does,
+        or return None if it isn't simple.
+        """
+        fmt = []
+        tokens = []
+        for line in lines:
+            loc = 0
+            while True:
+                m = doubledollar.search(line[loc:])
+                if m is None:
+                    fmt.append(line[loc:].replace("%", "%%"))
+                    break
+                fmt.append(m.group(1).replace("%", "%%"))
+                loc += m.end(1) + 2
+                if loc >= len(line):
+                    return None
+                m = keyword.search(line[loc:])
+                if m is not None:
+                    if m.group(2) != "CALC":
+                        return None
+                    loc += m.end(2)
+                    argm = brackets.search(line[loc:])
+                    if argm is None or "$$" in argm.group(1):
+                        return None
+                    loc += argm.end(1) + 1
+                    args = argm.group(1).split(",")
+                    if "(" in args[0]:
+                        args = [argm.group(1)]
+                    try:
+                        root = load_ast().parse(args[0]).body[0].value
+                    except Exception:
+                        root = None
+                    names = set()
+                    if root is not None:
+                        for node in ast.walk(root):
+                            if isinstance(node, ast.Name):
+                                names.add(node.id)
+                    fmtv = args[1] if len(args) > 1 else "%d"
+                    tokens.append(("calc", root, sorted(names), fmtv))
+                elif line[loc] == "(":
+                    m = parens.search(line[loc:])
+                    if m is None:
+                        return None
+                    tokens.append(("var", m.group(1)))
+                    loc += m.end(1) + 1
+                else:
+                    m = word.search(line[loc:])
+                    tokens.append(("var", m.group(1)))
+                    loc += m.end(1)
+                fmt.append("%s")
+        return cls("".join(fmt), tokens)
+
+    def render(self, ddict, ilist, f):
+        """
+        Write the body for every instance in ilist, with ddict the variables
+        outside of the loop.  Returns False if it can't be done exactly.
+        """
+        base = rename_index(ddict.copy())
+
+        def column(name):
+            return [
+                inst[name] if name in inst else base[name] if name in base else None
+                for inst in ilist
+            ]
+
+        try:
+            columns = []
+            for token in self.tokens:
+                if token[0] == "var":
+                    values = column(token[1])
+                    if any(type(v) is not str for v in values if v is not None):
+                        return False
+                    columns.append(["" if v is None else v for v in values])
+                else:
+                    fmt = token[3]
+                    columns.append([fmt % v for v in self.calc(token, column)])
+            if columns:
+                rows = [self.fmt % row for row in zip(*columns)]
+            else:
+                rows = [self.fmt % ()] * len(ilist)
+        except Exception:
+            return False
+        f.write("".join(rows))
+        return True
+
+    def calc(self, token, column):
+        """
+        Compute the values of a $$CALC token for every iteration.
+        """
+        root, names = token[1], token[2]
+        atoms = {}
+        for name in names:
+            values = []
+            for v in column(name):
+                try:
+                    values.append(calc_atom(v))
+                except Exception:
+                    values.append(0)
+            atoms[name] = values
+        count = len(next(iter(atoms.values()))) if atoms else None
+
+        if count is not None and count >= self.numpy_threshold:
+            if simple_loop.numpy is False:
+                simple_loop.numpy = import_numpy()
+            np = simple_loop.numpy
+            if np is not None:
+                bounds = {k: max(abs(v) for v in vs) for k, vs in atoms.items()}
+                if max(bounds.values()) < 2**62:
+                    result = numpy_calc(
+                        np,
+                        root,
+                        {
+                            k: (np.array(vs, dtype=np.int64), bounds[k])
+                            for k, vs in atoms.items()
+                        },
+                    )
+                    if result is not None:
+                        return result[0].tolist()
+
+        func = compile_calc(root) if root is not None else None
+        results = []
+        for k in range(count if count is not None else len(column(""))):
+            try:
+                results.append(func({name: atoms[name][k] for name in names}))
+            except Exception:
+                results.append(0)
+        return results
+
+
+# The iteration_cache in use, if any (see --loop-cache).
+loop_cache = None
+
+# While expanding a template for expand_file(), a dictionary of the
+# $$OUTPUT(NAME) streams written so far, by NAME.  When None, $$OUTPUT blocks
+# are expanded and thrown away.
+named_outputs = None
+# Where to write each $$OUTPUT(NAME) (see --output-map).  Other names are
+# written next to the main output.
+output_map = {}
+
+
 # Find the endre in the lines starting at index i, offset l.
 # However, lb and rb are regular expressions that denote a region to be skipped.
 # Note that endre might be equal to rb!
@@ -526,7 +1482,205 @@ def enumstring(s):
     return out
 
 
-def expand(cfg, lines, f, isfirst=False):
+class ExpandError(Exception):
+    """
+    An error in a template or config that stops the expansion.
+    """
+
+
+class BudgetExceeded(ExpandError):
+    """
+    An expansion used more than one of the budgets allows.  where is the
+    FILE:LINE responsible, if it is known.
+    """
+
+    def __init__(self, what, where=None):
+        ExpandError.__init__(self, what)
+        self.what = what
+        self.where = where
+
+    def __str__(self):
+        if self.where is None:
+            return self.what
+        return "%s: %s" % (self.where, self.what)
+
+
+class budgets:
+    """
+    Limits on what expanding may use, so that a typo such as a $$LOOP over a
+    huge number, or a file that includes itself, fails quickly instead of
+    running for minutes or filling the disk.  Each limit is None for none:
+
+        output_bytes   - bytes written to each output file.
+        iterations     - $$LOOP iterations in all, config and templates alike.
+        include_depth  - $$INCLUDEs nested within each other.
+        seconds        - wall time from when this was created.
+
+    Iterations are counted before a loop starts, so a loop that would go
+    over never runs at all.  The clock is checked each time expand() starts
+    or resumes a frame (a loop iteration, an $$IF or $$INCLUDE body, ...).
+    """
+
+    def __init__(
+        self, output_bytes=None, iterations=None, include_depth=None, seconds=None
+    ):
+        import time
+
+        self.output_bytes = output_bytes
+        self.iterations = iterations
+        self.include_depth = include_depth
+        self.seconds = seconds
+        self.clock = time.monotonic
+        self.deadline = None if seconds is None else self.clock() + seconds
+        self.used_iterations = 0
+
+    def iterate(self, n, fr, i):
+        self.used_iterations += n
+        if self.iterations is not None and self.used_iterations > self.iterations:
+            raise BudgetExceeded(
+                "More than %d $$LOOP iterations (--max-iterations)" % self.iterations,
+                location(fr, i),
+            )
+
+    def include(self, depth, fr, i):
+        if self.include_depth is not None and depth >= self.include_depth:
+            raise BudgetExceeded(
+                "$$INCLUDEs nested more than %d deep (--max-include-depth)"
+                % self.include_depth,
+                location(fr, i),
+            )
+
+    def tick(self, fr):
+        if self.deadline is not None and self.clock() > self.deadline:
+            raise BudgetExceeded(
+                "Expanding took more than %g seconds (--max-seconds)" % self.seconds,
+                location(fr, fr.i) if fr.name is not None else None,
+            )
+
+
+class metered_output:
+    """
+    An output stream that passes writes on to f, and raises BudgetExceeded
+    once more than limit characters have been written.
+    """
+
+    def __init__(self, f, limit):
+        self.f = f
+        self.limit = limit
+        self.written = 0
+
+    def write(self, s):
+        self.written += len(s)
+        if self.written > self.limit:
+            raise BudgetExceeded(
+                "More than %d bytes of output (--max-output-bytes)" % self.limit
+            )
+        return self.f.write(s)
+
+    def flush(self):
+        self.f.flush()
+
+
+# The budgets in force, if any (see --max-output-bytes and friends).
+budget = None
+
+# The most frames expand() may have on its stacks at once (see --max-depth).
+max_depth = 10000
+# The number of frames on expand()'s stacks, and the files being $$INCLUDEd
+# by them, by file identity.
+nesting = 0
+including = {}
+
+
+class frame:
+    """
+    One entry on expand()'s stack: lines to expand and how far we have got,
+    a function to call when they are done (returning the next frame, if any),
+    for an $$INCLUDEd file, (file identity, $$INCLUDE argument, name), and
+    the stream to write to (if None when pushed, that of the frame below).
+    name and line say where the lines came from, for error messages.
+    """
+
+    __slots__ = ("lines", "i", "loc", "done", "include", "out", "name", "line")
+
+    def __init__(self, lines, done=None, include=None, out=None, line=0):
+        self.lines = lines
+        self.i = 0
+        self.loc = 0
+        self.done = done
+        self.include = include
+        self.out = out
+        self.name = None  # The file the lines are from, if known.
+        self.line = line  # Where in it lines[0] is, counting from 0.
+
+
+def location(fr, i):
+    """
+    The FILE:LINE of line i of frame fr.
+    """
+    return "%s:%d" % (fr.name or "<string>", fr.line + i + 1)
+
+
+def include_chain():
+    return " <- ".join(reversed(list(including.values())))
+
+
+def push_frame(stack, fr):
+    global nesting
+    if nesting >= max_depth:
+        where = include_chain()
+        raise ExpandError(
+            "Nesting is more than %d levels deep%s"
+            % (max_depth, " in " + where if where else "")
+        )
+    if fr.include is not None:
+        if fr.include[0] in including:
+            raise ExpandError(
+                "Recursive $$INCLUDE(%s): %s <- %s"
+                % (fr.include[1], fr.include[2], include_chain())
+            )
+        including[fr.include[0]] = fr.include[2]
+    nesting += 1
+    stack.append(fr)
+
+
+def pop_frame(stack):
+    global nesting
+    fr = stack.pop()
+    nesting -= 1
+    if fr.include is not None:
+        del including[fr.include[0]]
+    return fr
+
+
+def end_iteration(cfg, olddict):
+    # Now, within the $$LOOP, we might have done some $$ASSIGNs.
+    # We need to pull these back into olddict!
+    for dname in cfg.assigns[-1]:
+        olddict[dname] = cfg.ddict[dname]
+    cfg.assigns[-1] = set()
+
+
+def loop_frame(cfg, body, ilist, n, olddict):
+    """
+    Set up iteration n of a $$LOOP over ilist, returning the frame for its
+    body.  When the loop is over, restore the variables and return None.
+    """
+    if n >= len(ilist):
+        cfg.assigns = cfg.assigns[:-1]  # Pop the assignment context for the loop.
+        cfg.ddict = olddict
+        return None
+    cfg.ddict = rename_index(olddict.copy())
+    cfg.ddict.update(ilist[n])
+
+    def done():
+        end_iteration(cfg, olddict)
+        return loop_frame(cfg, body, ilist, n + 1, olddict)
+
+    return frame(body, done)
+
+
+def expand(cfg, lines, f, isfirst=False, name=None, line=0):
     """
     expand is where the magic happens.
 
@@ -539,9 +1693,140 @@ def expand(cfg, lines, f, isfirst=False):
     isfirst is a flag indicating that we are actually processing the config file,
     and so $$INCLUDE might fail until we evaluate enough variables to properly
     expand the filename.
+
+    Rather than recursing into $$LOOP iterations, $$IF bodies and $$INCLUDEd
+    files, expand_frame() hands them back as a new frame, and they are kept
+    on an explicit stack here.  (Expanding a keyword's arguments still calls
+    expand() again, but those are single strings.)  The nesting of frames,
+    across all active calls, is limited to max_depth, and an $$INCLUDE of a
+    file that is already being included is an error.
+
+    An exception while expanding an $$INCLUDEd file is reported as failing
+    to open the file, as it always has been.
+
+    name and line are the file lines came from and the line number of
+    lines[0] in it (counting from 0), for locating errors.
+    """
+    stack = []
+    try:
+        top = frame(lines, out=f, line=line)
+        top.name = name
+        push_frame(stack, top)
+        while stack:
+            top = stack[-1]
+            try:
+                if budget is not None:
+                    budget.tick(top)
+                new = expand_frame(cfg, top, top.out, isfirst)
+                if new is None:
+                    pop_frame(stack)
+                    if top.done is not None:
+                        new = top.done()
+                        if new is not None:  # The next iteration of a loop.
+                            new.name = top.name
+                            new.line = top.line
+            except BudgetExceeded as e:
+                if e.where is None and top.name is not None:
+                    e.where = location(top, top.i)
+                raise
+            except ExpandError:
+                raise
+            except Exception:
+                # Unwind to the innermost $$INCLUDE, if there is one.
+                if not any(fr.include is not None for fr in stack):
+                    raise
+                while stack[-1].include is None:
+                    pop_frame(stack)
+                fr = pop_frame(stack)
+                if isfirst:
+                    fr.out.write("$$INCLUDE(%s)\n" % fr.include[1])
+                else:
+                    print("Cannot open file %s!\n" % fr.include[2])
+                continue
+            if new is not None:
+                if new.out is None:
+                    new.out = top.out
+                if new.include is not None:
+                    new.name = new.include[2]
+                elif new.name is None:
+                    new.name = top.name
+                push_frame(stack, new)
+    finally:
+        while stack:
+            pop_frame(stack)
+
+
+def include_name(cfg, arg, isfirst):
     """
-    i = 0
-    loc = 0
+    The file name an $$INCLUDE(arg) or $$RAWINCLUDE(arg) refers to: arg, or
+    the value of the variable arg, expanded.
+    """
+    try:
+        fn = cfg.ddict[arg]
+    except Exception:
+        fn = arg
+    try:
+        output = io.StringIO()
+        expand(cfg, [fn], output, isfirst)
+        fn = output.getvalue().strip()
+        output.close()
+    except Exception:
+        pass
+    return fn
+
+
+def copy_raw(fp, f):
+    """
+    Copy the file fp (as opened by myopen()) to the output f exactly as it
+    is, for $$RAWINCLUDE.  When f is a file, the bytes go straight from one
+    file to the other with sendfile(); otherwise they are decoded a chunk at
+    a time, without translating line endings, and written to f as text.
+    Either way, the file is never all in memory, or scanned for $$.
+    """
+    src = fp.buffer
+    if type(f) is io.TextIOWrapper:
+        try:
+            out = f.fileno()
+        except (OSError, ValueError):
+            out = None
+        if out is not None:
+            import shutil
+
+            f.flush()
+            offset = 0
+            try:
+                while True:
+                    n = os.sendfile(out, src.fileno(), offset, 1 << 24)
+                    if n == 0:
+                        return
+                    offset += n
+            except (AttributeError, OSError):
+                if offset != 0:
+                    raise
+            shutil.copyfileobj(src, f.buffer)
+            f.buffer.flush()
+            return
+    import codecs
+
+    decoder = codecs.getincrementaldecoder(fp.encoding)(fp.errors)
+    while True:
+        data = src.read(1 << 16)
+        text = decoder.decode(data, final=not data)
+        if text:
+            f.write(text)
+        if not data:
+            return
+
+
+def expand_frame(cfg, fr, f, isfirst):
+    """
+    Expand the lines of frame fr from where it left off, until they are done
+    (returning None) or a block needs expanding (returning a frame for it,
+    with fr's position saved just past the block).
+    """
+    lines = fr.lines
+    i = fr.i
+    loc = fr.loc
     while i < len(lines):
         m = doubledollar.search(lines[i][loc:])
         if m is None:
@@ -558,6 +1843,7 @@ def expand(cfg, lines, f, isfirst=False):
 
         m = keyword.search(lines[i][loc:])
         if m is not None:
+            kwline = i
             kw = m.group(1)
             if kw is None:
                 kw = m.group(2)
@@ -611,47 +1897,57 @@ def expand(cfg, lines, f, isfirst=False):
 
             if argm is not None:
                 if kw == "LOOP":
-                    iname = argm.group(1)
-                    startloop = re.compile(r"(.*?)\$\$LOOP\(" + iname + r"(\))")
+                    iname, filtered, spec = argm.group(1).partition(",")
+                    if filtered:
+                        iname = iname.strip()
+                    startloop = re.compile(r"(.*?)\$\$LOOP\(" + iname + r"(\)|,)")
                     endloop = re.compile(r"(.*?)\$\$ENDLOOP\(" + iname + r"(\))")
                     t = searchforend(lines, endloop, startloop, endloop, i, loc)
                     if t is None:
                         print("Cannot find $$ENDLOOP(%s)?" % iname)
                         sys.exit(1)
-                    if iname[0] >= "0" and iname[0] <= "9":
-                        try:
-                            cnt = int(iname)
-                        except Exception:
-                            cnt = 0
-                        ilist = [{"INDEX": str(n)} for n in range(cnt)]
-                    elif iname in list(cfg.idict.keys()):
-                        try:
-                            ilist = cfg.idict[iname]
-                        except Exception:
-                            ilist = []
+                    body_line = fr.line + i
+                    if filtered:
+                        ilist = cfg.loop_view(iname, spec)
+                        if budget is not None:
+                            budget.iterate(len(ilist), fr, kwline)
                     else:
-                        try:
-                            cnt = int(cfg.ddict[iname])
-                        except Exception:
-                            cnt = 0
-                        ilist = [{"INDEX": str(n)} for n in range(cnt)]
-                    olddict = cfg.ddict
+                        if budget is not None:
+                            # Before $$LOOP(COUNT) makes its COUNT instances.
+                            budget.iterate(cfg.loop_count(iname), fr, kwline)
+                        ilist = cfg.loop_instances(iname)
+                    if telemetry is not None:
+                        telemetry.iterations += len(ilist)
+                    if len(ilist) >= simple_loop.threshold:
+                        body = simple_loop.get(t[0])
+                        if body is not None and body.render(cfg.ddict, ilist, f):
+                            i = t[1]
+                            loc = t[2]
+                            continue
+                    i = t[1]
+                    loc = t[2]
                     cfg.assigns.append(set())  # Push a new assignment context.
+                    cache = None
+                    if loop_cache is not None and not isfirst:
+                        cache = loop_cache.body(t[0])
+                    if cache is None:
+                        new = loop_frame(cfg, t[0], ilist, 0, cfg.ddict)
+                        if new is not None:
+                            new.line = body_line
+                            fr.i = i
+                            fr.loc = loc
+                            return new
+                        continue
+                    olddict = cfg.ddict
                     for inst in ilist:
                         cfg.ddict = rename_index(olddict.copy())
                         cfg.ddict.update(inst)
-                        expand(cfg, t[0], f, isfirst)
-                        # Now, within the $$LOOP, we might have done some $$ASSIGNs.
-                        # We need to pull these back into olddict!
-                        for dname in cfg.assigns[-1]:
-                            olddict[dname] = cfg.ddict[dname]
-                        cfg.assigns[-1] = set()
+                        loop_cache.expand_iteration(cfg, t[0], f, cache, inst)
+                        end_iteration(cfg, olddict)
                     cfg.assigns = cfg.assigns[
                         :-1
                     ]  # Pop the assignment context for the loop.
                     cfg.ddict = olddict
-                    i = t[1]
-                    loc = t[2]
                 elif kw == "IF" or kw == "DIF" or kw == "IFCALC":
                     if kw == "IFCALC":
                         iname = "CALC"
@@ -695,21 +1991,26 @@ def expand(cfg, lines, f, isfirst=False):
                             if ((dif and v == eqval) or ((not dif) and v != ""))
                             else 0
                         )
+                    newlines = None
+                    body_line = fr.line + i
                     if testv != 0:
                         # True, do the if!
                         if elset is not None:
                             newlines = elset[0]
                         else:
                             newlines = t[0]
-                        expand(cfg, newlines, f, isfirst)
                     else:
                         # False, do the else!
                         if elset is not None:
                             newlines = t[0][elset[1] :]
                             newlines[0] = newlines[0][elset[2] :]
-                            expand(cfg, newlines, f, isfirst)
+                            body_line += elset[1]
                     i = t[1]
                     loc = t[2]
+                    if newlines is not None:
+                        fr.i = i
+                        fr.loc = loc
+                        return frame(newlines, line=body_line)
                 elif kw == "TIF":
                     iname = argm.group(1)
                     if "$$" in iname:
@@ -728,33 +2029,90 @@ def expand(cfg, lines, f, isfirst=False):
                     else:
                         # False, do the else!
                         newlines.append(argm.group(3))
-                    expand(cfg, newlines, f, isfirst)
+                    fr.i = i
+                    fr.loc = loc
+                    return frame(newlines, line=fr.line + kwline)
                 elif kw == "INCLUDE":
+                    fn = include_name(cfg, argm.group(1), isfirst)
+                    if budget is not None:
+                        budget.include(len(including), fr, kwline)
                     try:
-                        fn = cfg.ddict[argm.group(1)]
-                    except Exception:
-                        fn = argm.group(1)
-                    try:
-                        output = io.StringIO()
-                        expand(cfg, [fn], output, isfirst)
-                        fn = output.getvalue().strip()
-                        output.close()
+                        newlines, identity = read_include(fn)
                     except Exception:
-                        pass
+                        if isfirst:
+                            f.write("$$INCLUDE(%s)\n" % argm.group(1))
+                        else:
+                            print("Cannot open file %s!\n" % fn)
+                    else:
+                        if telemetry is not None:
+                            telemetry.includes += 1
+                        fr.i = i
+                        fr.loc = loc
+                        include = (identity, argm.group(1), fn)
+                        return frame(newlines, include=include)
+                elif kw == "RAWINCLUDE":
+                    fn = include_name(cfg, argm.group(1), isfirst)
                     try:
-                        newlines = myopen(fn).readlines()
-                        expand(cfg, newlines, f, isfirst)
+                        fp = myopen(fn)
                     except Exception:
+                        fp = None
+                    if not fp or fp is sys.stdin:
                         if isfirst:
-                            f.write("$$INCLUDE(%s)\n" % argm.group(1))
+                            f.write("$$RAWINCLUDE(%s)\n" % argm.group(1))
                         else:
                             print("Cannot open file %s!\n" % fn)
+                    else:
+                        if telemetry is not None:
+                            telemetry.includes += 1
+                        with fp:
+                            copy_raw(fp, f)
+                elif kw == "OUTPUT":
+                    oname = argm.group(1)
+                    startre = re.compile(
+                        r"(.*?)\$\$OUTPUT\(" + re.escape(oname) + r"(\))"
+                    )
+                    endre = re.compile(
+                        r"(.*?)\$\$ENDOUTPUT\(" + re.escape(oname) + r"(\))"
+                    )
+                    t = searchforend(lines, endre, startre, endre, i, loc)
+                    if t is None:
+                        print("Cannot find $$ENDOUTPUT(%s)?" % oname)
+                        sys.exit(1)
+                    if "$$" in oname:
+                        output = io.StringIO()
+                        expand(cfg, [oname], output, isfirst)
+                        oname = output.getvalue().strip()
+                        output.close()
+                    if named_outputs is not None:
+                        out = named_outputs.setdefault(oname, io.StringIO())
+                    else:
+                        out = io.StringIO()  # Nobody wants it.
+                    fr.i = t[1]
+                    fr.loc = t[2]
+                    return frame(t[0], out=out, line=fr.line + i)
                 elif kw == "COUNT":
                     try:
                         cnt = str(len(cfg.idict[argm.group(1)]))
                     except Exception:
                         cnt = "0"
                     f.write(cnt)
+                elif kw == "LOOKUP":
+                    args = argm.group(1).split(",")
+                    if len(args) != 4:
+                        raise ExpandError(
+                            "%s: $$LOOKUP(%s) doesn't have four arguments"
+                            % (location(fr, kwline), argm.group(1))
+                        )
+                    for n, arg in enumerate(args):
+                        if "$$" in arg:
+                            output = io.StringIO()
+                            expand(cfg, [arg], output, isfirst)
+                            arg = output.getvalue()
+                            output.close()
+                        args[n] = arg.strip()
+                    val = cfg.lookup(*args)
+                    if val is not None:
+                        f.write(val if isinstance(val, str) else str(val))
                 elif kw == "ASSIGN":
                     args = argm.group(1).split(",")
                     output = io.StringIO()
@@ -805,6 +2163,10 @@ def expand(cfg, lines, f, isfirst=False):
                         fn = argm.group(1)
                     if "." in fn:
                         fn = fn[: fn.index(".")]
+                    else:
+                        # Only variable references write a config value as
+                        # it is (see expand_partial.py), so make a plain str.
+                        fn = str(fn)
                     f.write(fn)
                 elif kw == "SUBSTR":
                     output = io.StringIO()
@@ -894,6 +2256,247 @@ def expand(cfg, lines, f, isfirst=False):
                 loc += m.end(1)
         else:
             print("Can't find variable name?!?")
+    return None
+
+
+def write_if_changed(path, text):
+    """
+    Write text to path, unless that is exactly what it already holds, so that
+    its modification time only changes along with its contents.  Returns
+    True if it was written.
+    """
+    path = rooted(path)
+    try:
+        with open(path) as fp:
+            if fp.read() == text:
+                return False
+    except (OSError, ValueError):
+        pass
+    outdir = os.path.dirname(path)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, "w") as fp:
+        fp.write(text)
+    os.replace(tmp, path)
+    return True
+
+
+def output_paths(outputs, outfile):
+    """
+    Given the $$OUTPUT streams of a template expanded into outfile, return a
+    list of (path, text) to write.
+    """
+    outdir = "" if outfile == "-" else os.path.dirname(outfile)
+    return [
+        (output_map.get(name, os.path.join(outdir, name)), stream.getvalue())
+        for name, stream in outputs.items()
+    ]
+
+
+def metered(f):
+    """
+    f, limited to the --max-output-bytes budget if there is one.
+    """
+    if budget is None or budget.output_bytes is None:
+        return f
+    return metered_output(f, budget.output_bytes)
+
+
+def expand_file(cfg, template, outfile, optional=False):
+    """
+    Expand template into outfile ("-" for stdout) using the configuration cfg.
+
+    If optional is set and the template doesn't exist, write a shell script
+    stub that just complains about the missing template instead.
+
+    Each $$OUTPUT(NAME) ... $$ENDOUTPUT(NAME) block is written to the file
+    output_map gives for NAME, or NAME in outfile's directory, after the
+    expansion; those files are only rewritten if their contents changed.
+
+    If the expansion goes over a budget, BudgetExceeded is raised, and the
+    partial output and the files of the $$OUTPUT blocks started so far are
+    removed.
+
+    Returns 0 on success, or 1 if the template couldn't be opened.
+    """
+    global named_outputs
+    if telemetry is not None:
+        import time
+
+        start = time.perf_counter()
+        counts = (telemetry.iterations, telemetry.includes)
+    try:
+        tplFile = myopen(template)
+        if not tplFile:
+            if optional:
+                if written_files is not None:
+                    written_files.add(outfile)
+                with open(rooted(outfile), "w") as fp:
+                    fp.write("#!/bin/sh\n")
+                    fp.write("echo No %s found!\n" % template)
+                return 0
+            print("Unable to open template file:", template)
+            return 1
+    except IOError as e:
+        print(e)
+        return 1
+    lines = tplFile.readlines()
+    if tplFile is not sys.stdin:
+        tplFile.close()
+    named_outputs = {}
+    if written_files is not None:
+        written_files.add(outfile)
+    try:
+        if outfile == "-":
+            expand(cfg, lines, metered(sys.stdout), name=template)
+            sys.stdout.flush()
+        else:
+            with open(rooted(outfile), "w") as fp:
+                expand(cfg, lines, metered(fp), name=template)
+        outputs = named_outputs
+    except BudgetExceeded:
+        # Don't leave half of the output behind, or $$OUTPUT files from an
+        # earlier run that no longer go with it.
+        stale = [path for path, _ in output_paths(named_outputs, outfile)]
+        if outfile != "-":
+            stale.append(outfile)
+        for path in stale:
+            try:
+                os.unlink(rooted(path))
+            except OSError:
+                pass
+        raise
+    finally:
+        named_outputs = None
+    for path, text in output_paths(outputs, outfile):
+        if written_files is not None:
+            written_files.add(path)
+        write_if_changed(path, text)
+    if telemetry is not None:
+        telemetry.output(
+            cfg,
+            template,
+            outfile,
+            time.perf_counter() - start,
+            telemetry.iterations - counts[0],
+            telemetry.includes - counts[1],
+        )
+    return 0
+
+
+def usage():
+    print("Usage: expand.py [ -c CONFIG ] TEMPLATE OUTFILE [ ADDITIONAL_STATEMENTS ]")
+    print("   or: expand.py [ -c CONFIG ] NAME")
+    print(
+        "   or: expand.py [ -c CONFIG ] { -o TEMPLATE OUTFILE | -O TEMPLATE OUTFILE }"
+        " ... [ ADDITIONAL_STATEMENTS ]"
+    )
+    print("")
+    print("  -o TEMPLATE OUTFILE  Expand TEMPLATE into OUTFILE.  May be repeated to")
+    print("                       expand several templates with one config read.")
+    print("  -O TEMPLATE OUTFILE  Like -o, but if TEMPLATE doesn't exist write a stub")
+    print("                       shell script that reports it missing instead.")
+    print("  --loop-cache FILE    Reuse unchanged $$LOOP iterations from FILE, and")
+    print("                       save them there (or set EXPAND_LOOP_CACHE=FILE).")
+    print("  --cache DIR          Copy outputs from a shared cache in DIR when their")
+    print("                       inputs haven't changed, and store new ones there")
+    print("                       (or set EXPAND_CACHE_DIR=DIR; see expand_cache.py).")
+    print("  --max-depth N        Allow $$LOOP/$$IF/$$INCLUDE nesting N levels deep")
+    print("                       (default 10000, or set EXPAND_MAX_DEPTH=N).")
+    print("  --output-map NAME=FILE")
+    print("                       Write $$OUTPUT(NAME) blocks to FILE rather than to")
+    print("                       NAME next to the output.  May be repeated.")
+    print("  --telemetry FILE     Append a JSON line about each output to FILE (or set")
+    print("                       EXPAND_TELEMETRY=FILE; see expand_telemetry.py).")
+    print("  --max-output-bytes N, --max-iterations N, --max-include-depth N,")
+    print("  --max-seconds S      Stop, removing the partial output, when an output")
+    print("                       grows past N bytes, the $$LOOPs run more than N")
+    print("                       iterations in all, $$INCLUDEs nest more than N deep")
+    print("                       or the run takes more than S seconds (or set")
+    print("                       EXPAND_MAX_OUTPUT_BYTES=N and so on).")
+    print("                       These options, --loop-cache, --cache, --telemetry,")
+    print("                       --max-depth and --output-map must come first.")
+    print("  --cache-stats        Report the hit rate and size of the --cache.")
+    print("")
+    print("Query several configs at once:")
+    print("       expand.py -c CONFIG [ -c CONFIG ... ] --get NAME [ NAME ... ]")
+    print("       expand.py -c CONFIG [ -c CONFIG ... ] --dump json")
+    print("Batch expansion of many IOCs at once (see expand_batch.py):")
+    print("       expand.py --batch MANIFEST.json [ --jobs N ]")
+    print("       expand.py --all-cfgs DIR [ --build-top DIR ] [ --jobs N ]")
+    print("Re-expand a children directory whenever its inputs change:")
+    print("       expand.py --watch DIR [ --build-top DIR ] [ --interval SECONDS ]")
+    print("Report the slowest IOCs, templates and releases from --telemetry:")
+    print("       expand.py --report [ TELEMETRY_FILE ] [ --top N ]")
+    print("Report which outputs an edit to a cfg changes (see expand_affected.py):")
+    print("       expand.py --affected OLD.cfg NEW.cfg [ TEMPLATE ... ]")
+    print("Record a run's inputs and outputs in a corpus, and replay the corpus")
+    print("(see expand_capture.py):")
+    print("       expand.py --capture DIR [ usual arguments ]")
+    print("       expand.py --replay DIR [ --repeat N ]")
+
+
+def query(configfiles, av):
+    """
+    Answer --get KEY ... or --dump json for each of the config files.
+
+    --get prints KEY=VALUE for each key (CONFIG:KEY=VALUE if there are several
+    config files), where VALUE is what "expand -c CONFIG KEY" would print.
+    --dump json prints the resolved variables and instances of every config
+    as a JSON object keyed by config file.
+
+    Errors and diagnostics go to stderr, so they don't end up in the middle
+    of the output.
+    """
+    if av[0] == "--get" and len(av) > 1:
+        keys = av[1:]
+    elif av == ["--dump", "json"]:
+        keys = None
+    else:
+        usage()
+        return 1
+    import contextlib
+
+    # Whatever read_config and expand print (a missing $$INCLUDE, say) goes
+    # to stderr along with the errors.
+    diagnostics = contextlib.redirect_stdout(sys.stderr)
+    status = 0
+    dump = {}
+    for configfile in configfiles:
+        cfg = config()
+        try:
+            with diagnostics:
+                cfg.read_config(configfile, [])
+        except IOError as e:
+            sys.stderr.write("%s\n" % e)
+            status = 1
+            continue
+        if keys is None:
+            dump[configfile] = {"variables": cfg.ddict, "instances": cfg.idict}
+            continue
+        prefix = configfile + ":" if len(configfiles) > 1 else ""
+        for key in keys:
+            output = io.StringIO()
+            with diagnostics:
+                expand(cfg, ["$$" + key], output)
+            sys.stdout.write("%s%s=%s\n" % (prefix, key, output.getvalue()))
+    if keys is None:
+        import json
+
+        json.dump(dump, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    return status
+
+
+# The budget options, and the budgets() arguments they set.  Each can also be
+# set in the environment: --max-seconds as EXPAND_MAX_SECONDS, and so on.
+budget_options = {
+    "--max-output-bytes": "output_bytes",
+    "--max-iterations": "iterations",
+    "--max-include-depth": "include_depth",
+    "--max-seconds": "seconds",
+}
 
 
 def main() -> int:
@@ -905,9 +2508,95 @@ def main() -> int:
     else:
         expand_path = xp.split(":") + [".."]
     av = sys.argv[1:]  # Drop expand.py
-    if av[0] == "-c":
-        configfile = av[1]  # -c CONFIG
+    if len(av) > 0 and av[0] in ("--batch", "--all-cfgs"):
+        from expand_batch import batch_main
+
+        return batch_main(av)
+    if len(av) > 0 and av[0] == "--watch":
+        from expand_watch import watch_main
+
+        return watch_main(av)
+    if len(av) > 0 and av[0] == "--report":
+        from expand_telemetry import report_main
+
+        return report_main(av)
+    if len(av) > 0 and av[0] == "--affected":
+        from expand_affected import affected_main
+
+        return affected_main(av)
+    if len(av) > 0 and av[0] == "--replay":
+        from expand_capture import replay_main
+
+        return replay_main(av)
+    capture_dir = os.getenv("EXPAND_CAPTURE")
+    if len(av) >= 2 and av[0] == "--capture":
+        capture_dir = av[1]
+        av = av[2:]
+    elif capture_dir:
+        # Say so, since copies of every file the run reads end up there.
+        sys.stderr.write("expand: capturing to %s (EXPAND_CAPTURE)\n" % capture_dir)
+    if capture_dir:
+        from expand_capture import capture
+
+        return capture(capture_dir, av)
+    global max_depth
+    cache_file = os.getenv("EXPAND_LOOP_CACHE")
+    cache_dir = os.getenv("EXPAND_CACHE_DIR")
+    telemetry_file = os.getenv("EXPAND_TELEMETRY")
+    depth = os.getenv("EXPAND_MAX_DEPTH")
+    limits = {}
+    for option in budget_options:
+        limits[option] = os.getenv("EXPAND_" + option[2:].upper().replace("-", "_"))
+    leading = ("--loop-cache", "--cache", "--telemetry", "--max-depth", "--output-map")
+    while len(av) >= 2 and (av[0] in leading or av[0] in budget_options):
+        if av[0] in budget_options:
+            limits[av[0]] = av[1]
+        elif av[0] == "--loop-cache":
+            cache_file = av[1]
+        elif av[0] == "--cache":
+            cache_dir = av[1]
+        elif av[0] == "--telemetry":
+            telemetry_file = av[1]
+        elif av[0] == "--max-depth":
+            depth = av[1]
+        else:
+            oname, eq, path = av[1].partition("=")
+            if not eq:
+                usage()
+                return 1
+            output_map[oname] = path
+        av = av[2:]
+    global budget
+    try:
+        if depth:
+            max_depth = int(depth)
+        limits = {
+            budget_options[option]: float(v) if option == "--max-seconds" else int(v)
+            for option, v in limits.items()
+            if v
+        }
+    except ValueError:
+        usage()
+        return 1
+    budget = budgets(**limits) if limits else None
+    if av == ["--cache-stats"]:
+        if not cache_dir:
+            usage()
+            return 1
+        from expand_cache import print_stats
+
+        return print_stats(cache_dir)
+    configfiles = []
+    while len(av) >= 2 and av[0] == "-c":
+        configfiles.append(av[1])  # -c CONFIG
         av = av[2:]
+    if len(av) > 0 and av[0] in ("--get", "--dump"):
+        return query(configfiles or ["config"], av)
+    if len(configfiles) > 1:
+        usage()
+        return 1
+    if len(configfiles) > 0:
+        configfile = configfiles[0]
         name = os.path.basename(configfile)
         if name[-4:] == ".cfg":
             name = name[:-4]
@@ -915,41 +2604,68 @@ def main() -> int:
     else:
         configfile = "config"
         extra = "CONFIG="
-    if len(av) == 0 or av[0] == "-h":
-        print(
-            "Usage: expand.py [ -c CONFIG ] TEMPLATE OUTFILE [ ADDITIONAL_STATEMENTS ]"
-        )
-        print("   or: expand.py [ -c CONFIG ] NAME")
+    outputs = []  # (template, outfile, optional) from -o/-O
+    while len(av) >= 3 and av[0] in ("-o", "-O"):
+        if av[0] == "-O" and av[2] == "-":
+            # The stub is a script, which is no use on stdout.
+            print("-O needs an output file, not -")
+            return 1
+        outputs.append((av[1], av[2], av[0] == "-O"))
+        av = av[3:]
+    if (len(av) == 0 and len(outputs) == 0) or (len(av) > 0 and av[0] == "-h"):
+        usage()
         return 1
+    global loop_cache
+    loop_cache = iteration_cache(cache_file) if cache_file else None
+    global telemetry
+    if telemetry_file:
+        from expand_telemetry import recorder
+
+        telemetry = recorder(telemetry_file, configfile)
     try:
+        if len(outputs) == 0 and len(av) > 1 and cache_dir:
+            outputs = [(av[0], av[1], False)]
+            av = av[2:]
+        if len(outputs) > 0 and cache_dir:
+            from expand_cache import output_cache
+
+            return output_cache(cache_dir).expand(configfile, outputs, av)
+        if len(outputs) > 0:
+            # Read the config once, and give each template its own copy of it,
+            # exactly as if expand had been run once per template.
+            cfg = config()
+            cfg.read_config(configfile, av)
+            status = 0
+            for template, outfile, optional in outputs:
+                status |= expand_file(cfg.copy(), template, outfile, optional)
+            return status
         if len(av) == 1:
             cfg = config()
+            if os.getenv("EXPAND_LAZY") != "0":
+                value = cfg.read_value(configfile, av[0])
+                if value is not None:
+                    sys.stdout.write(value + "\n")
+                    return 0
             cfg.read_config(configfile, [])
             lines = ["$$" + av[0] + "\n"]
             expand(cfg, lines, sys.stdout)
             return 0
         cfg = config()
         cfg.read_config(configfile, av[2:])
-        try:
-            tplFile = myopen(av[0])
-            if not tplFile:
-                print("Unable to open template file:", av[0])
-                return 1
-        except IOError as e:
-            print(e)
-            return 1
-        lines = tplFile.readlines()
-        if av[1] == "-":
-            fp = sys.stdout
-        else:
-            fp = open(av[1], "w")
-        expand(cfg, lines, fp)
-        fp.close()
-        return 0
-    except IOError as e:
+        return expand_file(cfg, av[0], av[1])
+    except (IOError, ExpandError) as e:
         print(e)
         return 1
+    finally:
+        if loop_cache is not None:
+            loop_cache.save()
+        if telemetry is not None:
+            telemetry.write()
+            telemetry = None
 
 
 if __name__ == "__main__":
+    # The helper modules (expand_batch.py and friends) "import expand": make
+    # sure that they get this module rather than a second copy of it.
+    sys.modules["expand"] = sys.modules[__name__]
     sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+Change-impact analysis: which outputs would an edit to a cfg change?
+
+    expand --affected OLD.cfg NEW.cfg [ TEMPLATE ... ]
+
+OLD.cfg and NEW.cfg are two versions of the same IOC's config (from git,
+say), and are resolved as if each were the cfg being built in the current
+directory.  With no templates, the outputs are the ones RULES_EXPAND would
+build for NEW.cfg (see expand_batch.rules_expand_jobs).
+
+Each template is specialized against OLD.cfg (see expand_partial.py), which
+records the variable names and instance types it looks up, and its residual
+program.  NEW.cfg is never expanded.  Each output is reported as:
+
+    unchanged - the template doesn't look at anything that differs between
+                the configs, or its residual program gives the same text.
+    changed   - the template's residual program applies to NEW.cfg, and
+                gives different text.  The values that differ in it are
+                listed, as NAME for a variable and TYPE[N].NAME for a
+                parameter of instance N (that is, iteration N of the
+                $$LOOP(TYPE)).
+    unknown   - the edit reaches something the template decides with ($$IF,
+                $$LOOP counts, $$INCLUDE names, ...), so only expanding it
+                again can tell.  The names it looked up that differ are
+                listed.
+
+The exit status is 0 if every output is unchanged, 1 if there was an error
+and 2 otherwise.
+"""
+
+import io
+import os
+
+import expand
+import expand_partial
+from expand_batch import job, read_template, rules_expand_jobs
+
+
+def config_diff(old, new):
+    """
+    Return the variable names and the instance types that differ (or are
+    only in one of) the resolved configs old and new.
+    """
+    names = {
+        k
+        for k in set(old.ddict) | set(new.ddict)
+        if old.ddict.get(k) != new.ddict.get(k)
+    }
+    types = {
+        t
+        for t in set(old.idict) | set(new.idict)
+        if old.idict.get(t) != new.idict.get(t)
+    }
+    return names, types
+
+
+def describe(source):
+    if source[0] == "g":
+        return source[1]
+    return "%s[%d].%s" % source[1:]
+
+
+class outcome:
+    """
+    What an edit does to one output: status is "unchanged", "changed" or
+    "unknown", and details is a list of what differs.
+    """
+
+    def __init__(self, output, status, details=()):
+        self.output = output
+        self.status = status
+        self.details = list(details)
+
+    def __str__(self):
+        s = "%-9s %s" % (self.status, self.output)
+        if self.details:
+            s += ": " + ", ".join(self.details)
+        return s
+
+
+def affected(old, new, j, lines, diff):
+    """
+    Work out what the edit from the resolved config old to new does to the
+    output of job j, whose template is lines (or None, if it can't be read).
+    """
+    if lines is None:
+        if j.optional:
+            return outcome(j.output, "unchanged")  # A stub either way.
+        return outcome(j.output, "unknown", ["no template %s" % j.template])
+    names = set()
+    types = set()
+    output = io.StringIO()
+    expand.named_outputs = {}
+    try:
+        program = expand_partial.specialize(old, lines, output, names, types)
+    except (Exception, SystemExit) as e:
+        return outcome(j.output, "unknown", [str(e) or type(e).__name__])
+    finally:
+        expand.named_outputs = None
+    seen = sorted(names & diff[0]) + sorted(types & diff[1])
+    if not seen:
+        return outcome(j.output, "unchanged")
+    text = program.render(new) if program is not None else None
+    if text is None:
+        return outcome(j.output, "unknown", seen)
+    if text == output.getvalue():
+        return outcome(j.output, "unchanged")
+    holes = []
+    for op in program.ops:
+        if type(op) is not str and op not in holes:
+            if expand_partial.value(old, op) != expand_partial.value(new, op):
+                holes.append(op)
+    return outcome(j.output, "changed", [describe(s) for s in holes])
+
+
+def resolve(cfgfile, statements):
+    cfg = expand.config()
+    cfg.read_config(cfgfile, statements)
+    return cfg
+
+
+def affected_jobs(oldfile, jobs, rules=False):
+    """
+    Return an outcome for each job, with OLD.cfg oldfile in place of each
+    job's cfg.  If rules is true, the jobs are from rules_expand_jobs(), so
+    their templates come from the new cfg's RELEASE.
+    """
+    results = []
+    configs = {}
+    for j in jobs:
+        key = tuple(j.statements)
+        if key not in configs:
+            old = resolve(oldfile, j.statements)
+            new = resolve(j.cfg, j.statements)
+            configs[key] = (old, new, config_diff(old, new))
+        old, new, diff = configs[key]
+        if rules and old.ddict.get("RELEASE") != new.ddict.get("RELEASE"):
+            # The templates themselves are different.
+            results.append(outcome(j.output, "unknown", ["RELEASE"]))
+            continue
+        results.append(affected(old, new, j, read_template(j.template), diff))
+    return results
+
+
+def usage():
+    print("Usage: expand --affected OLD.cfg NEW.cfg [ TEMPLATE ... ]")
+
+
+def affected_main(av):
+    """
+    Entry point for expand --affected.  av is the argument list, starting
+    with the --affected option.
+    """
+    if len(av) < 3 or not os.path.exists(av[1]) or not os.path.exists(av[2]):
+        usage()
+        return 1
+    oldfile, newfile, templates = av[1], av[2], av[3:]
+    try:
+        if templates:
+            jobs = [job(newfile, t, t, []) for t in templates]
+        else:
+            jobs = rules_expand_jobs([newfile])
+        results = affected_jobs(oldfile, jobs, not templates)
+    except (IOError, expand.ExpandError) as e:
+        print(e)
+        return 1
+    for r in results:
+        print(r)
+    counts = [
+        sum(1 for r in results if r.status == status)
+        for status in ("changed", "unknown", "unchanged")
+    ]
+    print("%d changed, %d unknown, %d unchanged" % tuple(counts))
+    return 0 if counts[0] + counts[1] == 0 else 2
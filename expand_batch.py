@@ -0,0 +1,576 @@
+"""
+Batch expansion: render many (config, template, output) jobs in one run.
+
+RULES_EXPAND starts one expand process per IOC, and each of those pays for
+interpreter startup and config resolution on its own.  When a whole hutch
+children directory is rebuilt at once, it is much cheaper to do the work
+here instead:
+
+    expand --batch manifest.json [ --jobs N ]
+    expand --all-cfgs DIR [ --build-top DIR ] [ --jobs N ]
+
+A manifest is a JSON list of jobs (or an object with a "jobs" list), where
+each job is an object with these keys:
+
+    cfg         - the config file.
+    template    - the template file.
+    output      - the file to write.
+    statements  - optional list of ADDITIONAL_STATEMENTS, e.g. "IOCNAME=x".
+    optional    - optional flag: write a stub script if the template is
+                  missing, like expand -O.
+    executable  - optional flag: chmod a+x the output afterwards.
+    release     - optional grouping key, normally the IOC_APPL_TOP.  By
+                  default, templates are grouped by their directory.
+
+--all-cfgs builds the same jobs that RULES_EXPAND would for every *.cfg in
+DIR, from the same directory make would run in.
+
+Jobs that share a config and statements resolve the config once.  Groups
+that share a release are handed to the same worker together, so each worker
+reads each template once per release.  Groups are spread over --jobs worker
+processes (default: one per CPU).  When run from a make -jN recipe, workers
+also take job slots from make's jobserver (see expand_jobserver.py), so that
+the build as a whole runs at most N jobs.  Under a make that runs one job at
+a time (no -j, or -j1), there is only one worker.  With more than one worker, the
+parent reads every template and the files they include into a store shared
+by all of the workers (see expand_store.py), unless --no-store is given.
+
+A summary of each job's time and any failures is printed at the end, along
+with how long it took until the first output was written and the peak
+memory use of the workers.  The exit status is nonzero if any job failed.
+"""
+
+import io
+import json
+import os
+import resource
+import sys
+import time
+
+import expand
+import expand_io
+
+# The file names RULES_EXPAND expects in $(IOC_APPL_TOP)/iocBoot/templates
+RULES_TEMPLATES = ["Makefile", "st.cmd", "ioc.sub-arch", "ioc.sub-req"]
+RULES_OPTIONAL_TEMPLATES = [
+    "edm-ioc.cmd",
+    "pydm-ioc.cmd",
+    "launchgui-ioc.cmd",
+    "syncts-ioc.cmd",
+]
+RULES_EXECUTABLES = ["st.cmd"] + RULES_OPTIONAL_TEMPLATES
+
+
+class job:
+    """
+    One template to expand into one output using one config.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        template,
+        output,
+        statements=(),
+        optional=False,
+        executable=False,
+        release=None,
+    ):
+        self.cfg = cfg
+        self.template = template
+        self.output = output
+        self.statements = list(statements)
+        self.optional = optional
+        self.executable = executable
+        if release is None:
+            release = os.path.dirname(template)
+        self.release = release
+
+    @classmethod
+    def from_dict(cls, d):
+        try:
+            return cls(
+                d["cfg"],
+                d["template"],
+                d["output"],
+                d.get("statements", ()),
+                d.get("optional", False),
+                d.get("executable", False),
+                d.get("release"),
+            )
+        except (KeyError, TypeError):
+            raise ValueError("Malformed batch job: %r" % (d,)) from None
+
+
+def read_manifest(filename):
+    with open(filename) as fp:
+        data = json.load(fp)
+    if isinstance(data, dict):
+        data = data.get("jobs", [])
+    return [job.from_dict(d) for d in data]
+
+
+def expand_output_name(template, iocname):
+    """
+    The output file name RULES_EXPAND uses for template: ioc.X becomes
+    IOCNAME.X and X-ioc.cmd becomes X-IOCNAME.cmd.
+    """
+    if template.startswith("ioc."):
+        return iocname + template[3:]
+    if template.endswith("-ioc.cmd"):
+        return template[: -len("ioc.cmd")] + iocname + ".cmd"
+    return template
+
+
+def rules_expand_jobs(cfgs, build_top="build"):
+    """
+    Make the list of jobs that RULES_EXPAND would run for the cfg files.
+
+    This has to be called from the directory make would run in (the one
+    holding the cfgs), since that is what $$PATH and $$DIRNAME refer to.
+    """
+    build_top_abs = os.path.abspath(build_top)
+    jobs = []
+    for cfgfile in cfgs:
+        iocname = os.path.basename(cfgfile)
+        if iocname.endswith(".cfg"):
+            iocname = iocname[:-4]
+        # What $(shell expand -c CFG RELEASE) gives RULES_EXPAND.
+        cfg = expand.config()
+        ioc_appl_top = cfg.read_value(cfgfile, "RELEASE")
+        if ioc_appl_top is None:
+            cfg.read_config(cfgfile, [])
+            ioc_appl_top = cfg.ddict.get("RELEASE", "")
+        template_dir = ioc_appl_top + "/iocBoot/templates"
+        output_dir = os.path.join(build_top, "iocBoot", iocname)
+        statements = [
+            "IOCNAME=" + iocname,
+            "TOP=" + build_top_abs,
+            "IOCTOP=" + ioc_appl_top,
+        ]
+        try:
+            scripts = sorted(
+                fn for fn in os.listdir(template_dir) if fn.endswith(".sh")
+            )
+        except OSError:
+            scripts = []
+        for template in RULES_TEMPLATES + scripts + RULES_OPTIONAL_TEMPLATES:
+            jobs.append(
+                job(
+                    cfgfile,
+                    template_dir + "/" + template,
+                    os.path.join(output_dir, expand_output_name(template, iocname)),
+                    statements,
+                    optional=template in RULES_OPTIONAL_TEMPLATES,
+                    executable=template in RULES_EXECUTABLES,
+                    release=ioc_appl_top,
+                )
+            )
+    return jobs
+
+
+def group_jobs(jobs):
+    """
+    Group the jobs by (cfg, statements), since they share a resolved config,
+    and then group those by release, since they share templates.
+
+    Returns a list of lists of (cfg, statements, [jobs]) groups, one list per
+    release, in the order they first appear.
+    """
+    by_config = {}
+    for j in jobs:
+        key = (j.cfg, tuple(j.statements))
+        if key not in by_config:
+            by_config[key] = (j.cfg, j.statements, [])
+        by_config[key][2].append(j)
+    by_release = {}
+    for group in by_config.values():
+        by_release.setdefault(group[2][0].release, []).append(group)
+    return list(by_release.values())
+
+
+def make_units(releases, nworkers):
+    """
+    Split the per-release lists of groups into work units, keeping groups
+    that share a release together as much as possible while still making
+    enough units to keep nworkers busy.
+    """
+    ngroups = sum(len(groups) for groups in releases)
+    size = max(1, ngroups // max(1, nworkers))
+    units = []
+    for groups in releases:
+        for i in range(0, len(groups), size):
+            units.append(groups[i : i + size])
+    return units
+
+
+# Template lines by file name, with the (mtime, size) of the file they were
+# read from, kept for the life of a worker process.  A template that changes
+# between batches (in expand --watch, say) is read again.
+template_cache = {}
+
+
+def read_template(template):
+    if expand.include_store is not None:
+        found = expand.include_store.get(template)
+        if found is not None:
+            return found[0]
+    fp = expand.myopen(template)
+    if not fp:
+        return None
+    try:
+        st = os.fstat(fp.fileno())
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = template_cache.get(template)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        lines = fp.readlines()
+    finally:
+        fp.close()
+    template_cache[template] = (stamp, lines)
+    return lines
+
+
+def expand_copy(cfg, lines, f):
+    expand.expand(cfg.copy(), lines, f)
+
+
+def render_job(cfg, j, lines, expander=expand_copy):
+    """
+    Expand the template lines for job j with a copy of cfg, where lines is
+    None if the template couldn't be read.  Returns the output text, and a
+    list of (path, text) for the template's $$OUTPUT blocks, which go next
+    to the output.
+
+    expander(cfg, lines, f) does the expansion, leaving cfg as it was.
+    """
+    if lines is None and not j.optional:
+        raise IOError("Unable to open template file: %s" % j.template)
+    if lines is None:
+        return "#!/bin/sh\necho No %s found!\n" % j.template, []
+    output = io.StringIO()
+    expand.named_outputs = {}
+    try:
+        expander(cfg, lines, output)
+        outputs = expand.named_outputs
+    finally:
+        expand.named_outputs = None
+    return output.getvalue(), expand.output_paths(outputs, j.output)
+
+
+def write_job(cfg, j, lines, expander=expand_copy):
+    text, outputs = render_job(cfg, j, lines, expander)
+    fs = expand_io.local_fs()
+    fs.write(j.output, text, j.executable)
+    for path, text in outputs:
+        fs.write(path, text, if_changed=True)
+
+
+def run_unit(unit, fs=None):
+    """
+    Run one work unit: a list of (cfg, statements, jobs) groups.
+
+    Unless this process already has a store of templates, the unit's
+    templates are read ahead while the configs are resolved, and the outputs
+    are written behind while the next job is expanded (see expand_io.py).
+
+    Returns a list of result dicts, one per job.  Besides the job's own
+    results, each records when its output was written, the worker's process
+    ID and the worker's peak resident set size so far (in kilobytes).
+    """
+    fetch = None
+    if expand.include_store is None:
+        templates = {j.template for _, _, jobs in unit for j in jobs}
+        fetch = expand_io.prefetcher(sorted(templates), fs)
+        expand.include_store = fetch
+    out = expand_io.writer(fs)
+    try:
+        results = run_groups(unit, out)
+    finally:
+        errors = out.close()
+        if fetch is not None:
+            expand.include_store = None
+            fetch.close()
+    for n, r in enumerate(results):
+        if n in errors and r["error"] is None:
+            r["error"] = errors[n]
+        r["finished"] = out.written.get(n, r["finished"])
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for r in results:
+        r["maxrss_kb"] = maxrss
+    return results
+
+
+def run_groups(unit, out):
+    results = []
+    for cfgfile, statements, jobs in unit:
+        start = time.perf_counter()
+        error = None
+        try:
+            cfg = expand.config()
+            cfg.read_config(cfgfile, statements)
+        except (Exception, SystemExit) as e:
+            error = "Config %s: %s" % (cfgfile, e)
+        config_time = time.perf_counter() - start
+        for j in jobs:
+            start = time.perf_counter()
+            if error is None:
+                try:
+                    text, outputs = render_job(cfg, j, read_template(j.template))
+                    out.put(len(results), j.output, text, j.executable)
+                    for path, text in outputs:
+                        out.put(len(results), path, text, if_changed=True)
+                    status = None
+                except (Exception, SystemExit) as e:
+                    status = str(e) or type(e).__name__
+            else:
+                status = error
+            results.append(
+                {
+                    "cfg": j.cfg,
+                    "template": j.template,
+                    "output": j.output,
+                    "config_time": config_time,
+                    "time": time.perf_counter() - start,
+                    "error": status,
+                    "finished": time.time(),
+                    "pid": os.getpid(),
+                }
+            )
+        sys.stdout.flush()
+    return results
+
+
+def init_worker(path, store=None):
+    expand.expand_path = path
+    if store is not None:
+        import expand_store
+
+        expand_store.attach(store)
+
+
+def schedule(pool, run, units, nworkers, js):
+    """
+    Run each unit on pool, at most nworkers at a time.  One unit at a time
+    runs in our own implicit job slot, and each of the others holds a token
+    from the jobserver js while it runs.  Returns the results of the units,
+    in order.
+
+    Waiting for a token and for a unit to finish is one select() on the
+    jobserver and a pipe that each unit writes a byte to when it is done.
+    """
+    import select
+    import threading
+
+    results = [None] * len(units)
+    pending = list(range(len(units) - 1, -1, -1))
+    running = {}  # future -> (unit index, token or None)
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    lock = threading.Lock()  # Keeps finished() from writing to a closed pipe.
+    wakeable = [True]
+
+    def finished(future):
+        with lock:
+            if wakeable[0]:
+                os.write(wake_w, b".")
+
+    def start(token):
+        i = pending.pop()
+        future = pool.submit(run, units[i])
+        running[future] = (i, token)
+        future.add_done_callback(finished)
+
+    try:
+        while pending or running:
+            wanted = [wake_r]
+            if pending and len(running) < nworkers:
+                if all(t is not None for _, t in running.values()):
+                    # Our own (implicit) slot is free, so no token is needed.
+                    start(None)
+                    continue
+                if not js.eof:
+                    wanted.append(js.rfd)
+            ready = select.select(wanted, [], [])[0]
+            if js.rfd in ready:
+                token = js.acquire(0)
+                if token is not None:
+                    start(token)
+            if wake_r in ready:
+                try:
+                    while os.read(wake_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                for f in [f for f in running if f.done()]:
+                    i, token = running.pop(f)
+                    if token is not None:
+                        js.release(token)
+                    results[i] = f.result()
+    finally:
+        with lock:
+            wakeable[0] = False
+        os.close(wake_r)
+        os.close(wake_w)
+    return results
+
+
+def run_jobs(jobs, nworkers, share=True, fs=None, js=None):
+    """
+    Run all of the jobs on nworkers processes, returning the per-job results.
+    If share is true and there is more than one worker, the templates and
+    their includes are read once, into a store the workers share.  fs is the
+    expand_io file system to read templates and write outputs through.  js
+    is a jobserver client (see expand_jobserver.py): if given, a worker only
+    starts on something while it has a job slot from make.
+
+    Each result's "since_start" is the time from the start of this call until
+    the job's output was written.
+    """
+    started = time.time()
+    units = make_units(group_jobs(jobs), nworkers)
+    if nworkers <= 1 or len(units) <= 1:
+        results = []
+        for unit in units:
+            results.extend(run_unit(unit, fs))
+    else:
+        import functools
+        import tempfile
+        from concurrent.futures import ProcessPoolExecutor
+
+        with tempfile.TemporaryDirectory(prefix="expand-batch-") as tmp:
+            store = None
+            if share:
+                import expand_store
+
+                store = os.path.join(tmp, "templates.store")
+                fetch = expand_io.prefetcher(sorted({j.template for j in jobs}), fs)
+                try:
+                    expand_store.write_store(store, fetch.files())
+                finally:
+                    fetch.close()
+            # Don't let the workers inherit unflushed output.
+            sys.stdout.flush()
+            with ProcessPoolExecutor(
+                max_workers=nworkers,
+                initializer=init_worker,
+                initargs=(expand.expand_path, store),
+            ) as pool:
+                results = []
+                run = functools.partial(run_unit, fs=fs)
+                if js is not None:
+                    per_unit = schedule(pool, run, units, nworkers, js)
+                else:
+                    per_unit = pool.map(run, units)
+                for unit_results in per_unit:
+                    results.extend(unit_results)
+    for r in results:
+        r["since_start"] = r.pop("finished") - started
+    return results
+
+
+def print_summary(results, elapsed, f=None):
+    if f is None:
+        f = sys.stdout
+    failed = [r for r in results if r["error"] is not None]
+    for r in results:
+        f.write(
+            "%-6s %8.1f ms  %s\n"
+            % ("FAILED" if r["error"] else "ok", 1000 * r["time"], r["output"])
+        )
+    for r in failed:
+        f.write("Failed to expand %s: %s\n" % (r["output"], r["error"]))
+    if results:
+        maxrss = {}
+        for r in results:
+            maxrss[r["pid"]] = max(maxrss.get(r["pid"], 0), r["maxrss_kb"])
+        f.write(
+            "first output after %.2f s, peak RSS per worker %.1f MB on average, "
+            "%.1f MB at most (%d workers)\n"
+            % (
+                min(r["since_start"] for r in results),
+                sum(maxrss.values()) / len(maxrss) / 1024,
+                max(maxrss.values()) / 1024,
+                len(maxrss),
+            )
+        )
+    f.write(
+        "%d jobs, %d failed, %.2f s elapsed\n" % (len(results), len(failed), elapsed)
+    )
+
+
+def usage():
+    print("Usage: expand --batch MANIFEST.json [ OPTIONS ]")
+    print("   or: expand --all-cfgs DIR [ OPTIONS ]")
+    print("")
+    print("  --jobs N            Number of worker processes (default: CPU count).")
+    print("                      Under make -jN, workers also take make's job slots.")
+    print("  --build-top DIR     Build directory for --all-cfgs (default: build).")
+    print("  --summary FILE      Also write the per-job results to FILE as JSON.")
+    print("  --no-store          Have each worker read the templates itself.")
+
+
+def batch_main(av):
+    """
+    Entry point for expand --batch and expand --all-cfgs.  av is the argument
+    list, starting with the --batch or --all-cfgs option.
+    """
+    manifest = None
+    cfgdir = None
+    build_top = "build"
+    nworkers = os.cpu_count() or 1
+    summary = None
+    share = True
+    try:
+        while len(av) > 0:
+            if av[0] == "--no-store":
+                share = False
+                av = av[1:]
+                continue
+            if av[0] == "--batch":
+                manifest = av[1]
+            elif av[0] == "--all-cfgs":
+                cfgdir = av[1]
+            elif av[0] == "--build-top":
+                build_top = av[1]
+            elif av[0] == "--jobs":
+                nworkers = int(av[1])
+            elif av[0] == "--summary":
+                summary = av[1]
+            else:
+                usage()
+                return 1
+            av = av[2:]
+    except (IndexError, ValueError):
+        usage()
+        return 1
+    if (manifest is None) == (cfgdir is None):
+        usage()
+        return 1
+
+    start = time.perf_counter()
+    try:
+        if manifest is not None:
+            jobs = read_manifest(manifest)
+        else:
+            os.chdir(cfgdir)
+            cfgs = sorted(fn for fn in os.listdir(".") if fn.endswith(".cfg"))
+            jobs = rules_expand_jobs(cfgs, build_top)
+    except (IOError, ValueError) as e:
+        print(e)
+        return 1
+    import expand_jobserver
+
+    js = expand_jobserver.connect()
+    if js is False or (js is None and expand_jobserver.serial_make()):
+        nworkers, js = 1, None
+    try:
+        results = run_jobs(jobs, nworkers, share, js=js)
+    finally:
+        if js is not None:
+            js.close()
+    print_summary(results, time.perf_counter() - start)
+    if summary is not None:
+        with open(summary, "w") as fp:
+            json.dump(results, fp, indent=1)
+    return 1 if any(r["error"] is not None for r in results) else 0
@@ -0,0 +1,396 @@
+"""
+A content-addressed cache of expanded outputs, in the style of ccache, that
+can be shared by everyone building the same IOCs (expand --cache DIR, or
+EXPAND_CACHE_DIR=DIR, pointing at a group directory).
+
+The key of an output is a hash of what expand is given on its command line,
+without reading the config: the contents of the template and of the cfg,
+the additional statements, expand_path, the maximum depth and the engine
+itself (the source of expand.py).  That key names a manifest, which lists
+the outputs that have been stored for it.  Each entry records every other
+file that was read to produce that output (files the cfg $$INCLUDEs, and
+files the template $$INCLUDEs) with a hash of its contents, every name
+myopen() tried and couldn't open on its way to them (an $$INCLUDE(inc.txt)
+found as ../inc.txt tried inc.txt first), and the hash of the output.  An
+entry applies if all of those files still hash the same and none of the
+names it missed can be opened now; the output is then copied from the
+cache, without resolving the config or expanding anything.  Otherwise the
+output is expanded as usual, and stored along with a new entry for the
+manifest.
+
+The config variables PATH and DIRNAME come from the current directory.  If
+any of the files an output was made from mention PATH or DIRNAME, its entry
+also records the current directory, and only applies there (as does the key,
+if the statements mention them); other outputs are shared between checkouts.
+
+Nothing is stored for an output whose expansion printed anything (an
+$$INCLUDE that couldn't be opened, say), whose template or includes have
+$$OUTPUT blocks, or that was written to stdout or read its cfg or template
+from stdin.
+
+The directory has sixteen subdirectories, 0 through f, each holding the
+manifests (KEY.manifest) and outputs (HASH.out) whose names start with that
+digit.  Every file is written to a temporary file in the same directory and
+renamed into place, so readers never see a partial file, and concurrent
+writers at worst replace each other's manifest entries.  Hits touch the
+files they use.  After something is stored, if its subdirectory holds more
+than a sixteenth of the size limit (EXPAND_CACHE_SIZE, default 1G), the
+files used least recently are removed until it is down to 90% of that.
+
+Hits and misses are appended to DIR/stats, one byte each, which is what
+expand --cache-stats reports.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+
+import expand
+
+VERSION = 2
+
+# How many entries a manifest keeps, most recently stored first.
+max_entries = 16
+
+default_size = 1024**3
+
+cwd_names = re.compile(rb"PATH|DIRNAME")
+
+
+def parse_size(s):
+    """
+    Parse a size such as 500000, 200M or 2G into a number of bytes.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    s = s.strip().upper()
+    scale = units.get(s[-1:], 1)
+    if scale != 1:
+        s = s[:-1]
+    return int(float(s) * scale)
+
+
+def read_bytes(name):
+    """
+    Open name as expand would, returning its contents, or None.
+    """
+    if name == "-":
+        return None
+    fp = expand.myopen(name)
+    if not fp:
+        return None
+    try:
+        with fp:
+            return fp.buffer.read()
+    except (OSError, ValueError):
+        return None
+
+
+def file_hash(path):
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def can_open(path):
+    try:
+        with open(path, "rb"):
+            return True
+    except OSError:
+        return False
+
+
+def engine_source():
+    try:
+        with open(expand.__file__, "rb") as fp:
+            return fp.read()
+    except OSError:
+        # Running from expand.pyz: read it out of the zipapp.
+        return expand.__loader__.get_data(expand.__file__)
+
+
+class counting_stdout:
+    """
+    Passes writes on to f, counting the characters written.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, s):
+        self.count += len(s)
+        return self.f.write(s)
+
+    def flush(self):
+        self.f.flush()
+
+
+class output_cache:
+    def __init__(self, directory, size=None):
+        self.dir = directory
+        if size is None:
+            size = os.getenv("EXPAND_CACHE_SIZE")
+            size = parse_size(size) if size else default_size
+        self.size = size
+        self.engine = hashlib.sha256(engine_source()).hexdigest()
+        self.hashes = {}  # path -> hash, for this run
+
+    def path(self, name):
+        return os.path.join(self.dir, name[0], name)
+
+    def hash(self, path):
+        try:
+            return self.hashes[path]
+        except KeyError:
+            h = self.hashes[path] = file_hash(path)
+            return h
+
+    def key(self, configfile, template, statements):
+        """
+        Return the manifest key for expanding template with the config in
+        configfile and the statements, or None if it can't be cached.
+        """
+        cfg = read_bytes(configfile)
+        tpl = read_bytes(template)
+        if cfg is None or tpl is None:
+            return None
+        h = hashlib.sha256()
+        parts = [VERSION, self.engine, expand.expand_path, expand.max_depth]
+        parts += statements
+        if cwd_names.search("\n".join(statements).encode("utf-8", "surrogateescape")):
+            parts.append(os.getcwd())
+        h.update(repr(parts).encode("utf-8", "surrogateescape"))
+        h.update(b"\0%d\0" % len(cfg))
+        h.update(cfg)
+        h.update(b"\0%d\0" % len(tpl))
+        h.update(tpl)
+        return h.hexdigest()
+
+    def read_manifest(self, key):
+        try:
+            with open(self.path(key + ".manifest")) as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return []
+        if not isinstance(manifest, dict) or manifest.get("version") != VERSION:
+            return []
+        return manifest["entries"]
+
+    def write_atomically(self, path, data):
+        d = os.path.dirname(path)
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.chmod(tmp, 0o664)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+
+    def count(self, event):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            fd = os.open(
+                os.path.join(self.dir, "stats"),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o664,
+            )
+        except OSError:
+            return
+        try:
+            os.write(fd, event)
+        finally:
+            os.close(fd)
+
+    def fetch(self, key, outfile):
+        """
+        Write outfile from the cache if an entry of key's manifest applies,
+        returning True if it did.
+        """
+        cwd = os.getcwd()
+        for entry in self.read_manifest(key):
+            if entry["cwd"] is not None and entry["cwd"] != cwd:
+                continue
+            if any(self.hash(p) != h for p, h in entry["files"].items()):
+                continue
+            if any(can_open(p) for p in entry["missed"]):
+                continue  # A file earlier in the search path has turned up.
+            result = self.path(entry["output"] + ".out")
+            try:
+                with open(result, "rb") as fp:
+                    data = fp.read()
+            except OSError:
+                continue  # Evicted.
+            with open(outfile, "wb") as fp:
+                fp.write(data)
+            with contextlib.suppress(OSError):
+                os.utime(result)
+                os.utime(self.path(key + ".manifest"))
+            return True
+        return False
+
+    def store(self, key, files, missed, outfile):
+        """
+        Store outfile, made from files, under key.  missed holds the names
+        that were looked for along the way, but couldn't be opened.
+        """
+        hashes = {}
+        uses_cwd = False
+        for path in sorted(files):
+            try:
+                with open(path, "rb") as fp:
+                    data = fp.read()
+            except OSError:
+                return
+            if b"$$OUTPUT(" in data:
+                return
+            uses_cwd = uses_cwd or cwd_names.search(data) is not None
+            hashes[path] = hashlib.sha256(data).hexdigest()
+        with open(outfile, "rb") as fp:
+            data = fp.read()
+        output = hashlib.sha256(data).hexdigest()
+        result = self.path(output + ".out")
+        if not os.path.exists(result):
+            self.write_atomically(result, data)
+        entry = {
+            "cwd": os.getcwd() if uses_cwd else None,
+            "files": hashes,
+            "missed": sorted(missed),
+            "output": output,
+        }
+        entries = [e for e in self.read_manifest(key) if e != entry]
+        manifest = {"version": VERSION, "entries": [entry] + entries}
+        manifest["entries"] = manifest["entries"][:max_entries]
+        self.write_atomically(
+            self.path(key + ".manifest"), json.dumps(manifest).encode("utf-8")
+        )
+        self.clean(output[0])
+
+    def clean(self, subdir):
+        """
+        Remove the least recently used files in subdir if it holds more than
+        its share of the size limit.
+        """
+        d = os.path.join(self.dir, subdir)
+        files = []
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.name.startswith(".tmp"):
+                        continue
+                    st = e.stat()
+                    files.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            return
+        share = self.size / 16
+        total = sum(f[1] for f in files)
+        if total <= share:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= share * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total -= size
+
+    def stats(self):
+        """
+        Return a dictionary of hits, misses, files and bytes.
+        """
+        try:
+            with open(os.path.join(self.dir, "stats"), "rb") as fp:
+                events = fp.read()
+        except OSError:
+            events = b""
+        files = 0
+        size = 0
+        for subdir in "0123456789abcdef":
+            try:
+                with os.scandir(os.path.join(self.dir, subdir)) as it:
+                    for e in it:
+                        files += 1
+                        size += e.stat().st_size
+            except OSError:
+                pass
+        return {
+            "hits": events.count(b"h"),
+            "misses": events.count(b"m"),
+            "files": files,
+            "bytes": size,
+        }
+
+    def expand(self, configfile, outputs, statements):
+        """
+        Expand each (template, outfile, optional) in outputs, as expand
+        -c configfile -o template outfile ... statements would, taking what
+        it can from the cache and storing the rest.
+        """
+        todo = []
+        for template, outfile, optional in outputs:
+            key = None
+            if outfile != "-":
+                key = self.key(configfile, template, statements)
+            if key is not None and self.fetch(key, outfile):
+                self.count(b"h")
+                if expand.telemetry is not None:
+                    expand.telemetry.cached(template, outfile)
+                continue
+            if key is not None:
+                self.count(b"m")
+            todo.append((template, outfile, optional, key))
+        if not todo:
+            return 0
+        printed = counting_stdout(sys.stdout)
+        old = (expand.opened_files, expand.missed_files)
+        expand.opened_files = set()
+        expand.missed_files = set()
+        try:
+            with contextlib.redirect_stdout(printed):
+                cfg = expand.config()
+                cfg.read_config(configfile, statements)
+                config_files = expand.opened_files
+                config_missed = expand.missed_files
+                status = 0
+                for template, outfile, optional, key in todo:
+                    expand.opened_files = set(config_files)
+                    expand.missed_files = set(config_missed)
+                    result = expand.expand_file(cfg.copy(), template, outfile, optional)
+                    status |= result
+                    if key is None or result != 0 or printed.count != 0:
+                        continue
+                    try:
+                        self.store(
+                            key, expand.opened_files, expand.missed_files, outfile
+                        )
+                    except OSError as e:
+                        sys.stderr.write("Cannot cache %s: %s\n" % (outfile, e))
+            return status
+        finally:
+            expand.opened_files, expand.missed_files = old
+
+
+def print_stats(directory):
+    cache = output_cache(directory)
+    s = cache.stats()
+    lookups = s["hits"] + s["misses"]
+    rate = 100.0 * s["hits"] / lookups if lookups else 0.0
+    print("cache directory  %s" % directory)
+    print("hits             %d" % s["hits"])
+    print("misses           %d" % s["misses"])
+    print("hit rate         %.1f%%" % rate)
+    print("files            %d" % s["files"])
+    print(
+        "size             %.1f MB of %.1f MB"
+        % (s["bytes"] / 1024.0**2, cache.size / 1024.0**2)
+    )
+    return 0
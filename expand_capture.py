@@ -0,0 +1,285 @@
+"""
+Capture bundles: record real expand runs, and replay them anywhere.
+
+    expand --capture DIR [ usual arguments ]    (or EXPAND_CAPTURE=DIR)
+    expand --replay DIR [ --repeat N ]
+
+A run's results depend on much more than its config and template: the
+release trees its templates and $$INCLUDEs come from, EXPAND_PATH, the
+current directory ($$PATH and $$DIRNAME) and the statements make adds to
+the command line.  --capture runs expand as usual, and adds a capture of
+the run to the corpus in DIR (with EXPAND_CAPTURE, it says so on stderr):
+
+    DIR/captures/KEY.json   - the arguments, the current directory, the
+                              EXPAND_* environment variables, the absolute
+                              path and hash of every file myopen() read
+                              (configs, templates, includes), the hash of
+                              every output and of what was printed, the
+                              exit status and how long it took.  KEY is a
+                              hash of the arguments, directory and
+                              environment, so capturing the same run again
+                              replaces it.
+    DIR/files/HASH          - the contents of the files, by SHA-256.
+
+--replay rebuilds each capture's files in a new temporary directory, at
+their absolute paths under it, and runs it again from there as many times
+as --repeat says (default 1), with expand.file_root set so that the run
+sees the same paths and current directory as it did when it was captured.
+Files that weren't captured don't exist, as far as the run can tell.  For
+each capture, it prints whether the outputs, printed text and exit status
+all matched, the captured time and the fastest and median replay times.
+The exit status is nonzero if anything didn't match.
+
+Only the single-config forms of expand are captured (TEMPLATE OUTFILE, -o,
+NAME and --get/--dump), not --batch or --watch, and not outputs copied from
+a --cache, since those don't read their inputs.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import expand
+
+
+class hashing_output:
+    """
+    A text stream that hashes what is written to it, and passes it on to f
+    (if f isn't None).
+    """
+
+    def __init__(self, f=None):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, s):
+        self.hash.update(s.encode("utf-8", "surrogateescape"))
+        if self.f is not None:
+            return self.f.write(s)
+        return len(s)
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+
+def file_hash(path):
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def write_file(path, data):
+    """
+    Write data to path by renaming a temporary file into place, so parallel
+    captures into one corpus never see half of a file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+def environment():
+    return {
+        k: v
+        for k, v in os.environ.items()
+        if k.startswith("EXPAND_") and k != "EXPAND_CAPTURE"
+    }
+
+
+def capture(corpus, av):
+    """
+    Run expand with the arguments av (less --capture DIR), adding a capture
+    of the run to the corpus directory.  Returns the exit status.
+    """
+    saved = (sys.argv, expand.opened_files, expand.written_files)
+    captured = os.environ.pop("EXPAND_CAPTURE", None)
+    expand.opened_files = set()
+    expand.written_files = set()
+    sys.argv = [sys.argv[0]] + av
+    printed = hashing_output(sys.stdout)
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(printed):
+            status = expand.main()
+        seconds = time.perf_counter() - start
+        opened = expand.opened_files
+        written = expand.written_files
+    finally:
+        sys.argv, expand.opened_files, expand.written_files = saved
+        if captured is not None:
+            os.environ["EXPAND_CAPTURE"] = captured
+
+    cwd = os.getcwd()
+    env = environment()
+    files = {}
+    try:
+        for name in sorted(opened):
+            with open(name, "rb") as fp:
+                data = fp.read()
+            h = hashlib.sha256(data).hexdigest()
+            files[os.path.abspath(name)] = h
+            if not os.path.exists(os.path.join(corpus, "files", h)):
+                write_file(os.path.join(corpus, "files", h), data)
+        manifest = {
+            "argv": av,
+            "cwd": cwd,
+            "env": env,
+            "files": files,
+            "outputs": {
+                os.path.abspath(name): file_hash(name)
+                for name in sorted(written)
+                if name != "-"
+            },
+            "stdout": printed.hash.hexdigest(),
+            "status": status,
+            "seconds": seconds,
+            "time": time.time(),
+        }
+        key = hashlib.sha256(
+            json.dumps([av, cwd, env], sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        data = json.dumps(manifest, indent=1, sort_keys=True) + "\n"
+        write_file(os.path.join(corpus, "captures", key + ".json"), data.encode())
+    except OSError as e:
+        sys.stderr.write("Cannot capture to %s: %s\n" % (corpus, e))
+    return status
+
+
+@contextlib.contextmanager
+def replaying(root, manifest):
+    """
+    Run the block as the captured run, with its files under root.
+    """
+    saved = (sys.argv, os.getcwd(), expand.file_root, dict(os.environ))
+    for k in list(os.environ):
+        if k.startswith("EXPAND_"):
+            del os.environ[k]
+    os.environ.update(manifest["env"])
+    sys.argv = ["expand"] + manifest["argv"]
+    expand.file_root = root
+    os.chdir(root + manifest["cwd"])
+    try:
+        yield
+    finally:
+        sys.argv, cwd, expand.file_root, env = saved
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+
+
+def replay(corpus, manifest, repeat=1):
+    """
+    Replay a capture repeat times.  Returns the list of run times and a
+    list of what didn't match the capture.
+    """
+    # The real path, since the run compares it with os.getcwd().
+    root = os.path.realpath(tempfile.mkdtemp(prefix="expand-replay-"))
+    problems = []
+    times = []
+    try:
+        for path, h in manifest["files"].items():
+            os.makedirs(os.path.dirname(root + path), exist_ok=True)
+            shutil.copyfile(os.path.join(corpus, "files", h), root + path)
+        os.makedirs(root + manifest["cwd"], exist_ok=True)
+        for path in manifest["outputs"]:
+            os.makedirs(os.path.dirname(root + path), exist_ok=True)
+        with replaying(root, manifest):
+            for n in range(repeat):
+                expand.base_configs.clear()  # As in a new process.
+                printed = hashing_output()
+                start = time.perf_counter()
+                try:
+                    with contextlib.redirect_stdout(printed):
+                        status = expand.main()
+                except SystemExit as e:
+                    status = e.code
+                times.append(time.perf_counter() - start)
+                if n > 0:
+                    continue
+                if status != manifest["status"]:
+                    problems.append("exit status %s" % status)
+                if printed.hash.hexdigest() != manifest["stdout"]:
+                    problems.append("printed text")
+                for path, h in sorted(manifest["outputs"].items()):
+                    if file_hash(root + path) != h:
+                        problems.append(path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return times, problems
+
+
+def read_corpus(corpus):
+    """
+    Return the captures in the corpus directory, as (name, manifest).
+    """
+    captures = []
+    directory = os.path.join(corpus, "captures")
+    for fn in sorted(os.listdir(directory)):
+        if fn.endswith(".json"):
+            with open(os.path.join(directory, fn)) as fp:
+                captures.append((fn[:-5], json.load(fp)))
+    return captures
+
+
+def replay_main(av):
+    """
+    Entry point for expand --replay DIR [--repeat N].
+    """
+    corpus = None
+    repeat = 1
+    av = av[1:]
+    try:
+        while av:
+            if av[0] == "--repeat":
+                repeat = max(1, int(av[1]))
+                av = av[2:]
+            elif corpus is None:
+                corpus = av[0]
+                av = av[1:]
+            else:
+                raise ValueError(av[0])
+    except (IndexError, ValueError):
+        corpus = None
+    if corpus is None:
+        print("Usage: expand --replay CAPTURE_DIR [ --repeat N ]")
+        return 1
+    try:
+        captures = read_corpus(corpus)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 1
+    columns = ("result", "captured ms", "min ms", "p50 ms", "capture")
+    print("%-8s %11s %9s %9s  %s" % columns)
+    failed = 0
+    for name, manifest in captures:
+        try:
+            times, problems = replay(corpus, manifest, repeat)
+        except OSError as e:
+            times, problems = [0.0], [str(e)]
+        times.sort()
+        print(
+            "%-8s %11.1f %9.1f %9.1f  %s %s"
+            % (
+                "MISMATCH" if problems else "ok",
+                1000 * manifest["seconds"],
+                1000 * times[0],
+                1000 * times[len(times) // 2],
+                name,
+                " ".join(manifest["argv"]),
+            )
+        )
+        for problem in problems:
+            print("         differs: %s" % problem)
+        failed += bool(problems)
+    print("%d captures, %d mismatched" % (len(captures), failed))
+    return 1 if failed else 0
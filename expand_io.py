@@ -0,0 +1,213 @@
+"""
+The I/O side of expand --batch: reading templates ahead of time on a thread
+pool, and writing outputs behind on a thread of their own.
+
+On NFS, each open() and read() of a small template, and each write of a
+small output, costs a round trip to the server, and done one after another
+they take longer than the expansions themselves.  So:
+
+    - A prefetcher starts reading every template as soon as the batch
+      starts, on a pool of threads, while the configs are being resolved.
+      Each file it reads is scanned for $$INCLUDEs of literal file names,
+      and those are read too (and so on).  It hands the files to the
+      engine as expand.include_store, so neither the batch nor $$INCLUDE
+      has to wait for a file that has already been read, and anything it
+      hasn't read (an $$INCLUDE whose name comes from a variable, say) is
+      opened as usual.
+
+    - A writer takes each finished output and writes it on a background
+      thread, so the next job can be expanded in the meantime.  At most
+      max_pending bytes of output may be waiting to be written; beyond
+      that, put() waits for the writer to catch up.
+
+All of the file system access goes through an fs object (local_fs here), so
+that tests can substitute one that is slow, or that counts what it does.
+"""
+
+import collections
+import io
+import os
+import re
+import threading
+import time
+
+import expand
+
+literal_include = re.compile(r"\$\$INCLUDE\(([^)$]*)\)")
+
+# The most bytes of output a writer holds before put() waits.
+max_pending = 32 * 1024 * 1024
+
+
+class local_fs:
+    """
+    Plain local (or NFS-mounted) files.
+    """
+
+    def read(self, name):
+        """
+        Read a file as the engine would, returning (text, path, identity),
+        where identity is (st_dev, st_ino), or None if it can't be read.
+        """
+        if name == "-":
+            return None
+        fp = expand.myopen(name)
+        if not fp:
+            return None
+        try:
+            with fp:
+                text = fp.read()
+                st = os.fstat(fp.fileno())
+        except (OSError, ValueError):
+            return None
+        return text, fp.name, (st.st_dev, st.st_ino)
+
+    def write(self, path, text, executable=False, if_changed=False):
+        if if_changed:
+            expand.write_if_changed(path, text)
+            return
+        outdir = os.path.dirname(path)
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        # Write a new file and rename it into place, so nothing ever reads a
+        # half-written output.
+        tmp = "%s.tmp%d" % (path, os.getpid())
+        with open(tmp, "w") as fp:
+            fp.write(text)
+        if executable:
+            mode = os.stat(tmp).st_mode
+            os.chmod(tmp, mode | 0o111)
+        os.replace(tmp, path)
+
+
+class prefetcher:
+    """
+    Read files, and the files they include by literal names, on a pool of
+    threads.  get(name) has the interface of expand.include_store.
+    """
+
+    def __init__(self, names, fs=None, threads=8):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.fs = fs if fs is not None else local_fs()
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.lines = {}
+        for name in names:
+            self.fetch(name)
+
+    def fetch(self, name):
+        with self.lock:
+            if name not in self.futures:
+                self.futures[name] = self.pool.submit(self.read, name)
+
+    def read(self, name):
+        found = self.fs.read(name)
+        if found is not None:
+            for m in literal_include.finditer(found[0]):
+                self.fetch(m.group(1).strip())
+        return found
+
+    def get(self, name):
+        """
+        Return (lines, path, identity) for a file that was asked for, waiting
+        for it if need be, or None if it wasn't asked for or can't be read.
+        """
+        try:
+            return self.lines[name]
+        except KeyError:
+            pass
+        with self.lock:
+            future = self.futures.get(name)
+        if future is None:
+            return None
+        try:
+            found = future.result()
+        except Exception:
+            return None  # Let the engine try for itself.
+        if found is not None:
+            text, path, identity = found
+            found = (io.StringIO(text).readlines(), path, identity)
+        self.lines[name] = found
+        return found
+
+    def files(self):
+        """
+        Wait for everything, returning a dictionary of the files that could
+        be read, as name -> (text, path, identity).
+        """
+        files = {}
+        done = set()
+        while True:
+            with self.lock:
+                todo = [n for n in self.futures if n not in done]
+            if not todo:
+                return files
+            for name in todo:
+                found = self.futures[name].result()
+                if found is not None:
+                    files[name] = found
+                done.add(name)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class writer:
+    """
+    Write outputs on a background thread.
+
+    put() queues an output, waiting first if that would take the bytes
+    queued past max_bytes (unless nothing is queued).  close() waits for
+    everything to be written and returns a dictionary of the keys of the
+    outputs that failed to the error messages; written has the time each of
+    the others was written.
+    """
+
+    def __init__(self, fs=None, max_bytes=None):
+        self.fs = fs if fs is not None else local_fs()
+        self.max_bytes = max_pending if max_bytes is None else max_bytes
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.pending = 0
+        self.peak = 0
+        self.closed = False
+        self.errors = {}
+        self.written = {}  # key -> time.time() when it was written
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, key, path, text, executable=False, if_changed=False):
+        size = len(text)
+        with self.cond:
+            while self.pending > 0 and self.pending + size > self.max_bytes:
+                self.cond.wait()
+            self.pending += size
+            self.peak = max(self.peak, self.pending)
+            self.queue.append((key, path, text, executable, if_changed))
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                key, path, text, executable, if_changed = self.queue.popleft()
+            try:
+                self.fs.write(path, text, executable, if_changed)
+                self.written[key] = time.time()
+            except Exception as e:
+                self.errors[key] = str(e) or type(e).__name__
+            with self.cond:
+                self.pending -= len(text)
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        return self.errors
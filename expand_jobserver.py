@@ -0,0 +1,162 @@
+"""
+A client for GNU make's jobserver, so that expand --batch run from a
+"make -jN" recipe keeps the whole build within N jobs.
+
+make hands out job slots as single-byte tokens through a pipe, or through a
+named pipe with GNU make 4.4 and later, and tells its children where to find
+it in MAKEFLAGS:
+
+    --jobserver-auth=fifo:PATH     a named pipe (make 4.4 and later)
+    --jobserver-auth=R,W           the file descriptors of a pipe (4.2, 4.3)
+    --jobserver-fds=R,W            the same, from make before 4.2
+
+Every process started by make has one implicit slot, which it doesn't have
+to ask for.  For each job beyond that it must read a token first, and write
+exactly that token back when the job is done, even if something fails.  The
+pipe's file descriptors are only passed to recipes that make thinks run
+make themselves (those using $(MAKE), or marked with "+"); if they aren't
+open, we are limited to the implicit slot, as make itself would be.
+
+Tokens are read without blocking, from a descriptor of our own (the fifo
+opened again, or /proc/self/fd/R), so that the batch can notice a finished
+job while it waits for a token, and so that nothing about make's own end of
+the pipe changes.
+"""
+
+import os
+import select
+import stat
+import sys
+
+
+def parse_makeflags(makeflags):
+    """
+    Find the jobserver in MAKEFLAGS, returning ("fifo", PATH), ("pipe", R, W)
+    or None.  The last --jobserver-auth (or --jobserver-fds) option wins.
+    """
+    found = None
+    for word in makeflags.split():
+        for option in ("--jobserver-auth=", "--jobserver-fds="):
+            if word.startswith(option):
+                value = word[len(option) :]
+                if value.startswith("fifo:"):
+                    found = ("fifo", value[5:])
+                else:
+                    r, comma, w = value.partition(",")
+                    try:
+                        found = ("pipe", int(r), int(w))
+                    except ValueError:
+                        found = None
+    return found
+
+
+class client:
+    """
+    Acquire and release job slots from a jobserver.  rfd is read without
+    blocking; only the descriptors in owned are closed by close().  eof is
+    set once rfd has been found closed at the other end, after which there
+    are no more tokens to wait for.
+    """
+
+    def __init__(self, rfd, wfd, owned=()):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.owned = list(owned)
+        self.held = []
+        self.eof = False
+
+    def acquire(self, timeout=None):
+        """
+        Wait up to timeout seconds for a token, returning it, or None.
+        """
+        try:
+            ready = select.select([self.rfd], [], [], timeout)[0]
+        except InterruptedError:
+            return None
+        if not ready:
+            return None
+        try:
+            token = os.read(self.rfd, 1)
+        except (BlockingIOError, InterruptedError):
+            return None  # Another process got there first.
+        if not token:
+            self.eof = True
+            return None
+        self.held.append(token)
+        return token
+
+    def release(self, token):
+        self.held.remove(token)
+        os.write(self.wfd, token)
+
+    def close(self):
+        """
+        Give back anything still held, and close our descriptors.
+        """
+        while self.held:
+            self.release(self.held[-1])
+        for fd in self.owned:
+            os.close(fd)
+        self.owned = []
+
+
+def is_pipe(fd):
+    try:
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+def from_makeflags(makeflags):
+    """
+    Connect to the jobserver in makeflags.  Returns a client, None if there
+    is no jobserver, or False if there is one but it can't be reached.
+    """
+    found = parse_makeflags(makeflags)
+    if found is None:
+        return None
+    if found[0] == "fifo":
+        try:
+            rfd = os.open(found[1], os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return False
+        try:
+            wfd = os.open(found[1], os.O_WRONLY)
+        except OSError:
+            os.close(rfd)
+            return False
+        return client(rfd, wfd, (rfd, wfd))
+    r, w = found[1], found[2]
+    if r < 0 or w < 0 or not is_pipe(r) or not is_pipe(w):
+        return False
+    try:
+        rfd = os.open("/proc/self/fd/%d" % r, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        # No /proc: read from make's descriptor, which may block briefly if
+        # another process takes the token select() saw.
+        return client(r, w)
+    return client(rfd, w, (rfd,))
+
+
+def serial_make(environ=os.environ):
+    """
+    Whether we were started by a make that runs one job at a time: one with
+    no jobserver, that wasn't given an unlimited -j.
+    """
+    if "MAKELEVEL" not in environ or parse_makeflags(environ.get("MAKEFLAGS", "")):
+        return False
+    return "-j" not in environ.get("MAKEFLAGS", "").split()
+
+
+def connect():
+    """
+    Connect to the jobserver of the make we are running under, if any,
+    warning (as make does) if it isn't reachable.
+    """
+    js = from_makeflags(os.getenv("MAKEFLAGS", ""))
+    if js is False:
+        sys.stderr.write(
+            "expand: warning: jobserver unavailable: using one job."
+            "  Add '+' to the parent make rule.\n"
+        )
+    return js
@@ -0,0 +1,231 @@
+"""
+Partial evaluation of a template against a resolved config.
+
+Expanding a template decides every $$IF, $$LOOP, $$COUNT, $$INCLUDE and so
+on from the config, and most of the output is the text in between.  Given
+a config, specialize() expands a template as usual, but also records a
+residual program for it: a flat list of text and "holes", where a hole is a
+variable reference whose value went into the output just as it is in the
+config.  Loops are unrolled, dead branches (and any $$INCLUDE in them) are
+gone, and every config value that was used for anything other than a hole
+is kept as a guard, along with the shape of the config (its variable names,
+the types, counts and parameter names of its instances, and any values that
+aren't strings, such as instance indexes).
+
+program.render(cfg) checks a config against the guards and, if they all
+still hold, produces the output by joining the text with the config's
+values for the holes, without expanding anything.  So when an IOC's cfg is
+edited in a way that only changes values that are substituted into the
+output (a PV prefix, a port name, ...), it is rendered again in a single
+join.  Otherwise render() returns None, and the template has to be
+specialized again.
+
+To tell holes from the rest, the config is copied with each value replaced
+by a str subclass that knows where in the config it came from, and the
+copy counts how many times each is looked up.  A value that is looked up
+more often than it is written out was used for something else.
+
+Templates that $$ASSIGN, write $$OUTPUT blocks or print anything (an
+$$INCLUDE that can't be opened, say) aren't given a program, since the
+output then isn't a function of the config and the text alone.
+"""
+
+import collections
+import contextlib
+import io
+
+import expand
+
+
+class tagged(str):
+    """
+    A config value, along with its source: ("g", NAME) for a variable, or
+    ("i", TYPE, N, NAME) for a parameter of an instance.
+    """
+
+
+def tag(value, source):
+    if type(value) is not str:
+        return value
+    t = tagged(value)
+    t.source = source
+    return t
+
+
+class counting_dict(dict):
+    """
+    cfg.ddict, and each instance, while a template is specialized: counts the
+    lookups of each tagged value by source, and adds the name of every key
+    looked up (found or not) to names, if given.  Copies (made by $$LOOPs)
+    share the counts and names.
+    """
+
+    def __init__(self, data, reads, names=None):
+        dict.__init__(self, data)
+        self.reads = reads
+        self.names = names
+
+    def __getitem__(self, key):
+        if self.names is not None:
+            self.names.add(key)
+        value = dict.__getitem__(self, key)
+        if type(value) is tagged:
+            self.reads[value.source] += 1
+        return value
+
+    def __contains__(self, key):
+        if self.names is not None:
+            self.names.add(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return counting_dict(self, self.reads, self.names)
+
+
+class residual_writer:
+    """
+    An output stream that passes everything on to f, and also keeps it as a
+    list of text and hole sources.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.ops = []
+        self.text = []
+        self.holes = collections.Counter()
+
+    def write(self, s):
+        self.f.write(s)
+        if type(s) is tagged:
+            self.flush()
+            self.ops.append(s.source)
+            self.holes[s.source] += 1
+        elif s:
+            self.text.append(s)
+
+    def flush(self):
+        if self.text:
+            self.ops.append("".join(self.text))
+            self.text = []
+
+
+def fixed(v):
+    # Only strings are tagged, so anything else has to stay the same.
+    return str if type(v) is str else v
+
+
+def shape(cfg):
+    return (
+        sorted((k, fixed(v)) for k, v in cfg.ddict.items()),
+        sorted(
+            (t, [sorted((p, fixed(v)) for p, v in d.items()) for d in insts])
+            for t, insts in cfg.idict.items()
+        ),
+    )
+
+
+def value(cfg, source):
+    if source[0] == "g":
+        return cfg.ddict[source[1]]
+    return cfg.idict[source[1]][source[2]][source[3]]
+
+
+class program:
+    """
+    The residual program of a template for configs like the one it was
+    specialized with.
+    """
+
+    def __init__(self, ops, guards, shape):
+        self.ops = ops  # text, or the source of a hole
+        self.guards = guards  # [(source, value)]
+        self.shape = shape
+
+    def render(self, cfg):
+        """
+        Return the output for cfg, or None if the program doesn't apply.
+        """
+        if shape(cfg) != self.shape:
+            return None
+        for source, v in self.guards:
+            if value(cfg, source) != v:
+                return None
+        out = []
+        for op in self.ops:
+            if type(op) is str:
+                out.append(op)
+            else:
+                v = value(cfg, op)
+                if type(v) is not str:
+                    return None
+                out.append(v)
+        return "".join(out)
+
+
+@contextlib.contextmanager
+def one_at_a_time():
+    """
+    Turn off the loop cache and batched loops for the block, since they read
+    the config without looking values up one at a time.
+    """
+    old = (expand.loop_cache, expand.simple_loop.threshold)
+    expand.loop_cache = None
+    expand.simple_loop.threshold = float("inf")
+    try:
+        yield
+    finally:
+        expand.loop_cache, expand.simple_loop.threshold = old
+
+
+def specialize(cfg, lines, f, names=None, types=None):
+    """
+    Expand lines into f with a copy of cfg, exactly as expand.expand() would,
+    returning the residual program, or None if there can't be one.
+
+    If they are given, the sets names and types are filled in with every
+    variable name and instance type the template looked up, whether or not
+    they were there.
+    """
+    reads = collections.Counter()
+    pcfg = cfg.copy()
+    pcfg.ddict = counting_dict(
+        {k: tag(v, ("g", k)) for k, v in cfg.ddict.items()}, reads, names
+    )
+    pcfg.idict = {}
+    for t, insts in cfg.idict.items():
+        # Filtered $$LOOPs look at instance parameters directly.
+        pcfg.idict[t] = [
+            counting_dict({p: tag(v, ("i", t, n, p)) for p, v in d.items()}, reads)
+            for n, d in enumerate(insts)
+        ]
+    if types is not None:
+        pcfg.idict = expand.recording_dict(pcfg.idict, types)
+    assigned = []
+
+    def assign(dname, v):
+        assigned.append(dname)
+        expand.config.assign(pcfg, dname, v)
+
+    pcfg.assign = assign
+    out = residual_writer(f)
+    printed = io.StringIO()
+    outputs = len(expand.named_outputs) if expand.named_outputs is not None else 0
+    try:
+        with one_at_a_time(), contextlib.redirect_stdout(printed):
+            expand.expand(pcfg, lines, out)
+    finally:
+        if printed.getvalue():
+            expand.sys.stdout.write(printed.getvalue())
+    out.flush()
+    if printed.getvalue() or assigned:
+        return None
+    if expand.named_outputs is not None and len(expand.named_outputs) != outputs:
+        return None
+    guards = [(s, value(cfg, s)) for s, n in reads.items() if n > out.holes[s]]
+    return program(out.ops, guards, shape(cfg))
@@ -0,0 +1,123 @@
+"""
+A read-only store of template and $$INCLUDE file contents, shared by the
+worker processes of expand --batch.
+
+Without it, every worker opens and reads each template and include file it
+uses, and keeps its own copy.  Instead, the parent reads each distinct
+template once, along with every file they $$INCLUDE by a literal name (and
+every file those include, and so on; see expand_io.prefetcher), and writes
+them all into one file:
+
+    magic        - b"EXPS", then the format version as a 4-byte integer.
+    index size   - a 4-byte integer, the length of the index.
+    lines        - a 4-byte integer, the number of entries in the line table.
+    index        - JSON: {name: [offset, length, first, count, path, st_dev,
+                   st_ino]}, where the file's lines are entries first to
+                   first + count of the line table.
+    line table   - (aligned to 4 bytes) the offset of the end of each line
+                   from the start of its file, as 4-byte integers.
+    data         - the UTF-8 text of each file, as readlines() would see it.
+
+Workers map that file read-only with mmap, so its pages are shared between
+all of them through the page cache.  Each get() slices the lines straight
+out of the mapping with the line table, so workers neither split the text
+nor keep a copy of it: the only per-worker memory for a template is the
+list of lines of an expansion that is using it.  Nothing is pickled or sent
+to the workers except the store's file name.
+
+Names are looked up exactly as they are given to myopen(), so a worker finds
+a file in the store only if it would have opened the same file itself (the
+workers run in the parent's directory with its expand_path).  Anything not
+in the store, such as an $$INCLUDE whose name comes from a variable that
+isn't in the config where it was found, is read from disk as usual.  The
+store is a snapshot taken when the batch starts.
+"""
+
+import io
+import json
+import mmap
+import struct
+
+import expand
+
+MAGIC = b"EXPS"
+VERSION = 2
+HEADER = struct.Struct("<4sIII")
+END = struct.Struct("=I")
+
+
+def write_store(filename, files):
+    """
+    Write the files (name -> (text, path, identity)) into a store file.
+    """
+    index = {}
+    ends = []
+    chunks = []
+    offset = 0
+    for name, (text, path, identity) in files.items():
+        start = len(ends)
+        end = 0
+        for line in io.StringIO(text).readlines():
+            data = line.encode("utf-8", "surrogatepass")
+            end += len(data)
+            ends.append(end)
+            chunks.append(data)
+        index[name] = [offset, end, start, len(ends) - start, path, *identity]
+        offset += end
+    header = json.dumps(index).encode("utf-8")
+    padding = -(HEADER.size + len(header)) % END.size
+    with open(filename, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(header), len(ends)))
+        fp.write(header)
+        fp.write(bytes(padding))
+        fp.write(struct.pack("=%dI" % len(ends), *ends))
+        for data in chunks:
+            fp.write(data)
+
+
+class template_store:
+    """
+    A store file mapped into memory.  get(name) returns (lines, path,
+    identity) for a file in the store, or None.  The lines are a new list
+    each time, made from the mapping.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, nlines = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an expand template store" % filename)
+        start = HEADER.size + size
+        self.index = json.loads(self.map[HEADER.size : start].decode("utf-8"))
+        start += -start % END.size
+        view = memoryview(self.map)
+        self.ends = view[start : start + nlines * END.size].cast("I")
+        self.data = view[start + nlines * END.size :]
+        view.release()
+
+    def get(self, name):
+        try:
+            offset, length, first, count, path, dev, ino = self.index[name]
+        except KeyError:
+            return None
+        data = self.data[offset : offset + length]
+        lines = []
+        start = 0
+        for end in self.ends[first : first + count]:
+            lines.append(str(data[start:end], "utf-8", "surrogatepass"))
+            start = end
+        data.release()
+        return lines, path, (dev, ino)
+
+    def close(self):
+        self.ends.release()
+        self.data.release()
+        self.map.close()
+
+
+def attach(filename):
+    """
+    Use the store in filename for this process's templates and includes.
+    """
+    expand.include_store = template_store(filename)
@@ -0,0 +1,210 @@
+"""
+Build telemetry: an append-only log of how long each output took to expand,
+and a report of the slowest IOCs, templates and releases from it.
+
+With expand --telemetry FILE (or EXPAND_TELEMETRY=FILE), each output that
+expand writes adds a JSON line to FILE:
+
+    time        - when it was written (seconds since the epoch).
+    cfg, ioc    - the config file, and its name without .cfg.
+    template    - the template file.
+    output      - the file written ("-" for stdout).
+    release     - the config's RELEASE (for an output from the cache, the
+                  part of the template's path before /iocBoot/, if any).
+    wall        - seconds from the start of this expand to the end of all
+                  of its outputs.
+    config      - seconds spent resolving the config (shared by all of the
+                  outputs of one expand -o ... run).
+    passes      - how many times the config file was expanded to resolve it.
+    expand      - seconds spent expanding this template.
+    iterations  - $$LOOP iterations, counting those of nested loops.
+    includes    - $$INCLUDEs read by the template.
+    bytes       - the size of the output.
+    cached      - true if the output came from the --cache.
+
+Every record of a run is appended with a single write() to a file opened
+with O_APPEND, so parallel make jobs can share one file.
+
+expand --report [FILE] [--top N] prints the 50th, 90th and 99th percentile
+and the maximum of config + expand time per IOC, per template (by file
+name, across releases) and per release, slowest first.
+"""
+
+import json
+import os
+import sys
+import time
+
+
+def release_of(template):
+    head, sep, tail = template.partition("/iocBoot/")
+    return head if sep else ""
+
+
+class recorder:
+    """
+    Counts loop iterations and includes (expand.py adds to iterations and
+    includes as it goes), and collects a record for each output.
+    """
+
+    def __init__(self, filename, configfile):
+        self.filename = filename
+        self.cfg = configfile
+        self.ioc = os.path.basename(configfile)
+        if self.ioc.endswith(".cfg"):
+            self.ioc = self.ioc[:-4]
+        self.start = time.perf_counter()
+        self.iterations = 0
+        self.includes = 0
+        self.config_time = 0.0
+        self.passes = 0
+        self.records = []
+
+    def config_read(self, seconds, passes):
+        self.config_time += seconds
+        self.passes += passes
+
+    def record(self, template, outfile, release, seconds, iterations, includes):
+        try:
+            size = None if outfile == "-" else os.path.getsize(outfile)
+        except OSError:
+            size = None
+        self.records.append(
+            {
+                "time": time.time(),
+                "cfg": self.cfg,
+                "ioc": self.ioc,
+                "template": template,
+                "output": outfile,
+                "release": release,
+                "config": self.config_time,
+                "passes": self.passes,
+                "expand": seconds,
+                "iterations": iterations,
+                "includes": includes,
+                "bytes": size,
+                "cached": False,
+            }
+        )
+
+    def output(self, cfg, template, outfile, seconds, iterations, includes):
+        release = cfg.ddict.get("RELEASE") or release_of(template)
+        self.record(template, outfile, release, seconds, iterations, includes)
+
+    def cached(self, template, outfile):
+        self.record(template, outfile, release_of(template), 0.0, 0, 0)
+        self.records[-1].update(config=0.0, passes=0, cached=True)
+
+    def write(self):
+        """
+        Append the records to the log.
+        """
+        if not self.records:
+            return
+        wall = time.perf_counter() - self.start
+        data = "".join(
+            json.dumps(dict(r, wall=wall), sort_keys=True) + "\n" for r in self.records
+        )
+        self.records = []
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+            try:
+                os.write(fd, data.encode("utf-8", "surrogateescape"))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            sys.stderr.write("Cannot write telemetry to %s: %s\n" % (self.filename, e))
+
+
+def read_log(filename):
+    records = []
+    with open(filename) as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # A line cut short by a full disk, say.
+    return records
+
+
+def percentile(values, p):
+    """
+    The p'th percentile of the sorted values, by the nearest-rank method.
+    """
+    n = max(1, -(-len(values) * p // 100))
+    return values[int(n) - 1]
+
+
+def table(records, field, title, top, f):
+    groups = {}
+    for r in records:
+        groups.setdefault(r.get(field) or "(unknown)", []).append(
+            r["config"] + r["expand"]
+        )
+    rows = []
+    for name, times in groups.items():
+        times.sort()
+        rows.append(
+            (
+                percentile(times, 90),
+                name,
+                len(times),
+                percentile(times, 50),
+                percentile(times, 99),
+                times[-1],
+            )
+        )
+    rows.sort(key=lambda row: (-row[0], row[1]))
+    f.write(
+        "Slowest %s (%d of %d), by 90th percentile time:\n"
+        % (title, min(top, len(rows)), len(rows))
+    )
+    columns = ("runs", "p50 ms", "p90 ms", "p99 ms", "max ms", field)
+    f.write("%6s %9s %9s %9s %9s  %s\n" % columns)
+    for p90, name, n, p50, p99, most in rows[:top]:
+        f.write(
+            "%6d %9.1f %9.1f %9.1f %9.1f  %s\n"
+            % (n, 1000 * p50, 1000 * p90, 1000 * p99, 1000 * most, name)
+        )
+    f.write("\n")
+
+
+def report(records, top=20, f=None):
+    if f is None:
+        f = sys.stdout
+    records = [dict(r, template=os.path.basename(r["template"])) for r in records]
+    cached = sum(1 for r in records if r.get("cached"))
+    f.write("%d outputs, %d from the cache\n\n" % (len(records), cached))
+    expanded = [r for r in records if not r.get("cached")]
+    table(expanded, "ioc", "IOCs", top, f)
+    table(expanded, "template", "templates", top, f)
+    table(expanded, "release", "releases", top, f)
+
+
+def report_main(av):
+    """
+    Entry point for expand --report [FILE] [--top N].
+    """
+    filename = os.getenv("EXPAND_TELEMETRY")
+    top = 20
+    av = av[1:]
+    try:
+        while av:
+            if av[0] == "--top":
+                top = int(av[1])
+                av = av[2:]
+            else:
+                filename = av[0]
+                av = av[1:]
+    except (IndexError, ValueError):
+        filename = None
+    if filename is None:
+        print("Usage: expand --report [ TELEMETRY_FILE ] [ --top N ]")
+        return 1
+    try:
+        records = read_log(filename)
+    except OSError as e:
+        print(e)
+        return 1
+    report(records, top)
+    return 0
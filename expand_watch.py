@@ -0,0 +1,346 @@
+"""
+Watch mode: keep a children directory's build up to date as files change.
+
+    expand --watch DIR [ --build-top DIR ] [ --interval SECONDS ] [ --poll ]
+
+The first cycle expands everything that RULES_EXPAND would (see
+expand_batch.rules_expand_jobs), and records for each output the files it
+was built from: the cfg, the template and every file myopen() handed out
+while resolving the config or expanding the template ($$INCLUDEs).
+
+After that, each cycle stats the recorded inputs and re-expands only the
+outputs whose inputs changed.  Resolved configs and template contents are
+kept between cycles and only thrown away when one of their own inputs
+changes.  New cfg files are picked up as they appear.
+
+Each output also keeps the residual program of its template for its config
+(see expand_partial.py), which outlives changes to the cfg.  When a cfg
+changes, its outputs are rendered from their programs if the change only
+touched values that are substituted into them as they are, and expanded
+(and specialized again) otherwise.
+
+Changes are found by comparing modification times, which needs nothing
+beyond the standard library.  On Linux, inotify (through ctypes) is used to
+wake up as soon as something in a watched directory changes; the mtime
+scan still runs every --interval seconds regardless, since inotify doesn't
+see changes made to NFS from other hosts.
+"""
+
+import os
+import sys
+import time
+
+import expand
+import expand_partial
+from expand_batch import rules_expand_jobs, write_job
+
+
+def file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def recording(func, *args):
+    """
+    Call func(*args), returning its result and the set of files it opened.
+    """
+    old = expand.opened_files
+    expand.opened_files = set()
+    try:
+        result = func(*args)
+        return result, {os.path.abspath(fn) for fn in expand.opened_files}
+    finally:
+        if old is not None:
+            old |= expand.opened_files
+        expand.opened_files = old
+
+
+class inotify_waiter:
+    """
+    Wait for changes in a set of directories using Linux inotify via ctypes.
+
+    Raises OSError from the constructor if inotify isn't available.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    # IN_CREATE | IN_DELETE
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self):
+        import ctypes
+
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = set()
+
+    def watch(self, dirs):
+        for d in dirs - self.dirs:
+            # Directories that don't exist (yet) are left to the mtime scan.
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.MASK)
+            if wd >= 0:
+                self.dirs.add(d)
+
+    def wait(self, timeout):
+        import select
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # Give an editor a moment to finish writing, then drain the events:
+            # we only use them as a wake-up, the mtime scan finds what changed.
+            time.sleep(0.05)
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class poll_waiter:
+    def watch(self, dirs):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class watcher:
+    """
+    The warm state for watch mode: jobs, resolved configs, template contents,
+    residual programs and the inputs each output was built from.
+    """
+
+    def __init__(self, build_top="build", log=None):
+        self.build_top = build_top
+        self.log = log if log is not None else sys.stdout
+        self.jobs = {}  # cfg -> (jobs, inputs of the job list)
+        self.configs = {}  # (cfg, statements) -> (config, inputs)
+        self.templates = {}  # template -> (lines or None, inputs)
+        self.outputs = {}  # output -> inputs
+        # (template, cfg, statements) -> (program or None, inputs but the cfg)
+        self.programs = {}
+        self.replayed = 0  # outputs rendered from programs
+        self.states = {}  # input -> file_state()
+
+    def inputs(self):
+        files = set()
+        for _, deps in self.jobs.values():
+            files |= deps
+        for _, deps in self.configs.values():
+            files |= deps
+        for _, deps in self.templates.values():
+            files |= deps
+        for deps in self.outputs.values():
+            files |= deps
+        for _, deps in self.programs.values():
+            files |= deps
+        return files
+
+    def get_jobs(self, cfgfile):
+        try:
+            return self.jobs[cfgfile][0]
+        except KeyError:
+            pass
+        jobs, deps = recording(rules_expand_jobs, [cfgfile], self.build_top)
+        self.jobs[cfgfile] = (jobs, deps | {os.path.abspath(cfgfile)})
+        return jobs
+
+    def get_config(self, j):
+        key = (j.cfg, tuple(j.statements))
+        try:
+            return self.configs[key]
+        except KeyError:
+            pass
+
+        def resolve():
+            cfg = expand.config()
+            cfg.read_config(j.cfg, j.statements)
+            return cfg
+
+        cfg, deps = recording(resolve)
+        self.configs[key] = (cfg, deps | {os.path.abspath(j.cfg)})
+        return self.configs[key]
+
+    def get_template(self, template):
+        try:
+            return self.templates[template]
+        except KeyError:
+            pass
+
+        def read():
+            fp = expand.myopen(template)
+            if not fp:
+                return None
+            lines = fp.readlines()
+            fp.close()
+            return lines
+
+        lines, deps = recording(read)
+        # Also watch for a missing template turning up.
+        self.templates[template] = (lines, deps | {os.path.abspath(template)})
+        return self.templates[template]
+
+    def render(self, j):
+        cfg, cfg_deps = self.get_config(j)
+        lines, tpl_deps = self.get_template(j.template)
+        key = (j.template, j.cfg, tuple(j.statements))
+
+        def expander(cfg, lines, f):
+            if key in self.programs:
+                program = self.programs[key][0]
+                if program is None:
+                    # It can't have one (it $$ASSIGNs, say).
+                    expand.expand(cfg.copy(), lines, f)
+                    return
+                text = program.render(cfg)
+                if text is not None:
+                    f.write(text)
+                    self.replayed += 1
+                    return
+            program, deps = recording(expand_partial.specialize, cfg, lines, f)
+            self.programs[key] = (program, deps | tpl_deps)
+
+        _, deps = recording(write_job, cfg, j, lines, expander)
+        if key in self.programs:
+            deps |= self.programs[key][1]
+        self.outputs[j.output] = cfg_deps | tpl_deps | deps
+
+    def invalidate(self, changed):
+        """
+        Forget everything that was built from a changed file.
+        """
+        for table in (self.jobs, self.configs, self.templates, self.programs):
+            for key in [k for k, v in table.items() if v[1] & changed]:
+                del table[key]
+        dirty = {out for out, deps in self.outputs.items() if deps & changed}
+        for out in dirty:
+            del self.outputs[out]
+        return dirty
+
+    def cycle(self):
+        """
+        Bring everything up to date once.  Returns the number of outputs that
+        were expanded.
+        """
+        start = time.perf_counter()
+        replayed = self.replayed
+        changed = set()
+        for path, state in list(self.states.items()):
+            if file_state(path) != state:
+                changed.add(path)
+        self.invalidate(changed)
+
+        cfgs = sorted(fn for fn in os.listdir(".") if fn.endswith(".cfg"))
+        for cfgfile in list(self.jobs):
+            if cfgfile not in cfgs:
+                del self.jobs[cfgfile]
+        todo = []
+        for cfgfile in cfgs:
+            try:
+                jobs = self.get_jobs(cfgfile)
+            except (Exception, SystemExit) as e:
+                self.log.write("Cannot read %s: %s\n" % (cfgfile, e))
+                # Try again when it changes.
+                self.jobs[cfgfile] = ([], {os.path.abspath(cfgfile)})
+                continue
+            todo.extend(j for j in jobs if j.output not in self.outputs)
+
+        failed = 0
+        for j in todo:
+            try:
+                self.render(j)
+            except (Exception, SystemExit) as e:
+                failed += 1
+                self.log.write("Failed to expand %s: %s\n" % (j.output, e))
+                # Try again when any of its inputs change.
+                self.outputs[j.output] = {
+                    os.path.abspath(j.cfg),
+                    os.path.abspath(j.template),
+                }
+
+        self.states = {path: file_state(path) for path in self.inputs()}
+        if todo or changed:
+            elapsed = 1000 * (time.perf_counter() - start)
+            self.log.write(
+                "Expanded %d output(s) (%d failed, %d from residual programs) "
+                "after %d change(s) in %.1f ms\n"
+                % (len(todo), failed, self.replayed - replayed, len(changed), elapsed)
+            )
+            self.log.flush()
+        return len(todo)
+
+    def watched_dirs(self):
+        return {os.path.dirname(path) for path in self.states} | {os.getcwd()}
+
+
+def usage():
+    print("Usage: expand --watch DIR [ OPTIONS ]")
+    print("")
+    print("  --build-top DIR      Build directory (default: build).")
+    print("  --interval SECONDS   How often to check for changes (default: 1).")
+    print("  --poll               Don't use inotify, just check every interval.")
+
+
+def watch_main(av):
+    """
+    Entry point for expand --watch.  av is the argument list, starting with
+    the --watch option.
+    """
+    cfgdir = None
+    build_top = "build"
+    interval = 1.0
+    poll = False
+    try:
+        while len(av) > 0:
+            if av[0] == "--watch":
+                cfgdir = av[1]
+                av = av[2:]
+            elif av[0] == "--build-top":
+                build_top = av[1]
+                av = av[2:]
+            elif av[0] == "--interval":
+                interval = float(av[1])
+                av = av[2:]
+            elif av[0] == "--poll":
+                poll = True
+                av = av[1:]
+            else:
+                usage()
+                return 1
+    except (IndexError, ValueError):
+        usage()
+        return 1
+    if cfgdir is None:
+        usage()
+        return 1
+
+    os.chdir(cfgdir)
+    w = watcher(build_top)
+    waiter = poll_waiter()
+    if not poll:
+        try:
+            waiter = inotify_waiter()
+        except (OSError, AttributeError):
+            pass
+    print("Watching %s (%s), ^C to stop" % (os.getcwd(), type(waiter).__name__))
+    try:
+        while True:
+            w.cycle()
+            waiter.watch(w.watched_dirs())
+            waiter.wait(interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        waiter.close()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""
+Differential fuzzer for the expand engine.
+
+Generates random configs, $$INCLUDE files and templates from a grammar that
+covers every keyword, the nesting of blocks and each quoting form, and runs
+them through the frozen reference engine (reference_expand.py) and through
+the current expand.py in several configurations:
+
+    current  - expand.py as it runs by default.
+    scalar   - with the batched simple loops and lazy queries turned off.
+    batch    - with every simple loop batched, through NumPy if available.
+    cached   - with a warm --loop-cache.
+    partial  - through expand_partial.specialize(), also checking that the
+               residual program renders the same output.
+
+Each case expands the template, and answers a few "expand -c CFG NAME"
+queries, and the output (and anything printed along the way) has to be
+identical byte for byte.  A mismatch is shrunk to a small counterexample by
+deleting lines while the engines still disagree, and printed (and saved
+with --save DIR).
+
+Each engine is also timed on each case, and cases where an engine takes
+more than --budget times as long as the reference (plus a little slack for
+timer noise) are reported as too slow.
+
+    python tests/fuzz_expand.py [ --seed N ] [ --count N ] [ --engine NAME ]
+                                [ --budget FACTOR ] [ --save DIR ]
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+
+HERE = pathlib.Path(__file__).resolve().parent
+if str(HERE.parent) not in sys.path:
+    sys.path.insert(0, str(HERE.parent))
+
+import expand  # noqa: E402
+import expand_partial  # noqa: E402
+
+
+def load_reference():
+    spec = importlib.util.spec_from_file_location(
+        "reference_expand", HERE / "reference_expand.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+reference = load_reference()
+
+VARS = ["A", "B", "C", "N", "P", "X", "EMPTY"]
+TYPES = ["EVR", "CH"]
+FIELDS = ["NAME", "PORT", "TYPE"]
+WORDS = ["x", "abc", "1", "07", "0x1f", "-", "a b", "%", ",", "(", ")", "'", '"']
+FORMATS = ["%d", "%02d", "%x", "%04X", "%s", "%.2f", "ch%03d"]
+INCLUDES = 3  # inc0.txt ... inc2.txt, each only including later ones
+
+
+class case:
+    """
+    One fuzz input: the files to write and what to do with them.
+    """
+
+    def __init__(self, files, statements, keys):
+        self.files = files  # name -> text; fuzz.cfg and template are run
+        self.statements = statements  # ADDITIONAL_STATEMENTS
+        self.keys = keys  # names to query with "expand -c fuzz.cfg NAME"
+
+    def with_file(self, name, text):
+        files = dict(self.files)
+        files[name] = text
+        return case(files, self.statements, self.keys)
+
+    def describe(self):
+        out = []
+        for name, text in sorted(self.files.items()):
+            out.append("==> %s <==\n%s" % (name, text))
+        out.append("statements: %r\nkeys: %r\n" % (self.statements, self.keys))
+        return "\n".join(out)
+
+
+class generator:
+    """
+    Random configs and templates.
+    """
+
+    def __init__(self, rnd):
+        self.rnd = rnd
+
+    def choice(self, seq):
+        return self.rnd.choice(seq)
+
+    def value(self):
+        r = self.rnd.random()
+        if r < 0.2:
+            return "$$" + self.choice(VARS)
+        if r < 0.3:
+            return self.choice(["$$UP(PATH)", "$$DIRNAME", "$$(A)x"])
+        if r < 0.4:
+            return ""
+        return self.choice(["1", "2", "3", "010", "0x10", "abc", "a b", "x/y/z.db"])
+
+    def definition(self):
+        name = self.choice(VARS)
+        value = self.value()
+        if " " in value:
+            forms = ['%s="%s"', "%s='%s'", '%s "%s"', "%s '%s'", "%s=%s"]
+        else:
+            forms = ["%s=%s", '%s="%s"', "%s='%s'", "%s %s", "%s\t%s", "%s = %s"]
+        return self.choice(forms) % (name, value)
+
+    def old_instance(self, counts):
+        itype = self.choice(TYPES)
+        params = []
+        for field in self.rnd.sample(FIELDS, self.rnd.randint(0, 3)):
+            form = self.choice(["%s=%s", '%s="%s"', "%s='%s'"])
+            params.append(form % (field, self.choice(["a", "b1", "", "$$A"])))
+        if itype == "CH" and counts.get("EVR") and self.rnd.random() < 0.5:
+            params.append(self.choice(["EVR0", "ev"]))
+        prefix = ""
+        if itype == "EVR" and "ev" not in counts and self.rnd.random() < 0.5:
+            prefix = "ev:"
+            counts["ev"] = 1
+        counts[itype] = counts.get(itype, 0) + 1
+        return "%s%s(%s)" % (prefix, itype, ",".join(params))
+
+    def new_instance(self):
+        lines = ["INSTANCE %s%s" % (self.choice(TYPES), self.choice(["", " n1"]))]
+        for _ in range(self.rnd.randint(0, 3)):
+            field = self.choice(FIELDS)
+            lines.append(
+                self.choice(["    %s %s", "    %s=%s", "  %s   '%s'"])
+                % (field, self.choice(["v", "w2", "q r"]).replace(" ", ""))
+            )
+        return lines
+
+    def config(self):
+        lines = []
+        counts = {}
+        for _ in range(self.rnd.randint(0, 8)):
+            r = self.rnd.random()
+            if r < 0.5:
+                lines.append(self.definition())
+            elif r < 0.75:
+                lines.append(self.old_instance(counts))
+            elif r < 0.8:
+                lines.append("$$INCLUDE(common.inc)")
+            elif r < 0.85:
+                lines.append(self.choice(["# comment $$A", "", "junk line ("]))
+            elif r < 0.9:
+                lines.append("$$IF(A)\nB=if\n$$ELSE(A)\nB=else\n$$ENDIF(A)")
+            else:
+                lines.append("$$LOOP(2)\nC$$INDEX=$$INDEX\n$$ENDLOOP(2)")
+        if self.rnd.random() < 0.3:
+            for _ in range(self.rnd.randint(1, 2)):
+                lines.extend(self.new_instance())
+        text = "\n".join(lines)
+        return text + ("\n" if self.rnd.random() < 0.9 else "")
+
+    def expr(self, depth=0):
+        r = self.rnd.random()
+        if depth > 2 or r < 0.4:
+            return self.choice(VARS + ["INDEX", "INDEX1", "0", "3", "0x10", "07"])
+        if r < 0.5:
+            return "2**INDEX"
+        if r < 0.55:
+            return "-" + self.expr(depth + 1)
+        if r < 0.6:
+            return "%s if %s else %s" % (
+                self.expr(depth + 1),
+                self.expr(depth + 1),
+                self.expr(depth + 1),
+            )
+        op = self.choice(["+", "-", "*", "%", "/", "<<", ">>", "&", "|", "^"])
+        text = "%s%s%s" % (self.expr(depth + 1), op, self.expr(depth + 1))
+        return "(%s)" % text if self.rnd.random() < 0.3 else text
+
+    def block(self, kw, name, body, orelse=None):
+        nl = self.choice(["", "\n"])
+        text = "$$%s(%s)%s%s" % (kw, name, nl, body)
+        if orelse is not None:
+            text += "$$ELSE(%s)%s%s" % (name, self.choice(["", "\n"]), orelse)
+        return text + "$$END%s(%s)%s" % (kw, name, self.choice(["", "\n"]))
+
+    def item(self, depth, include):
+        r = self.rnd.random()
+        if depth < 3 and r < 0.12:
+            name = self.choice(TYPES + ["N", "0", "2", "3"])
+            return self.block("LOOP", name, self.body(depth + 1, include))
+        if depth < 3 and r < 0.22:
+            name = self.choice(VARS + FIELDS)
+            orelse = self.body(depth + 1, include) if self.rnd.random() < 0.5 else None
+            if self.rnd.random() < 0.3:
+                name = "%s,%s" % (name, self.choice(["1", "abc", ""]))
+                text = self.block("IF", name, self.body(depth + 1, include))
+                return text.replace("$$ENDIF(%s)" % name, "$$ENDIF(%s)" % name[:-1])
+            return self.block("IF", name, self.body(depth + 1, include), orelse)
+        if depth < 3 and r < 0.25:
+            text = "$$IFCALC{%s}%s$$ENDIF(CALC)" % (
+                self.expr(),
+                self.body(depth + 1, include),
+            )
+            return text
+        if r < 0.4:
+            return self.choice(["$$%s", "$$(%s)"]) % self.choice(
+                VARS + FIELDS + ["INDEX", "INDEX1", "DIRNAME", "EVRNAME", "CHPORT0"]
+            )
+        if r < 0.5:
+            fmt = ("," + self.choice(FORMATS)) if self.rnd.random() < 0.5 else ""
+            return "$$CALC{%s%s}" % (self.expr(), fmt)
+        if r < 0.55:
+            return "$$ASSIGN{%s,%s}" % (self.choice(VARS), self.expr())
+        if r < 0.6 and include < INCLUDES:
+            n = self.rnd.randint(include, INCLUDES - 1)
+            return self.choice(["$$INCLUDE(inc%d.txt)", "\n$$INCLUDE(inc%d.txt)\n"]) % n
+        if r < 0.65:
+            return self.choice(
+                [
+                    "$$COUNT(%s)" % self.choice(TYPES),
+                    "$$IF(%s,yes,no)" % self.choice(VARS + FIELDS),
+                    '$$TRANSLATE(%s,"abc","xyz")' % self.choice(VARS + FIELDS),
+                    "$$UP(%s)" % self.choice(VARS + ["PATH"]),
+                    "$$ROOT(%s)" % self.choice(VARS + ["x.y.z"]),
+                    "$$SUBSTR(%s,1,3)" % self.choice(VARS + FIELDS),
+                    "$$SUBSTR($$%s,N)" % self.choice(VARS + FIELDS),
+                    "$$NAME(ev,NAME)",
+                    "$$INCLUDE(missing.txt)",
+                    "$$$",
+                ]
+            )
+        if r < 0.8:
+            return "\n"
+        return self.choice(WORDS) + self.choice(["", " ", "  "])
+
+    def body(self, depth=0, include=INCLUDES):
+        return "".join(self.item(depth, include) for _ in range(self.rnd.randint(1, 6)))
+
+    def case(self):
+        files = {
+            "fuzz.cfg": self.config(),
+            "common.inc": self.choice(["A=2\n", "B $$A\n", "N=2\nX=07\n", "P=p"]),
+            "template": self.body(),
+        }
+        for n in range(INCLUDES):
+            files["inc%d.txt" % n] = self.body(1, n + 1) + self.choice(["", "\n"])
+        statements = self.choice([[], [], ["X=5"], ["IOCNAME=ioc-fuzz", "N=1"]])
+        keys = self.rnd.sample(VARS + ["EVRNAME0", "DIRNAME", "ev:TYPE"], 3)
+        return case(files, statements, keys)
+
+
+@contextlib.contextmanager
+def patched(settings):
+    """
+    Set module attributes (given as (object, name, value) triples) and
+    environment variables (name -> value) for the duration of the block.
+    """
+    attrs, env = settings
+    saved = [(obj, name, getattr(obj, name)) for obj, name, _ in attrs]
+    saved_env = {name: os.environ.get(name) for name in env}
+    try:
+        for obj, name, value in attrs:
+            setattr(obj, name, value)
+        os.environ.update(env)
+        yield
+    finally:
+        for obj, name, value in saved:
+            setattr(obj, name, value)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class engine:
+    """
+    A module implementing expand, and the settings to run it with.
+    """
+
+    def __init__(self, name, module, attrs=(), env=None, warm=False, expander=None):
+        self.name = name
+        self.module = module
+        self.settings = (list(attrs), dict(env or {}))
+        self.warm = warm
+        self.expander = expander if expander is not None else module.expand
+
+    def run(self, c, workdir):
+        """
+        Run the case in workdir (where its files have been written),
+        returning (what it wrote, seconds).
+        """
+        m = self.module
+        with patched(self.settings):
+            if self.warm:
+                m.loop_cache = m.iteration_cache(os.path.join(workdir, "loops.json"))
+                self.expand_template(c, workdir)
+            start = time.perf_counter()
+            result = self.expand_template(c, workdir)
+            for key in c.keys:
+                result += self.query(c, workdir, key)
+            elapsed = time.perf_counter() - start
+            if self.warm:
+                m.loop_cache = None
+        return result, elapsed
+
+    def expand_template(self, c, workdir):
+        m = self.module
+        m.expand_path = [".."]
+        out = io.StringIO()
+        printed = io.StringIO()
+        cwd = os.getcwd()
+        try:
+            os.chdir(workdir)
+            with contextlib.redirect_stdout(printed):
+                cfg = m.config()
+                cfg.read_config("fuzz.cfg", c.statements)
+                self.expander(cfg, c.files["template"].splitlines(True), out)
+        except SystemExit:
+            out.write("<exit>")
+        except Exception as e:
+            out.write("<%s>" % type(e).__name__)
+        finally:
+            os.chdir(cwd)
+        return "%s\n--- printed ---\n%s" % (out.getvalue(), printed.getvalue())
+
+    def query(self, c, workdir, key):
+        m = self.module
+        printed = io.StringIO()
+        cwd = os.getcwd()
+        argv = sys.argv
+        try:
+            os.chdir(workdir)
+            sys.argv = ["expand", "-c", "fuzz.cfg", key]
+            with contextlib.redirect_stdout(printed):
+                status = m.main()
+        except SystemExit:
+            status = "<exit>"
+        except Exception as e:
+            status = "<%s>" % type(e).__name__
+        finally:
+            os.chdir(cwd)
+            sys.argv = argv
+        # Only the answer itself is compared: config.read_value doesn't read
+        # instance lines, so it doesn't repeat what read_config prints about
+        # them.
+        answer = printed.getvalue().splitlines()[-1:]
+        return "\n--- %s: %s ---\n%s" % (key, status, answer)
+
+
+def partial_expand(cfg, lines, out):
+    program = expand_partial.specialize(cfg, lines, out)
+    if program is not None and program.render(cfg) != out.getvalue():
+        out.write("<residual program differs>")
+
+
+def engines():
+    sl = expand.simple_loop
+    return {
+        "reference": engine("reference", reference),
+        "current": engine("current", expand, [(expand, "loop_cache", None)]),
+        "scalar": engine(
+            "scalar",
+            expand,
+            [(expand, "loop_cache", None), (sl, "threshold", 10**9)],
+            {"EXPAND_LAZY": "0"},
+        ),
+        "batch": engine(
+            "batch",
+            expand,
+            [
+                (expand, "loop_cache", None),
+                (sl, "threshold", 0),
+                (sl, "numpy_threshold", 0),
+            ],
+        ),
+        "cached": engine("cached", expand, [(sl, "threshold", 10**9)], warm=True),
+        "partial": engine(
+            "partial", expand, [(expand, "loop_cache", None)], expander=partial_expand
+        ),
+    }
+
+
+def write_case(c, workdir):
+    for name in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, name))
+    for name, text in c.files.items():
+        with open(os.path.join(workdir, name), "w") as fd:
+            fd.write(text)
+
+
+def differs(c, ref, other, workdir):
+    write_case(c, workdir)
+    return ref.run(c, workdir)[0] != other.run(c, workdir)[0]
+
+
+def shrink(c, still_fails):
+    """
+    Delete lines from each file, and then characters from what is left,
+    for as long as still_fails(case) stays true.
+    """
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(c.files):
+            for unit in ("lines", "chars"):
+                text = c.files[name]
+                parts = text.splitlines(True) if unit == "lines" else list(text)
+                chunk = max(1, len(parts) // 2)
+                while chunk >= 1:
+                    i = 0
+                    while i < len(parts):
+                        trial = parts[:i] + parts[i + chunk :]
+                        candidate = c.with_file(name, "".join(trial))
+                        if still_fails(candidate):
+                            c = candidate
+                            parts = trial
+                            changed = True
+                        else:
+                            i += chunk
+                    chunk //= 2
+    return c
+
+
+def fuzz(seed, count, names, budget, workdir, log=None, slack=0.002):
+    """
+    Run count cases from the given seed through the named engines, returning
+    a list of (engine, case) mismatches, already shrunk, and a list of
+    (engine, case, reference seconds, engine seconds) budget overruns.
+    """
+    table = engines()
+    ref = table["reference"]
+    others = [table[name] for name in names]
+    rnd = random.Random(seed)
+    gen = generator(rnd)
+    mismatches = []
+    slow = []
+    for n in range(count):
+        c = gen.case()
+        write_case(c, workdir)
+        expected, ref_time = ref.run(c, workdir)
+        for e in others:
+            got, elapsed = e.run(c, workdir)
+            if got != expected:
+                small = shrink(c, lambda x, e=e: differs(x, ref, e, workdir))
+                mismatches.append((e.name, small))
+                if log is not None:
+                    log.write(
+                        "MISMATCH in %s (seed %d, case %d):\n" % (e.name, seed, n)
+                    )
+                    log.write(small.describe() + "\n")
+            elif elapsed > budget * ref_time + slack:
+                slow.append((e.name, c, ref_time, elapsed))
+    return mismatches, slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument(
+        "--engine",
+        action="append",
+        choices=sorted(set(engines()) - {"reference"}),
+        help="engine to compare with the reference (default: all of them)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1.5,
+        help="allowed time relative to the reference (default: 1.5)",
+    )
+    parser.add_argument("--save", help="directory to save counterexamples in")
+    args = parser.parse_args()
+    names = args.engine or sorted(set(engines()) - {"reference"})
+
+    with tempfile.TemporaryDirectory() as workdir:
+        mismatches, slow = fuzz(
+            args.seed, args.count, names, args.budget, workdir, log=sys.stdout
+        )
+    for name, c, ref_time, elapsed in slow:
+        print(
+            "%s took %.1f ms, the reference %.1f ms:\n%s"
+            % (name, 1000 * elapsed, 1000 * ref_time, c.describe())
+        )
+    if args.save:
+        for n, (name, c) in enumerate(mismatches):
+            path = os.path.join(args.save, "%s-%d-%d" % (name, args.seed, n))
+            os.makedirs(path, exist_ok=True)
+            write_case(c, path)
+            with open(os.path.join(path, "CASE"), "w") as fd:
+                fd.write(c.describe())
+    print(
+        "%d cases, %d engines: %d mismatches, %d over the %.1fx time budget"
+        % (args.count, len(names), len(mismatches), len(slow), args.budget)
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
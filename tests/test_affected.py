@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import pathlib
+
+from expand import main
+
+from .conftest import cli_args, pushd
+
+OLD = """\
+RELEASE={release}
+PREFIX=IOC:OLD
+DEBUG=
+MOTOR(NAME=m1,PV=A:1,PORT=p1)
+MOTOR(NAME=m2,PV=A:2,PORT=p2)
+"""
+
+TEMPLATE = """\
+$$LOOP(MOTOR)
+dbLoad(m.db, "P=$$PV,PORT=$$PORT")
+$$ENDLOOP(MOTOR)
+$$IF(DEBUG)
+debug
+$$ENDIF(DEBUG)
+$$IF(EXTRA)extra$$ENDIF(EXTRA)
+"""
+
+
+def affected(tmp_path, capsys, old, new, *templates):
+    (tmp_path / "old.cfg").write_text(old)
+    (tmp_path / "new.cfg").write_text(new)
+    capsys.readouterr()
+    args = ["expand", "--affected", "old.cfg", "new.cfg", *templates]
+    with pushd(tmp_path):
+        with cli_args(args):
+            status = main()
+    return status, capsys.readouterr().out.splitlines()
+
+
+def test_affected(tmp_path: pathlib.Path, capsys):
+    """
+    Outputs are changed (with the instances that change), unknown or
+    unchanged, depending on what the templates look at.
+    """
+    (tmp_path / "st.cmd").write_text(TEMPLATE)
+    (tmp_path / "env").write_text("prefix $$PREFIX\n")
+    old = OLD.format(release="/nowhere")
+    templates = ("st.cmd", "env")
+
+    status, out = affected(
+        tmp_path, capsys, old, old.replace("A:2", "A:22"), *templates
+    )
+    assert status == 2
+    assert out == [
+        "changed   st.cmd: MOTOR[1].PV",
+        "unchanged env",
+        "1 changed, 0 unknown, 1 unchanged",
+    ]
+
+    new = old.replace("DEBUG=", "DEBUG=1").replace("IOC:OLD", "IOC:NEW")
+    status, out = affected(tmp_path, capsys, old, new, *templates)
+    assert out[:2] == ["unknown   st.cmd: DEBUG", "changed   env: PREFIX"]
+
+    # A variable nothing looks at, and one the template looked for.
+    status, out = affected(tmp_path, capsys, old, old + "UNUSED=1\n", *templates)
+    assert status == 0
+    assert out[-1] == "0 changed, 0 unknown, 2 unchanged"
+    status, out = affected(tmp_path, capsys, old, old + "EXTRA=1\n", *templates)
+    assert out[0] == "unknown   st.cmd: EXTRA"
+
+
+def test_affected_rules(tmp_path: pathlib.Path, capsys):
+    """
+    Without templates, the outputs are those RULES_EXPAND builds.
+    """
+    templates = tmp_path / "release" / "iocBoot" / "templates"
+    templates.mkdir(parents=True)
+    (templates / "st.cmd").write_text(TEMPLATE)
+    (templates / "Makefile").write_text("IOC = $$IOCNAME\n")
+    old = OLD.format(release=tmp_path / "release")
+
+    status, out = affected(tmp_path, capsys, old, old.replace("p1", "p9"))
+    assert status == 2
+    assert "unchanged build/iocBoot/new/Makefile" in out
+    assert "changed   build/iocBoot/new/st.cmd: MOTOR[0].PORT" in out
+    # ioc.sub-arch and ioc.sub-req are missing; the optional ones are stubs.
+    assert out[-1] == "1 changed, 2 unknown, 5 unchanged"
+
+    status, out = affected(tmp_path, capsys, old, old.replace("/release", "/other"))
+    assert "unknown   build/iocBoot/new/Makefile: RELEASE" in out
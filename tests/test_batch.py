@@ -0,0 +1,304 @@
+"""
+Tests for expand --batch and expand --all-cfgs
+"""
+
+import io
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+
+from expand import main
+
+from .conftest import cli_args, pushd
+
+TEST_IOC = pathlib.Path(__file__).parent / "ioc-tst-unittest"
+RULES_EXPAND = pathlib.Path(__file__).parent.parent / "RULES_EXPAND"
+
+
+@pytest.fixture
+def children_dir(tmp_path: pathlib.Path) -> pathlib.Path:
+    shutil.copytree(TEST_IOC, tmp_path / "ioc-tst-unittest")
+    children = tmp_path / "ioc-tst-unittest" / "children"
+    with open(children / "Makefile", "w") as fd:
+        fd.write("IOC_CFG += $(wildcard *.cfg)\n")
+        fd.write(f"include {RULES_EXPAND}\n")
+    return children
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_all_cfgs_matches_make(children_dir: pathlib.Path, jobs: str):
+    """
+    expand --all-cfgs writes the same files that RULES_EXPAND does.
+    """
+    with pushd(children_dir):
+        subprocess.run(["make", "expand"], check=True, capture_output=True)
+        with cli_args(
+            ["expand", "--all-cfgs", ".", "--build-top", "batch", "--jobs", jobs]
+        ):
+            assert main() == 0
+
+    make_dir = children_dir / "build" / "iocBoot"
+    batch_dir = children_dir / "batch" / "iocBoot"
+    for num in "123":
+        ioc_name = f"ioc-tst-unittest{num}"
+        batch_files = sorted(p.name for p in (batch_dir / ioc_name).iterdir())
+        assert batch_files
+        for name in batch_files:
+            expected = (make_dir / ioc_name / name).read_text()
+            # TOP is the absolute build directory, which differs on purpose
+            expected = expected.replace(str(make_dir.parent), str(batch_dir.parent))
+            assert (batch_dir / ioc_name / name).read_text() == expected
+        assert (batch_dir / ioc_name / "st.cmd").stat().st_mode & 0o111
+
+
+def test_batch_manifest(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    """
+    Jobs run from a manifest, and a failed job makes the exit status nonzero.
+    """
+    cfg = tmp_path / "ioc-batch.cfg"
+    cfg.write_text("NAME=batch\n")
+    template = tmp_path / "template.txt"
+    template.write_text("$$NAME $$IOCNAME\n")
+    manifest = tmp_path / "manifest.json"
+    summary = tmp_path / "summary.json"
+    jobs = [
+        {
+            "cfg": str(cfg),
+            "template": str(template),
+            "output": str(tmp_path / "out" / f"{n}.txt"),
+            "statements": [f"IOCNAME=ioc{n}"],
+        }
+        for n in range(3)
+    ]
+    jobs.append(
+        {
+            "cfg": str(cfg),
+            "template": str(tmp_path / "missing.txt"),
+            "output": str(tmp_path / "out" / "missing.txt"),
+        }
+    )
+    manifest.write_text(json.dumps({"jobs": jobs}))
+
+    with cli_args(["expand", "--batch", str(manifest), "--summary", str(summary)]):
+        assert main() == 1
+
+    for n in range(3):
+        assert (tmp_path / "out" / f"{n}.txt").read_text() == f"batch ioc{n}\n"
+    results = json.loads(summary.read_text())
+    assert [r["error"] is None for r in results] == [True, True, True, False]
+    assert "4 jobs, 1 failed" in capsys.readouterr().out
+
+
+def test_template_store(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    Templates and the files they include are served from the store, even
+    after they are gone from the disk.
+    """
+    import expand
+    import expand_io
+    import expand_store
+
+    (tmp_path / "template").write_text("a $$NAME\n$$INCLUDE(inc1.txt)\nb\n")
+    (tmp_path / "inc1.txt").write_bytes(b"one\r\n$$INCLUDE( inc2.txt)\n")
+    (tmp_path / "inc2.txt").write_text("two $$NAME é\nend", encoding="utf-8")
+    store = tmp_path / "templates.store"
+    with pushd(tmp_path):
+        fetch = expand_io.prefetcher(["template", "missing.txt"])
+        files = fetch.files()
+        fetch.close()
+        assert sorted(files) == ["inc1.txt", "inc2.txt", "template"]
+        expand_store.write_store(store, files)
+    for name in files:
+        (tmp_path / name).unlink()
+
+    monkeypatch.setattr(expand, "include_store", None)
+    expand_store.attach(str(store))
+    lines, path, _ = expand.include_store.get("inc1.txt")
+    assert lines == ["one\n", "$$INCLUDE( inc2.txt)\n"]
+    assert path == "inc1.txt"
+    # Sliced from the mapping each time, not kept by the worker.
+    assert expand.include_store.get("inc1.txt")[0] is not lines
+    assert expand.include_store.get("inc2.txt")[0] == ["two $$NAME é\n", "end"]
+    assert expand.include_store.get("missing.txt") is None
+
+    cfg = expand.config()
+    cfg.ddict["NAME"] = "x"
+    out = io.StringIO()
+    expand.expand(cfg, expand.include_store.get("template")[0], out)
+    assert out.getvalue() == "a x\none\ntwo x é\nendb\n"
+    expand.include_store.close()
+
+
+def test_template_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    A cached template is read again once the file changes.
+    """
+    import expand_batch
+
+    monkeypatch.setattr(expand_batch, "template_cache", {})
+    template = tmp_path / "template"
+    template.write_text("one\n")
+    assert expand_batch.read_template(str(template)) == ["one\n"]
+    assert expand_batch.read_template(str(template)) == ["one\n"]
+    template.write_text("one\ntwo\n")
+    assert expand_batch.read_template(str(template)) == ["one\n", "two\n"]
+    assert expand_batch.read_template(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.parametrize("share", [True, False])
+def test_batch_workers(tmp_path: pathlib.Path, capsys, share: bool):
+    """
+    Jobs on several workers give the same output with or without the shared
+    store, and the summary reports per-worker memory and the first output.
+    """
+    (tmp_path / "inc.txt").write_text("included $$IOCNAME\n")
+    template = tmp_path / "template.txt"
+    template.write_text("$$NAME\n$$INCLUDE(inc.txt)\n")
+    jobs = []
+    for n in range(4):
+        cfg = tmp_path / f"ioc{n}.cfg"
+        cfg.write_text(f"NAME=cfg{n}\n")
+        jobs.append(
+            {
+                "cfg": str(cfg),
+                "template": str(template),
+                "output": str(tmp_path / "out" / f"{n}.txt"),
+                "statements": [f"IOCNAME=ioc{n}"],
+            }
+        )
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(jobs))
+    summary = tmp_path / "summary.json"
+    args = ["expand", "--batch", str(manifest), "--jobs", "2"]
+    args += ["--summary", str(summary)] + ([] if share else ["--no-store"])
+
+    with cli_args(args), pushd(tmp_path):
+        assert main() == 0
+
+    for n in range(4):
+        expected = f"cfg{n}\nincluded ioc{n}\n"
+        assert (tmp_path / "out" / f"{n}.txt").read_text() == expected
+    results = json.loads(summary.read_text())
+    assert all(r["maxrss_kb"] > 0 and r["since_start"] >= 0 for r in results)
+    assert "first output after" in capsys.readouterr().out
+
+
+class slow_fs:
+    """
+    A stand-in for a file system with a lot of latency, which counts how many
+    reads are in progress at once.
+    """
+
+    def __init__(self, delay: float):
+        import expand_io
+
+        self.local = expand_io.local_fs()
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.reading = 0
+        self.most_reading = 0
+        self.reads = []
+        self.writes = []
+
+    def read(self, name):
+        with self.lock:
+            self.reads.append(name)
+            self.reading += 1
+            self.most_reading = max(self.most_reading, self.reading)
+        time.sleep(self.delay)
+        with self.lock:
+            self.reading -= 1
+        return self.local.read(name)
+
+    def write(self, path, text, executable=False, if_changed=False):
+        time.sleep(self.delay)
+        self.writes.append(path)
+        self.local.write(path, text, executable, if_changed)
+
+
+def test_batch_pipeline(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    Templates and their includes are read concurrently and outputs are
+    written behind, in order, with a cap on the bytes waiting to be written.
+    """
+    import expand_batch
+    import expand_io
+
+    jobs = []
+    for n in range(6):
+        (tmp_path / f"inc{n}.txt").write_text(f"inc{n} $$NAME\n")
+        template = tmp_path / f"template{n}"
+        template.write_text(f"$$INCLUDE({tmp_path}/inc{n}.txt)\n" + "x" * 100)
+        job = expand_batch.job(
+            str(tmp_path / "ioc.cfg"), str(template), str(tmp_path / "out" / str(n))
+        )
+        jobs.append(job)
+    (tmp_path / "ioc.cfg").write_text("NAME=pipe\n")
+    monkeypatch.setattr(expand_batch, "template_cache", {})
+
+    fs = slow_fs(0.05)
+    peaks = []
+    close = expand_io.writer.close
+
+    def checked_close(self):
+        errors = close(self)
+        peaks.append(self.peak)
+        return errors
+
+    monkeypatch.setattr(expand_io, "max_pending", 250)
+    monkeypatch.setattr(expand_io.writer, "close", checked_close)
+    results = expand_batch.run_jobs(jobs, 1, fs=fs)
+
+    assert [r["error"] for r in results] == [None] * 6
+    for n in range(6):
+        expected = f"inc{n} pipe\n" + "x" * 100
+        assert (tmp_path / "out" / str(n)).read_text() == expected
+    assert fs.writes == [j.output for j in jobs]
+    assert sorted(fs.reads) == sorted(
+        [j.template for j in jobs] + [f"{tmp_path}/inc{n}.txt" for n in range(6)]
+    )
+    assert fs.most_reading > 1
+    assert peaks and max(peaks) <= 250
+
+
+def test_batch_write_error(tmp_path: pathlib.Path):
+    """
+    An output that can't be written fails its job, and only its job.
+    """
+    import expand_batch
+
+    (tmp_path / "ioc.cfg").write_text("NAME=x\n")
+    (tmp_path / "template").write_text("$$NAME\n")
+    (tmp_path / "out").write_text("not a directory")
+    jobs = [
+        expand_batch.job(
+            str(tmp_path / "ioc.cfg"), str(tmp_path / "template"), str(output)
+        )
+        for output in [tmp_path / "out" / "1", tmp_path / "ok"]
+    ]
+    results = expand_batch.run_jobs(jobs, 1)
+    assert results[0]["error"] is not None
+    assert results[1]["error"] is None
+    assert (tmp_path / "ok").read_text() == "x\n"
+
+
+def test_local_fs_write(tmp_path: pathlib.Path):
+    """
+    Outputs are renamed into place, so a reader never sees half of one.
+    """
+    import expand_io
+
+    out = tmp_path / "out"
+    out.write_text("old\n")
+    os.link(out, tmp_path / "reader")
+    expand_io.local_fs().write(str(out), "new\n", executable=True)
+    assert out.read_text() == "new\n"
+    assert os.access(out, os.X_OK)
+    assert (tmp_path / "reader").read_text() == "old\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out", "reader"]
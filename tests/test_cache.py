@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import os
+import pathlib
+
+import expand
+import expand_cache
+from expand import main
+
+from .conftest import cli_args, pushd
+
+TEMPLATE = """\
+# $$IOCNAME
+$$LOOP(MOTOR)
+motor $$INDEX $$NAME prefix=$$PREFIX
+$$INCLUDE(motor.inc)
+$$ENDLOOP(MOTOR)
+"""
+
+
+def run(
+    cwd: pathlib.Path, cache: pathlib.Path, cfg: str, out: str, *statements: str
+) -> str:
+    args = ["expand", "--cache", str(cache), "-c", cfg, "template", out]
+    with cli_args(args + list(statements)), pushd(cwd):
+        assert main() == 0
+        return (cwd / out).read_text()
+
+
+def setup_ioc(d: pathlib.Path, prefix: str = "TST"):
+    d.mkdir(parents=True, exist_ok=True)
+    (d / "template").write_text(TEMPLATE)
+    (d / "motor.inc").write_text("include $$NAME\n")
+    (d / "common.cfg").write_text("PREFIX=%s\n" % prefix)
+    (d / "ioc.cfg").write_text("$$INCLUDE(common.cfg)\nMOTOR(NAME=a)\nMOTOR(NAME=b)\n")
+
+
+def stats(cache: pathlib.Path) -> tuple[int, int]:
+    s = expand_cache.output_cache(str(cache)).stats()
+    return s["hits"], s["misses"]
+
+
+def test_output_cache(tmp_path: pathlib.Path, monkeypatch, capsys):
+    """
+    Outputs come from the cache only while every file they were made from is
+    unchanged, and are shared between checkouts in different directories.
+    """
+    monkeypatch.setattr(expand, "loop_cache", None)
+    cache = tmp_path / "cache"
+    one = tmp_path / "one"
+    setup_ioc(one)
+    expected = run(one, cache, "ioc.cfg", "plain.out", "IOCNAME=x")
+    assert "motor 1 b prefix=TST\ninclude b\n" in expected
+    assert stats(cache) == (0, 1)
+
+    # A hit doesn't read the config at all.
+    def no_config(*args):
+        raise AssertionError("config read on a cache hit")
+
+    with monkeypatch.context() as m:
+        m.setattr(expand.config, "read_config", no_config)
+        assert run(one, cache, "ioc.cfg", "again.out", "IOCNAME=x") == expected
+    assert stats(cache) == (1, 1)
+
+    # Another checkout of the same IOC.
+    two = tmp_path / "two"
+    setup_ioc(two)
+    with monkeypatch.context() as m:
+        m.setattr(expand.config, "read_config", no_config)
+        assert run(two, cache, "ioc.cfg", "plain.out", "IOCNAME=x") == expected
+
+    # The statements, a file the cfg includes, and a file the template
+    # includes are all part of the key.
+    assert "# y\n" in run(one, cache, "ioc.cfg", "y.out", "IOCNAME=y")
+    (one / "common.cfg").write_text("PREFIX=NEW\n")
+    assert "prefix=NEW" in run(one, cache, "ioc.cfg", "new.out", "IOCNAME=x")
+    (one / "motor.inc").write_text("included $$NAME\n")
+    assert "included b" in run(one, cache, "ioc.cfg", "inc.out", "IOCNAME=x")
+    assert stats(cache) == (2, 4)
+
+    # Back to the original include: that entry is still in the manifest.
+    (one / "common.cfg").write_text("PREFIX=TST\n")
+    (one / "motor.inc").write_text("include $$NAME\n")
+    assert run(one, cache, "ioc.cfg", "old.out", "IOCNAME=x") == expected
+    assert stats(cache) == (3, 4)
+
+    capsys.readouterr()
+    with cli_args(["expand", "--cache", str(cache), "--cache-stats"]):
+        assert main() == 0
+    assert "hit rate         42.9%" in capsys.readouterr().out
+
+
+def test_output_cache_cwd(tmp_path: pathlib.Path, monkeypatch):
+    """
+    Outputs that use PATH or DIRNAME are only shared within one directory,
+    and outputs that printed something aren't cached.
+    """
+    monkeypatch.setattr(expand, "loop_cache", None)
+    cache = tmp_path / "cache"
+    for name in ("one", "two"):
+        setup_ioc(tmp_path / name)
+        (tmp_path / name / "template").write_text("dir $$DIRNAME\n")
+    assert run(tmp_path / "one", cache, "ioc.cfg", "o") == "dir one\n"
+    assert run(tmp_path / "two", cache, "ioc.cfg", "o") == "dir two\n"
+    assert run(tmp_path / "two", cache, "ioc.cfg", "o") == "dir two\n"
+    assert stats(cache) == (1, 2)
+
+    (tmp_path / "one" / "template").write_text("$$INCLUDE(missing.inc)\n")
+    run(tmp_path / "one", cache, "ioc.cfg", "o")
+    run(tmp_path / "one", cache, "ioc.cfg", "o")
+    assert stats(cache) == (1, 4)
+
+
+def test_output_cache_closer_include(tmp_path: pathlib.Path, monkeypatch):
+    """
+    An entry doesn't apply once an include (of the template or the cfg)
+    turns up earlier in the search path than the one it was made with.
+    """
+    monkeypatch.setattr(expand, "loop_cache", None)
+    monkeypatch.delenv("EXPAND_PATH", raising=False)
+    cache = tmp_path / "cache"
+    sub = tmp_path / "top" / "sub"
+    sub.mkdir(parents=True)
+    (sub / "template").write_text("$$INCLUDE(inc.txt)\n$$VALUE\n")
+    (sub / "ioc.cfg").write_text("$$INCLUDE(common.cfg)\n")
+    (tmp_path / "top" / "inc.txt").write_text("FROM PARENT\n")
+    (tmp_path / "top" / "common.cfg").write_text("VALUE=parent\n")
+    assert run(sub, cache, "ioc.cfg", "o") == "FROM PARENT\nparent\n"
+    assert run(sub, cache, "ioc.cfg", "o") == "FROM PARENT\nparent\n"
+    assert stats(cache) == (1, 1)
+
+    (sub / "inc.txt").write_text("FROM LOCAL\n")
+    assert run(sub, cache, "ioc.cfg", "o") == "FROM LOCAL\nparent\n"
+    (sub / "common.cfg").write_text("VALUE=local\n")
+    assert run(sub, cache, "ioc.cfg", "o") == "FROM LOCAL\nlocal\n"
+    assert stats(cache) == (1, 3)
+
+
+def test_output_cache_eviction(tmp_path: pathlib.Path):
+    """
+    A subdirectory over its share of the size limit loses its least recently
+    used files.
+    """
+    cache = expand_cache.output_cache(str(tmp_path), size=16 * 1000)
+    sub = tmp_path / "a"
+    sub.mkdir()
+    for i in range(10):
+        path = sub / ("a%d.out" % i)
+        path.write_bytes(b"x" * 300)
+        os.utime(path, (i, i))
+    cache.clean("a")
+    assert sorted(p.name for p in sub.iterdir()) == ["a7.out", "a8.out", "a9.out"]
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import shutil
+
+from expand import main
+
+from .conftest import cli_args, pushd
+
+TEMPLATE = """\
+$$PATH $$DIRNAME $$IOCNAME $$BASE
+$$LOOP(MOTOR)
+$$NAME
+$$ENDLOOP(MOTOR)
+$$INCLUDE(../inc.txt)
+$$OUTPUT(extra.txt)
+extra $$IOCNAME
+$$ENDOUTPUT(extra.txt)
+"""
+
+
+def test_capture_replay(tmp_path: pathlib.Path, monkeypatch, capsys):
+    """
+    A captured run replays from the corpus alone, with the same paths and
+    the same outputs, and a changed input is reported.
+    """
+    release = tmp_path / "release"
+    (release / "iocBoot" / "templates").mkdir(parents=True)
+    (release / "common.cfg").write_text("BASE=X\n")
+    template = release / "iocBoot" / "templates" / "st.cmd"
+    template.write_text(TEMPLATE)
+    children = tmp_path / "hutch" / "children"
+    (children / "build").mkdir(parents=True)
+    (tmp_path / "hutch" / "inc.txt").write_text("included\n")
+    (children / "ioc-a.cfg").write_text(
+        "RELEASE=%s\n$$INCLUDE(%s/common.cfg)\nMOTOR(NAME=m1)\n" % (release, release)
+    )
+    corpus = tmp_path / "corpus"
+    with pushd(children):
+        args = ["expand", "--capture", str(corpus), "-c", "ioc-a.cfg"]
+        with cli_args(args + [str(template), "build/st.cmd", "IOCNAME=ioc-a"]):
+            assert main() == 0
+        monkeypatch.setenv("EXPAND_CAPTURE", str(corpus))
+        with cli_args(["expand", "-c", "ioc-a.cfg", "BASE"]):
+            assert main() == 0
+        monkeypatch.delenv("EXPAND_CAPTURE")
+    assert capsys.readouterr().err == (
+        "expand: capturing to %s (EXPAND_CAPTURE)\n" % corpus
+    )
+    assert (children / "build" / "st.cmd").read_text() == (
+        "%s children ioc-a X\nm1\nincluded\n" % children
+    )
+    captures = sorted((corpus / "captures").iterdir())
+    assert len(captures) == 2
+    manifests = [json.loads(c.read_text()) for c in captures]
+    run = next(m for m in manifests if len(m["argv"]) > 3)
+    assert run["cwd"] == str(children)
+    inc = tmp_path / "hutch" / "inc.txt"
+    assert sorted(run["files"]) == sorted(
+        str(p) for p in (children / "ioc-a.cfg", release / "common.cfg", template, inc)
+    )
+    assert sorted(run["outputs"]) == [
+        str(children / "build" / "extra.txt"),
+        str(children / "build" / "st.cmd"),
+    ]
+
+    # Nothing outside the corpus is needed.
+    shutil.rmtree(release)
+    shutil.rmtree(tmp_path / "hutch")
+    capsys.readouterr()
+    with cli_args(["expand", "--replay", str(corpus), "--repeat", "2"]):
+        assert main() == 0
+    out = capsys.readouterr().out
+    assert "2 captures, 0 mismatched" in out
+    assert out.count("\nok ") == 2
+
+    blob = corpus / "files" / run["files"][str(inc)]
+    blob.write_text("something else\n")
+    with cli_args(["expand", "--replay", str(corpus)]):
+        assert main() == 1
+    out = capsys.readouterr().out
+    assert "differs: %s" % (children / "build" / "st.cmd") in out
+    assert "2 captures, 1 mismatched" in out
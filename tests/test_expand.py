@@ -1,12 +1,14 @@
+import json
 import os
 import pathlib
 import re
 
 import pytest
 
+import expand
 from expand import main
 
-from .conftest import ON_CDS_NFS, cli_args
+from .conftest import ON_CDS_NFS, cli_args, pushd
 
 
 def get_release_dir(config_file: pathlib.Path) -> str:
@@ -295,3 +297,216 @@ def test_expand_preprocessing(
         outerr = capsys.readouterr()
 
     assert outerr.out.strip() == config_vars[config_var]
+
+
+def test_expand_several_outputs(tmp_path: pathlib.Path):
+    """
+    expand -c CFG -o TEMPLATE OUTPUT -o ... renders each template as if it
+    had been expanded on its own, and -O writes a stub for missing templates.
+    """
+    cfg_file = tmp_path / "several.cfg"
+    with open(cfg_file, "w") as fd:
+        fd.write("COUNTER=1\nNAME=several\n")
+    first = tmp_path / "first.txt"
+    with open(first, "w") as fd:
+        fd.write("$$ASSIGN{COUNTER,COUNTER+1}\n$$NAME $$COUNTER\n")
+    second = tmp_path / "second.txt"
+    with open(second, "w") as fd:
+        fd.write("$$IOCNAME $$COUNTER\n")
+    missing = tmp_path / "missing.cmd"
+
+    with cli_args(
+        [
+            "expand",
+            "-c",
+            str(cfg_file),
+            "-o",
+            str(first),
+            str(tmp_path / "first.out"),
+            "-o",
+            str(second),
+            str(tmp_path / "second.out"),
+            "-O",
+            str(missing),
+            str(tmp_path / "missing.out"),
+            "IOCNAME=ioc-several",
+        ]
+    ):
+        assert main() == 0
+
+    assert (tmp_path / "first.out").read_text() == "several 2\n"
+    # The $$ASSIGN in the first template must not leak into the second
+    assert (tmp_path / "second.out").read_text() == "ioc-several 1\n"
+    assert (tmp_path / "missing.out").read_text() == (
+        f"#!/bin/sh\necho No {missing} found!\n"
+    )
+
+
+def test_expand_query(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    """
+    --get and --dump json answer for several keys and configs in one run.
+    """
+    for name, arch in (("one", "linux-x86_64"), ("two", "rhel7-x86_64")):
+        with open(tmp_path / f"{name}.cfg", "w") as fd:
+            fd.write(f"RELEASE=/rel/{name}\nARCH={arch}\nIOC_PV=IOC:$$ARCH\n")
+            fd.write("EVR(NAME=EVR:01,TYPE=PMC)\n")
+    one = str(tmp_path / "one.cfg")
+    two = str(tmp_path / "two.cfg")
+
+    with cli_args(["expand", "-c", one, "--get", "RELEASE", "IOC_PV"]):
+        assert main() == 0
+    assert capsys.readouterr().out == "RELEASE=/rel/one\nIOC_PV=IOC:linux-x86_64\n"
+
+    with cli_args(["expand", "-c", one, "-c", two, "--get", "ARCH", "EVRNAME0"]):
+        assert main() == 0
+    assert capsys.readouterr().out == (
+        f"{one}:ARCH=linux-x86_64\n{one}:EVRNAME0=EVR:01\n"
+        f"{two}:ARCH=rhel7-x86_64\n{two}:EVRNAME0=EVR:01\n"
+    )
+    # Each value matches the single-NAME form
+    with cli_args(["expand", "-c", two, "IOC_PV"]):
+        assert main() == 0
+    assert capsys.readouterr().out == "IOC:rhel7-x86_64\n"
+
+    with cli_args(["expand", "-c", one, "-c", two, "--dump", "json"]):
+        assert main() == 0
+    dump = json.loads(capsys.readouterr().out)
+    assert list(dump) == [one, two]
+    assert dump[two]["variables"]["IOC_PV"] == "IOC:rhel7-x86_64"
+    assert dump[two]["instances"]["EVR"] == [
+        {"INDEX": "0", "NAME": "EVR:01", "TYPE": "PMC"}
+    ]
+
+    with cli_args(["expand", "-c", one, "-c", "missing.cfg", "--get", "ARCH"]):
+        assert main() == 1
+    captured = capsys.readouterr()
+    assert captured.out == f"{one}:ARCH=linux-x86_64\n"
+    assert "missing.cfg" in captured.err
+
+
+def test_expand_query_diagnostics(tmp_path: pathlib.Path, capsys):
+    """
+    What read_config complains about goes to stderr, not into the JSON.
+    """
+    cfg = tmp_path / "bad.cfg"
+    cfg.write_text("RELEASE=/rel\n$$INCLUDE(nope.inc)\n$$junk\nARCH=x\n")
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "bad.cfg", "--dump", "json"]):
+            assert main() == 0
+        captured = capsys.readouterr()
+        dump = json.loads(captured.out)
+        assert dump["bad.cfg"]["variables"]["ARCH"] == "x"
+        assert "nope.inc" in captured.err
+        with cli_args(["expand", "-c", "bad.cfg", "--get", "RELEASE"]):
+            assert main() == 0
+        assert capsys.readouterr().out == "RELEASE=/rel\n"
+
+
+LAZY_CONFIGS = {
+    "oldstyle.cfg": (
+        "RELEASE=/reg/g/pcds/epics/ioc/common/ipimb/R2.0.17\n"
+        "ARCH=linux-x86\n"
+        "# ENGINEER=nobody\n"
+        "ENGINEER=Some Body\n"
+        "IOC_PV=IOC:$$ARCH:$$LOCATION\n"
+        "EVR(NAME=$$IOC_PV:EVR,TYPE=PMC)\n"
+        "LOCATION = 'MEC:R64A:24'\n"
+        "IPIMB(NAME=MEC:XT2:IPM:02,PORT=/dev/ttyPS3,EVR0)\n"
+        "ARCH rhel7-x86_64\n"
+        'DIRNAME="$$DIRNAME-$$PATH"\n'
+    ),
+    "newstyle.cfg": (
+        "$$INCLUDE(common.inc)\n"
+        'RELEASE    "$$TOP/ipimb/R2.0.17"\n'
+        "IOC_PV     IOC:MEC:IMB02\n"
+        "PV2=$$IOC_PV:$$(TOP)x$$UNDEFINED\n"
+        "INSTANCE EVR\n"
+        "    NAME       MEC:XT2:EVR:01\n"
+        "    IOC_PV     ignored\n"
+        "RELEASE=ignored\n"
+    ),
+    # Not handled lazily: these have to fall back to read_config
+    "keyword.cfg": "A=1\n$$IF(A)\nRELEASE=/one\n$$ELSE(A)\nRELEASE=/two\n$$ENDIF(A)\n",
+    "computed.cfg": "N=RELEASE\n$$N=/computed\nRELEASE=/plain\n",
+    "named.cfg": "inc=common.inc\n$$INCLUDE(inc)\n",
+}
+
+
+@pytest.mark.parametrize("cfg_name", list(LAZY_CONFIGS))
+def test_lazy_query(tmp_path: pathlib.Path, cfg_name: str, capsys, monkeypatch):
+    """
+    expand -c CONFIG NAME gives the same answer with and without EXPAND_LAZY.
+    """
+    (tmp_path / "common.inc").write_text("TOP=/reg/common\nRELEASE=/from/include\n")
+    for name, text in LAZY_CONFIGS.items():
+        (tmp_path / name).write_text(text)
+    names = set(re.findall(r"[A-Za-z_][A-Za-z0-9_:]*", LAZY_CONFIGS[cfg_name]))
+    names |= {"PATH", "EVRNAME0", "IPIMBPORT0", "EVR0:TYPE", "UNDEFINED"}
+    for name in sorted(names):
+        results = []
+        for lazy in ("1", "0"):
+            monkeypatch.setenv("EXPAND_LAZY", lazy)
+            with cli_args(["expand", "-c", cfg_name, name]), pushd(tmp_path):
+                assert main() == 0
+            results.append(capsys.readouterr().out)
+        assert results[0] == results[1], name
+
+    with pushd(tmp_path):
+        lazy = expand.config().read_value(cfg_name, "RELEASE")
+    if cfg_name.startswith(("oldstyle", "newstyle")):
+        assert lazy is not None
+    else:
+        assert lazy is None
+
+
+BASE_CONFIGS = {
+    "common.cfg": (
+        "# The hutch\nHUTCH=xpp\nDEBUG=0\nEVR(NAME=evr1,BASE=XPP:EVR:01)\n"
+        "ev2: EVR(NAME=evr2)\nnot a definition (\n"
+    ),
+    "newstyle.cfg": "A=1\nINSTANCE MOTOR m0\n  NAME=zero\n",
+    "child.cfg": (
+        "\n# Child\n$$INCLUDE(common.cfg)\nDEBUG=1\nPREFIX=$$HUTCH:$$DEBUG\n"
+        "EVR(NAME=evr3,BASE=$$HUTCH:EVR:03)\nCAM(NAME=c1,EVR=ev2)\n"
+    ),
+    "sibling.cfg": "$$INCLUDE(common.cfg)\nHUTCH=mfx\n",
+    "open.cfg": "$$INCLUDE(newstyle.cfg)\n  PORT=$$A\nINSTANCE MOTOR m1\nA=2\n",
+}
+
+
+def test_base_config(tmp_path: pathlib.Path, capsys, monkeypatch):
+    """
+    Configs that start by including a file without $$ in it share one parse
+    of that file, and come out just as if they had each parsed it.
+    """
+    for name, text in BASE_CONFIGS.items():
+        (tmp_path / name).write_text(text)
+    monkeypatch.setattr(expand, "base_configs", {})
+
+    def read(name, extra, base=True):
+        cfg = expand.config()
+        with pushd(tmp_path):
+            if base:
+                cfg.read_config(name, extra)
+            else:
+                with monkeypatch.context() as m:
+                    m.setattr(expand.config, "find_base", lambda *args: None)
+                    cfg.read_config(name, extra)
+        return cfg.ddict, cfg.idict, capsys.readouterr().out
+
+    for name in ("child.cfg", "sibling.cfg", "open.cfg"):
+        for extra in ([], ["IOCNAME=ioc-tst", "HUTCH=cxi"]):
+            expected = read(name, extra, base=False)
+            assert read(name, extra) == expected
+            assert read(name, extra) == expected
+    assert len(expand.base_configs) == 2
+    assert read("child.cfg", [])[0]["PREFIX"] == "xpp:1"
+    assert read("sibling.cfg", [])[0]["HUTCH"] == "mfx"
+    motors = read("open.cfg", [])[1]["MOTOR"]
+    assert [m["INDEX"] for m in motors] == ["0", "1"]
+    assert motors[0]["PORT"] == "1"
+    assert "PORT" not in expand.base_configs[BASE_CONFIGS["newstyle.cfg"]].state[3]
+
+    # An edit to the included file is seen.
+    (tmp_path / "common.cfg").write_text("HUTCH=mec\n")
+    assert read("child.cfg", [])[0]["PREFIX"] == "mec:1"
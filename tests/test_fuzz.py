@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import pathlib
+
+import pytest
+
+from . import fuzz_expand
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_fuzz(tmp_path: pathlib.Path, seed: int):
+    """
+    Every engine variant expands random inputs exactly like the reference.
+    Timing is left to tests/fuzz_expand.py, as it is too noisy for here.
+    """
+    mismatches, _ = fuzz_expand.fuzz(
+        seed, 40, ["current", "scalar", "batch", "cached", "partial"], 1.5, tmp_path
+    )
+    assert [(name, c.describe()) for name, c in mismatches] == []
+
+
+def test_shrink():
+    """
+    Shrinking keeps the failure while removing everything it doesn't need.
+    """
+    c = fuzz_expand.case(
+        {"template": "a\n$$LOOP(X)\nbad\n$$ENDLOOP(X)\nb\n", "fuzz.cfg": "A=1\n"},
+        [],
+        [],
+    )
+    small = fuzz_expand.shrink(c, lambda x: "bad" in x.files["template"])
+    assert small.files == {"template": "bad", "fuzz.cfg": ""}
@@ -0,0 +1,160 @@
+"""
+Tests for the make jobserver client used by expand --batch, against a fake
+jobserver: a pipe (or fifo) holding the tokens.
+"""
+
+import json
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import expand_batch
+import expand_jobserver
+from expand import main
+
+from .conftest import cli_args
+
+
+def test_parse_makeflags():
+    parse = expand_jobserver.parse_makeflags
+    assert parse("") is None
+    assert parse("-j4") is None
+    assert parse(" -j4 --jobserver-auth=3,4") == ("pipe", 3, 4)
+    assert parse(" -j4 --jobserver-fds=5,6 -j") == ("pipe", 5, 6)
+    assert parse("-j4 --jobserver-auth=fifo:/tmp/GMfifo1") == ("fifo", "/tmp/GMfifo1")
+    assert parse("--jobserver-auth=3,4 --jobserver-auth=fifo:x") == ("fifo", "x")
+
+
+def tokens_left(rfd: int) -> int:
+    os.set_blocking(rfd, False)
+    try:
+        return len(os.read(rfd, 100))
+    except BlockingIOError:
+        return 0
+
+
+@pytest.fixture(params=["pipe", "fifo"])
+def fake_jobserver(request, tmp_path: pathlib.Path):
+    """
+    A jobserver with two tokens (so three slots, counting the implicit one),
+    as (MAKEFLAGS, the read end).
+    """
+    if request.param == "pipe":
+        r, w = os.pipe()
+        makeflags = " -j3 --jobserver-auth=%d,%d" % (r, w)
+    else:
+        fifo = str(tmp_path / "GMfifo")
+        os.mkfifo(fifo)
+        r = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        w = os.open(fifo, os.O_WRONLY)
+        makeflags = " -j3 --jobserver-auth=fifo:%s" % fifo
+    os.write(w, b"++")
+    yield makeflags, r
+    os.close(r)
+    os.close(w)
+
+
+def test_schedule(fake_jobserver):
+    """
+    No more units run at once than there are job slots, the implicit slot is
+    used again once its first unit is done, and every token is given back.
+    """
+    makeflags, r = fake_jobserver
+    js = expand_jobserver.from_makeflags(makeflags)
+    lock = threading.Lock()
+    now = [0]
+    most = [0]
+    most_later = [0]  # After the first unit, in the implicit slot, is done.
+    first_done = threading.Event()
+
+    def run(unit):
+        with lock:
+            now[0] += 1
+            most[0] = max(most[0], now[0])
+            if first_done.is_set():
+                most_later[0] = max(most_later[0], now[0])
+        # Unit 1 holds a token for as long as the rest take on one slot.
+        time.sleep({0: 0.005, 1: 0.3}.get(unit, 0.02))
+        with lock:
+            now[0] -= 1
+        if unit == 0:
+            first_done.set()
+        return unit * 2
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = expand_batch.schedule(pool, run, list(range(12)), 8, js)
+    js.close()
+    assert results == [n * 2 for n in range(12)]
+    assert most[0] == 3
+    assert most_later[0] == 3
+    assert tokens_left(r) == 2
+
+
+def test_batch_under_make(tmp_path: pathlib.Path, fake_jobserver, monkeypatch):
+    """
+    expand --batch takes job slots from make, and gives them all back.
+    """
+    makeflags, r = fake_jobserver
+    monkeypatch.setenv("MAKEFLAGS", makeflags)
+    cfg = tmp_path / "ioc.cfg"
+    cfg.write_text("NAME=batch\n")
+    template = tmp_path / "template.txt"
+    template.write_text("$$NAME $$IOCNAME\n")
+    jobs = [
+        {
+            "cfg": str(cfg),
+            "template": str(template),
+            "output": str(tmp_path / "out" / f"{n}.txt"),
+            "statements": [f"IOCNAME=ioc{n}"],
+        }
+        for n in range(6)
+    ]
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(jobs))
+    with cli_args(["expand", "--batch", str(manifest), "--jobs", "4"]):
+        assert main() == 0
+    for n in range(6):
+        assert (tmp_path / "out" / f"{n}.txt").read_text() == f"batch ioc{n}\n"
+    assert tokens_left(r) == 2
+
+
+def test_jobserver_unavailable():
+    """
+    A jobserver whose descriptors weren't passed down means one job.
+    """
+    r, w = os.pipe()
+    os.close(r)
+    os.close(w)
+    js = expand_jobserver.from_makeflags("-j8 --jobserver-auth=%d,%d" % (r, w))
+    assert js is False
+    assert expand_jobserver.from_makeflags("-j8") is None
+
+
+def test_schedule_jobserver_gone():
+    """
+    A jobserver that has gone away leaves only the implicit slot.
+    """
+    r, w = os.pipe()
+    os.close(w)
+    js = expand_jobserver.client(r, -1, (r,))
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = expand_batch.schedule(pool, lambda n: n + 1, [1, 2, 3], 4, js)
+    js.close()
+    assert results == [2, 3, 4]
+    assert js.eof
+
+
+def test_serial_make():
+    """
+    Under make with no jobserver, only an unlimited -j allows more workers.
+    """
+    serial = expand_jobserver.serial_make
+    assert not serial({})
+    assert serial({"MAKELEVEL": "1", "MAKEFLAGS": "s"})
+    assert serial({"MAKELEVEL": "1", "MAKEFLAGS": "s -j1"})
+    assert not serial({"MAKELEVEL": "1", "MAKEFLAGS": "s -j"})
+    assert not serial({"MAKELEVEL": "1", "MAKEFLAGS": " -j3 --jobserver-auth=3,4"})
@@ -2,10 +2,13 @@
 Unit tests for individual supported keywords in expand.py
 """
 
+import io
+import os
 import pathlib
 
 import pytest
 
+import expand
 from expand import main
 
 from .conftest import cli_args, pushd
@@ -72,3 +75,396 @@ def test_standard_up_path(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture)
             outerr = capsys.readouterr()
 
     assert outerr.out.strip() == f"{tmp_path.parent}"
+
+
+SIMPLE_LOOPS = [
+    '$$LOOP(600)\nrecord(ai, "$$P:CH$$INDEX") { $$CALC{INDEX*4+BASE,%04x} }\n'
+    "$$ENDLOOP(600)\n",
+    "$$LOOP(CH)\n$$NAME $$(PORT)$$MISSING 100%\t$$CALC{(INDEX+1)*SCALE}"
+    " $$CALC{INDEX%ZERO} $$CALC{BASE/(INDEX+1),%.3f} $$CALC{-INDEX^BASE&0xff}\n"
+    "$$CALC{INDEX if PORT else 7,%3d} $$CALC{2**INDEX} $$CALC{INDEX-BIG}"
+    " $$CALC{a b} $$CALC{~INDEX}\n$$ENDLOOP(CH)\n",
+    "$$LOOP(2)\n$$LOOP(40)\n$$INDEX1.$$INDEX $$CALC{INDEX1*40+INDEX}\n"
+    "$$ENDLOOP(40)\n$$ENDLOOP(2)\n",
+    # Not simple, always expanded the usual way
+    "$$LOOP(40)\n$$IF(INDEX,0)zero$$ELSE(INDEX)$$INDEX$$ENDIF(INDEX)\n$$ENDLOOP(40)\n",
+]
+
+
+@pytest.mark.parametrize("template", SIMPLE_LOOPS)
+def test_simple_loop(tmp_path: pathlib.Path, template: str, monkeypatch):
+    """
+    Long loops over simple bodies are rendered in one go, with exactly the
+    same output as expanding them an iteration at a time.
+    """
+    with open(tmp_path / "loops.cfg", "w") as fd:
+        fd.write("P=TST\nBASE=0x100\nSCALE=010\nZERO=0\nBIG=99999999999999999999\n")
+        for n in range(300):
+            fd.write("CH(NAME=ch%d,PORT=%s)\n" % (n, "" if n % 3 else n))
+    (tmp_path / "template").write_text(template)
+
+    outputs = []
+    for threshold, numpy_threshold in ((10**9, 0), (0, 10**9), (0, 0)):
+        monkeypatch.setattr(expand.simple_loop, "threshold", threshold)
+        monkeypatch.setattr(expand.simple_loop, "numpy_threshold", numpy_threshold)
+        with cli_args(["expand", "-c", "loops.cfg", "template", "out"]):
+            with pushd(tmp_path):
+                assert main() == 0
+        outputs.append((tmp_path / "out").read_text())
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert outputs[0].count("\n") >= 40
+
+
+def test_simple_loop_bodies(monkeypatch):
+    """
+    The parsed loop bodies are dropped once there are too many of them, so
+    a long --watch session doesn't keep every version of its templates.
+    """
+    monkeypatch.setattr(expand.simple_loop, "bodies", {})
+    monkeypatch.setattr(expand.simple_loop, "max_bodies", 3)
+    for n in range(10):
+        assert expand.simple_loop.get(["%d $$NAME\n" % n]) is not None
+        assert len(expand.simple_loop.bodies) <= 3
+
+
+def test_include_nesting(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    """
+    $$INCLUDE chains can nest far deeper than Python's recursion limit, up to
+    --max-depth, and recursive $$INCLUDEs are reported instead of crashing.
+    """
+    depth = 1500
+    for n in range(depth):
+        (tmp_path / f"inc{n}.txt").write_text(f"{n}\n$$INCLUDE(inc{n + 1}.txt)\n")
+    (tmp_path / f"inc{depth}.txt").write_text("bottom\n")
+    (tmp_path / "nest.cfg").write_text("A=1\n")
+    (tmp_path / "loop.txt").write_text("a\n$$IF(A)\n$$INCLUDE(loop2.txt)\n$$ENDIF(A)\n")
+    (tmp_path / "loop2.txt").write_text("b\n$$INCLUDE(loop.txt)\n")
+
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "nest.cfg", "inc0.txt", "out"]):
+            assert main() == 0
+        assert (tmp_path / "out").read_text().splitlines()[-2:] == ["1499", "bottom"]
+
+        args = ["expand", "--max-depth", "100", "-c", "nest.cfg", "inc0.txt", "out"]
+        with cli_args(args):
+            assert main() == 1
+        assert "more than 100 levels deep in inc99.txt <- " in capsys.readouterr().out
+
+        with cli_args(["expand", "-c", "nest.cfg", "loop.txt", "out"]):
+            assert main() == 1
+        assert capsys.readouterr().out == (
+            "Recursive $$INCLUDE(loop2.txt): loop2.txt <- loop.txt <- loop2.txt\n"
+        )
+    assert expand.nesting == 0 and expand.including == {}
+
+
+OUTPUT_TEMPLATE = """\
+# st.cmd for $$IOCNAME
+$$LOOP(MOTOR)
+dbLoadRecords("motor.db", "M=$$NAME")
+$$OUTPUT($$IOCNAME.sub-req)
+$$NAME.req
+$$ENDOUTPUT($$IOCNAME.sub-req)
+$$OUTPUT(archive)
+$$NAME.RBV 1 monitor
+$$ENDOUTPUT(archive)
+$$ENDLOOP(MOTOR)
+iocInit()
+"""
+
+
+def test_output(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    $$OUTPUT(NAME) blocks go to their own files, next to the output or where
+    --output-map puts them, and those are only rewritten when they change.
+    """
+    monkeypatch.setattr(expand, "output_map", {})
+    (tmp_path / "ioc.cfg").write_text("MOTOR(NAME=m1)\nMOTOR(NAME=m2)\n")
+    (tmp_path / "template").write_text(OUTPUT_TEMPLATE)
+    args = ["expand", "--output-map", f"archive={tmp_path}/arch/ioc.archive"]
+    args += ["-c", str(tmp_path / "ioc.cfg"), str(tmp_path / "template")]
+    args += [str(tmp_path / "st.cmd"), "IOCNAME=ioc-out"]
+
+    with cli_args(args), pushd(tmp_path):
+        assert main() == 0
+    assert (tmp_path / "st.cmd").read_text() == (
+        "# st.cmd for ioc-out\n"
+        'dbLoadRecords("motor.db", "M=m1")\n'
+        'dbLoadRecords("motor.db", "M=m2")\n'
+        "iocInit()\n"
+    )
+    req = tmp_path / "ioc-out.sub-req"
+    archive = tmp_path / "arch" / "ioc.archive"
+    assert req.read_text() == "m1.req\nm2.req\n"
+    assert archive.read_text() == "m1.RBV 1 monitor\nm2.RBV 1 monitor\n"
+
+    req.write_text("m1.req\nm2.req\n")
+    past = req.stat().st_mtime_ns - 10**9
+    os.utime(req, ns=(past, past))
+    archive.write_text("stale\n")
+    with cli_args(args), pushd(tmp_path):
+        assert main() == 0
+    assert req.stat().st_mtime_ns == past
+    assert archive.read_text() == "m1.RBV 1 monitor\nm2.RBV 1 monitor\n"
+
+
+BUDGET_TEMPLATE = """\
+# $$NCHAN channels
+$$IF(NCHAN)
+$$LOOP(NCHAN)
+chan $$INDEX
+$$INCLUDE(chan.inc)
+$$ENDLOOP(NCHAN)
+$$ENDIF(NCHAN)
+"""
+
+
+@pytest.mark.parametrize(
+    "option, value, nchan, message",
+    [
+        (
+            "--max-iterations",
+            "1000",
+            "1000000000",
+            "template:3: More than 1000 $$LOOP iterations (--max-iterations)\n",
+        ),
+        (
+            "--max-include-depth",
+            "1",
+            "2",
+            "chan.inc:2: $$INCLUDEs nested more than 1 deep (--max-include-depth)\n",
+        ),
+        (
+            "--max-output-bytes",
+            "100",
+            "20",
+            "More than 100 bytes of output (--max-output-bytes)\n",
+        ),
+    ],
+)
+def test_budgets(
+    tmp_path: pathlib.Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    option: str,
+    value: str,
+    nchan: str,
+    message: str,
+):
+    """
+    Going over a budget stops the expansion at once, says where, and leaves
+    no partial output behind.  The budgets can also be set in the environment.
+    """
+    (tmp_path / "ioc.cfg").write_text("NCHAN=%s\n" % nchan)
+    (tmp_path / "template").write_text(BUDGET_TEMPLATE)
+    (tmp_path / "chan.inc").write_text("inc\n$$INCLUDE(leaf.inc)\n")
+    (tmp_path / "leaf.inc").write_text("leaf\n")
+    with pushd(tmp_path):
+        with cli_args(["expand", option, value, "-c", "ioc.cfg", "template", "out"]):
+            assert main() == 1
+        assert capsys.readouterr().out.endswith(message)
+        assert not (tmp_path / "out").exists()
+
+        monkeypatch.setenv("EXPAND_" + option[2:].upper().replace("-", "_"), value)
+        with cli_args(["expand", "-c", "ioc.cfg", "template", "out"]):
+            assert main() == 1
+        monkeypatch.delenv("EXPAND_" + option[2:].upper().replace("-", "_"))
+        (tmp_path / "ioc.cfg").write_text("NCHAN=1\n")
+        with cli_args(["expand", option, "1000", "-c", "ioc.cfg", "template", "out"]):
+            assert main() == 0
+        assert (tmp_path / "out").read_text() == "# 1 channels\nchan 0\ninc\nleaf\n"
+    assert expand.nesting == 0 and expand.including == {}
+
+
+def test_budget_outputs(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    """
+    Going over a budget also removes the files of the $$OUTPUT blocks that
+    had started, rather than leaving those of an earlier run.
+    """
+    (tmp_path / "ioc.cfg").write_text("NCHAN=10\n")
+    (tmp_path / "template").write_text(
+        "$$OUTPUT(chans.req)\n$$LOOP(NCHAN)\nchan $$INDEX\n$$ENDLOOP(NCHAN)\n"
+        "$$ENDOUTPUT(chans.req)\n"
+    )
+    args = ["-c", "ioc.cfg", "template", "out"]
+    with pushd(tmp_path):
+        with cli_args(["expand"] + args):
+            assert main() == 0
+        assert (tmp_path / "chans.req").exists()
+        with cli_args(["expand", "--max-iterations", "5"] + args):
+            assert main() == 1
+    assert "--max-iterations" in capsys.readouterr().out
+    assert not (tmp_path / "out").exists()
+    assert not (tmp_path / "chans.req").exists()
+
+
+def test_rawinclude(tmp_path: pathlib.Path, capsys: pytest.CaptureFixture):
+    """
+    $$RAWINCLUDE copies a file into the output as it is, whether the output
+    is a file, stdout or an $$OUTPUT block.
+    """
+    table = "".join('record(ai, "$$P:%d")\n' % n for n in range(5000))
+    (tmp_path / "table.db").write_text(table)
+    (tmp_path / "short").write_text("no newline $$P")
+    (tmp_path / "raw.cfg").write_text("P=TST\nTABLE=table.db\n")
+    (tmp_path / "template").write_text(
+        "# $$P\n"
+        "$$RAWINCLUDE(TABLE)\n"
+        "[$$RAWINCLUDE(short)]\n"
+        "$$OUTPUT(extra)\n"
+        "$$RAWINCLUDE(short)\n"
+        "$$ENDOUTPUT(extra)\n"
+        "$$RAWINCLUDE(missing)\n"
+        "end\n"
+    )
+    expected = "# TST\n" + table + "[no newline $$P]\nend\n"
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "raw.cfg", "template", "out"]):
+            assert main() == 0
+        assert capsys.readouterr().out == "Cannot open file missing!\n\n"
+        assert (tmp_path / "out").read_text() == expected
+        assert (tmp_path / "extra").read_text() == "no newline $$P"
+
+        with cli_args(["expand", "-c", "raw.cfg", "template", "-"]):
+            assert main() == 0
+        assert capsys.readouterr().out == expected.replace(
+            "end\n", "Cannot open file missing!\n\nend\n"
+        )
+
+
+def test_rawinclude_crlf(tmp_path: pathlib.Path):
+    """
+    $$RAWINCLUDE copies the bytes of a file as they are, line endings
+    included, to a file and to an $$OUTPUT block alike.
+    """
+    (tmp_path / "dos.txt").write_bytes(b"one\r\ntwo\rthree\n\xc3\xa9\r\n")
+    (tmp_path / "raw.cfg").write_text("")
+    (tmp_path / "template").write_text(
+        "$$RAWINCLUDE(dos.txt)\n"
+        "$$OUTPUT(extra)\n"
+        "$$RAWINCLUDE(dos.txt)\n"
+        "$$ENDOUTPUT(extra)\n"
+    )
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "raw.cfg", "template", "out"]):
+            assert main() == 0
+    expected = b"one\r\ntwo\rthree\n\xc3\xa9\r\n"
+    assert (tmp_path / "out").read_bytes() == expected
+    assert (tmp_path / "extra").read_bytes() == expected
+
+    out = io.StringIO()
+    cfg = expand.config()
+    with pushd(tmp_path):
+        expand.expand(cfg, ["$$RAWINCLUDE(dos.txt)\n"], out)
+    assert out.getvalue().encode() == expected
+
+
+FILTER_CFG = """\
+MOTOR(NAME=a,TYPE=PMC,POS=3)
+MOTOR(NAME=b,TYPE=IMS,POS=1)
+MOTOR(NAME=c,TYPE=PMC,POS=10)
+MOTOR(NAME=d,TYPE=PMC,POS=2)
+KIND=PMC
+"""
+
+FILTER_TEMPLATE = """\
+$$LOOP(MOTOR, TYPE=PMC)
+$$LOOPINDEX $$INDEX $$NAME
+$$ENDLOOP(MOTOR)
+$$LOOP(MOTOR, TYPE=$$KIND, SORT=POS)
+$$LOOPINDEX $$NAME $$POS$$LOOP(MOTOR) $$NAME$$ENDLOOP(MOTOR)
+$$ENDLOOP(MOTOR)
+$$LOOP(MOTOR, TYPE=XPS)
+never
+$$ENDLOOP(MOTOR)
+"""
+
+
+def test_loop_filter(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    $$LOOP(INST, FIELD=VALUE, SORT=FIELD) runs over the matching instances in
+    order, with $$INDEX still that of the instance, and $$LOOPINDEX counting
+    iterations.
+    """
+    import expand_partial
+
+    (tmp_path / "filter.cfg").write_text(FILTER_CFG)
+    (tmp_path / "template").write_text(FILTER_TEMPLATE)
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "filter.cfg", "template", "out"]):
+            assert main() == 0
+    assert (tmp_path / "out").read_text() == (
+        "0 0 a\n1 2 c\n2 3 d\n0 d 2 a b c d\n1 a 3 a b c d\n2 c 10 a b c d\n"
+    )
+
+    # The filtered lists are kept with the config, and residual programs
+    # don't apply once a filtered field changes.
+    cfg = expand.config()
+    cfg.read_config(str(tmp_path / "filter.cfg"), [])
+    assert cfg.loop_view("MOTOR", "TYPE=PMC") is cfg.loop_view("MOTOR", "TYPE=PMC")
+    lines = FILTER_TEMPLATE.splitlines(keepends=True)
+    out = io.StringIO()
+    monkeypatch.setattr(expand, "named_outputs", None)
+    program = expand_partial.specialize(cfg, lines, out)
+    assert program.render(cfg) == out.getvalue()
+    cfg.idict["MOTOR"][1] = dict(cfg.idict["MOTOR"][1], TYPE="PMC")
+    assert program.render(cfg) is None
+
+    # --max-iterations counts the iterations that are run: 3 + 3 + 3 * 4.
+    monkeypatch.setattr(expand, "budget", None)
+    for limit, status in (("18", 0), ("17", 1)):
+        args = ["expand", "--max-iterations", limit, "-c", "filter.cfg"]
+        with pushd(tmp_path):
+            with cli_args(args + ["template", "out"]):
+                assert main() == status
+
+
+LOOKUP_CFG = """\
+EVR(NAME=evr1,BASE=IOC:EVR:01)
+EVR(NAME=evr2,BASE=IOC:EVR:02)
+EVR(NAME=evr2,BASE=IOC:EVR:03)
+CAM(NAME=c1,EVR=evr2)
+CAM(NAME=c2,EVR=evr1)
+CAM(NAME=c3,EVR=nope)
+"""
+
+LOOKUP_TEMPLATE = """\
+$$LOOP(CAM)
+$$NAME $$LOOKUP(EVR, NAME, $$EVR, BASE)$$LOOKUP(EVR,NAME,$$EVR,INDEX)
+$$ENDLOOP(CAM)
+"""
+
+
+def test_lookup(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    $$LOOKUP(INST, KEYFIELD, KEYVALUE, OUTFIELD) finds the first matching
+    instance through an index kept with the config.
+    """
+    import expand_partial
+
+    (tmp_path / "lookup.cfg").write_text(LOOKUP_CFG)
+    (tmp_path / "template").write_text(LOOKUP_TEMPLATE)
+    (tmp_path / "bad").write_text("$$LOOKUP(EVR,NAME,evr1)\n")
+    with pushd(tmp_path):
+        with cli_args(["expand", "-c", "lookup.cfg", "template", "out"]):
+            assert main() == 0
+        with cli_args(["expand", "-c", "lookup.cfg", "bad", "out2"]):
+            assert main() == 1
+    assert (tmp_path / "out").read_text() == "c1 IOC:EVR:021\nc2 IOC:EVR:010\nc3 \n"
+
+    cfg = expand.config()
+    cfg.read_config(str(tmp_path / "lookup.cfg"), [])
+    assert cfg.lookup("EVR", "NAME", "evr2", "BASE") == "IOC:EVR:02"
+    assert cfg.derived()[("index", "EVR", "NAME")]["evr1"]["BASE"] == "IOC:EVR:01"
+    assert cfg.lookup("EVR", "NAME", "evr1", "NOPE") is None
+    assert cfg.lookup("NOPE", "NAME", "evr1", "BASE") is None
+
+    # The values found are holes, but the keys are guards.
+    lines = LOOKUP_TEMPLATE.splitlines(keepends=True)
+    out = io.StringIO()
+    monkeypatch.setattr(expand, "named_outputs", None)
+    program = expand_partial.specialize(cfg, lines, out)
+    cfg.idict["EVR"][1] = dict(cfg.idict["EVR"][1], BASE="IOC:EVR:99")
+    assert program.render(cfg) == out.getvalue().replace(":02", ":99")
+    cfg.idict["EVR"][0] = dict(cfg.idict["EVR"][0], NAME="evr3")
+    assert program.render(cfg) is None
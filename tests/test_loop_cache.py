@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import pathlib
+
+import expand
+from expand import main
+
+from .conftest import cli_args, pushd
+
+TEMPLATE = """\
+# $$IOCNAME
+$$LOOP(MOTOR)
+motor $$INDEX $$NAME port=$$PORT prefix=$$PREFIX
+$$INCLUDE(motor.inc)
+$$LOOP(2)
+  axis $$INDEX1.$$INDEX $$CALC{INDEX1*10+INDEX}
+$$ENDLOOP(2)
+$$ENDLOOP(MOTOR)
+$$LOOP(MOTOR)
+$$ASSIGN{TOTAL,TOTAL+1}
+total $$TOTAL
+$$ENDLOOP(MOTOR)
+"""
+
+
+def write_cfg(path: pathlib.Path, prefix: str, ports: list[str]):
+    with open(path, "w") as fd:
+        fd.write("PREFIX=%s\nTOTAL=0\n" % prefix)
+        for i, port in enumerate(ports):
+            fd.write("MOTOR(NAME=M%d,PORT=%s)\n" % (i, port))
+
+
+def run(tmp_path: pathlib.Path, cache: bool) -> str:
+    args = ["expand"]
+    if cache:
+        args += ["--loop-cache", str(tmp_path / "loops.json")]
+    out = tmp_path / ("cached.out" if cache else "plain.out")
+    args += [
+        "-c",
+        str(tmp_path / "ioc.cfg"),
+        str(tmp_path / "template"),
+        str(out),
+        "IOCNAME=ioc-test",
+    ]
+    with cli_args(args), pushd(tmp_path):
+        assert main() == 0
+    return out.read_text()
+
+
+def check(tmp_path: pathlib.Path) -> tuple[int, int]:
+    """
+    Expand with and without the cache, returning the cache (hits, misses).
+    """
+    expected = run(tmp_path, False)
+    assert run(tmp_path, True) == expected
+    return expand.loop_cache.hits, expand.loop_cache.misses
+
+
+def test_loop_cache(tmp_path: pathlib.Path, monkeypatch):
+    """
+    Cached loop iterations give the same output as expanding from scratch,
+    and only the iterations whose inputs changed are expanded again.
+    """
+    monkeypatch.setattr(expand, "loop_cache", None)
+    (tmp_path / "template").write_text(TEMPLATE)
+    (tmp_path / "motor.inc").write_text("include $$NAME\n")
+    write_cfg(tmp_path / "ioc.cfg", "TST", ["a", "b", "c"])
+
+    assert check(tmp_path) == (0, 3)
+    assert check(tmp_path) == (3, 0)
+
+    # One instance changed: only its iteration is expanded again.
+    write_cfg(tmp_path / "ioc.cfg", "TST", ["a", "x", "c"])
+    assert check(tmp_path) == (2, 1)
+
+    # A global read by every iteration, and an included file.
+    write_cfg(tmp_path / "ioc.cfg", "NEW", ["a", "x", "c"])
+    assert check(tmp_path) == (0, 3)
+    (tmp_path / "motor.inc").write_text("included $$NAME\n")
+    assert check(tmp_path) == (0, 3)
+
+    # A new instance at the end.
+    write_cfg(tmp_path / "ioc.cfg", "NEW", ["a", "x", "c", "d"])
+    assert check(tmp_path) == (3, 1)
+    assert "total 4\n" in run(tmp_path, True)
@@ -1,10 +1,13 @@
+import os
 import pathlib
 import shutil
 import subprocess
 
 import pytest
 
-from .conftest import pushd
+from expand import main
+
+from .conftest import cli_args, pushd
 
 
 @pytest.mark.parametrize(
@@ -65,3 +68,75 @@ def test_rules_expand(tmp_path: pathlib.Path, target: str, expected: str):
         assert (ioc_bld_path / "Makefile").exists()
         # Did the inner Makefile get run?
         assert (ioc_bld_path / "we_ran_make.txt").exists()
+
+
+def test_rules_expand_one_process_per_ioc(tmp_path: pathlib.Path):
+    """
+    All of an IOC's files come from one expand call, stubs included.
+    """
+    ioc_source = pathlib.Path(__file__).parent / "ioc-tst-unittest"
+    shutil.copytree(ioc_source, tmp_path / "ioc-tst-unittest")
+    # Drop an optional template to check that it gets a stub instead
+    templates_dir = tmp_path / "ioc-tst-unittest" / "iocBoot" / "templates"
+    (templates_dir / "pydm-ioc.cmd").unlink()
+    rules_expand = pathlib.Path(__file__).parent.parent / "RULES_EXPAND"
+    children_dir = tmp_path / "ioc-tst-unittest" / "children"
+    with open(children_dir / "Makefile", "w") as fd:
+        fd.write("IOC_CFG += $(wildcard *.cfg)\n")
+        fd.write(f"include {rules_expand}\n")
+    with pushd(children_dir):
+        dry_run = subprocess.run(
+            ["make", "-n", "expand"], check=True, capture_output=True, text=True
+        )
+        expand_calls = [
+            line for line in dry_run.stdout.splitlines() if " -c ioc-tst-" in line
+        ]
+        assert len(expand_calls) == 3
+        subprocess.run(["make", "expand"], check=True, capture_output=True)
+        # Nothing to do the second time around
+        again = subprocess.run(
+            ["make", "-n", "expand"], check=True, capture_output=True, text=True
+        )
+        assert " -c ioc-tst-" not in again.stdout
+    stub = children_dir / "build" / "iocBoot" / "ioc-tst-unittest1"
+    stub = stub / "pydm-ioc-tst-unittest1.cmd"
+    with open(stub, "r") as fd:
+        text = fd.read().splitlines()
+    assert text == [
+        "#!/bin/sh",
+        f"echo No {templates_dir}/pydm-ioc.cmd found!",
+    ]
+
+
+def test_rules_expand_fallback(tmp_path: pathlib.Path):
+    """
+    Without grouped targets, a deleted secondary output is still rebuilt.
+    """
+    ioc_source = pathlib.Path(__file__).parent / "ioc-tst-unittest"
+    shutil.copytree(ioc_source, tmp_path / "ioc-tst-unittest")
+    rules_expand = pathlib.Path(__file__).parent.parent / "RULES_EXPAND"
+    children_dir = tmp_path / "ioc-tst-unittest" / "children"
+    with open(children_dir / "Makefile", "w") as fd:
+        fd.write("IOC_CFG += $(wildcard *.cfg)\n")
+        fd.write(f"include {rules_expand}\n")
+    make = ["make", "EXPAND_GROUPED_TARGETS=", "expand"]
+    with pushd(children_dir):
+        subprocess.run(make, check=True, capture_output=True)
+        ioc_dir = children_dir / "build" / "iocBoot" / "ioc-tst-unittest1"
+        st_cmd = ioc_dir / "st.cmd"
+        text = st_cmd.read_text()
+        assert os.access(st_cmd, os.X_OK)
+        st_cmd.unlink()
+        subprocess.run(make, check=True, capture_output=True)
+        assert st_cmd.read_text() == text
+        assert os.access(st_cmd, os.X_OK)
+
+
+def test_optional_template_to_stdout(tmp_path: pathlib.Path, capsys):
+    """
+    -O writes a stub script, so it needs a real output file.
+    """
+    with pushd(tmp_path):
+        with cli_args(["expand", "-O", "missing.cmd", "-"]):
+            assert main() == 1
+    assert not (tmp_path / "-").exists()
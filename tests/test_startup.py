@@ -0,0 +1,116 @@
+"""
+Tests for the fast startup path of the expand wrapper and expand.py
+"""
+
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+TOP = pathlib.Path(__file__).parent.parent
+MINIMAL_FLAGS = ["-E", "-s"]
+
+
+@pytest.fixture
+def plain_cfg(tmp_path: pathlib.Path) -> pathlib.Path:
+    cfg = tmp_path / "ioc-tst-startup.cfg"
+    with open(cfg, "w") as fd:
+        fd.write("RELEASE=/some/release/path\nENGINEER=somebody\n")
+    return cfg
+
+
+def test_keyword_query_skips_ast(plain_cfg: pathlib.Path):
+    """
+    expand -c X.cfg RELEASE has no arithmetic, so ast should never be imported.
+    """
+    code = (
+        "import sys\n"
+        "import expand\n"
+        f"sys.argv = ['expand', '-c', {str(plain_cfg)!r}, 'RELEASE']\n"
+        "expand.main()\n"
+        "print('ast' in sys.modules)\n"
+    )
+    proc = subprocess.run(
+        [sys.executable] + MINIMAL_FLAGS + ["-c", code],
+        cwd=TOP,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert proc.stdout.splitlines() == ["/some/release/path", "False"]
+
+
+def test_calc_still_works(tmp_path: pathlib.Path):
+    """
+    The lazily-built operator table must behave like the old eager one.
+    """
+    cfg = tmp_path / "calc.cfg"
+    with open(cfg, "w") as fd:
+        fd.write("BASE=0x10\nOFFSET=3\n")
+    proc = subprocess.run(
+        [sys.executable]
+        + MINIMAL_FLAGS
+        + [str(TOP / "expand.py"), "-c", str(cfg), "CALC{BASE*2+OFFSET,%x}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert proc.stdout.strip() == "23"
+
+
+def test_wrapper_and_zipapp(tmp_path: pathlib.Path, plain_cfg: pathlib.Path):
+    """
+    The zipapp from tools/build_zipapp.py gives the same answers as expand.py.
+    """
+    pyz = tmp_path / "expand.pyz"
+    subprocess.run(
+        [sys.executable, str(TOP / "tools" / "build_zipapp.py"), "-o", str(pyz)],
+        check=True,
+        capture_output=True,
+    )
+    for script in (TOP / "expand.py", pyz):
+        proc = subprocess.run(
+            [sys.executable]
+            + MINIMAL_FLAGS
+            + [str(script), "-c", str(plain_cfg), "ENGINEER"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert proc.stdout.strip() == "somebody"
+    proc = subprocess.run(
+        [str(TOP / "expand"), "-c", str(plain_cfg), "RELEASE"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert proc.stdout.strip() == "/some/release/path"
+
+
+def test_wrapper_stale_zipapp(tmp_path: pathlib.Path, plain_cfg: pathlib.Path):
+    """
+    The wrapper only uses expand.pyz if it is newer than every module in it.
+    """
+    for src in [TOP / "expand", TOP / "expand.py"] + sorted(TOP.glob("expand_*.py")):
+        shutil.copy2(src, tmp_path / src.name)
+    with zipfile.ZipFile(tmp_path / "expand.pyz", "w") as zf:
+        zf.writestr("__main__.py", "print('from the zipapp')\n")
+    old = os.stat(tmp_path / "expand.pyz").st_mtime - 100
+    for src in tmp_path.glob("expand*.py"):
+        os.utime(src, (old, old))
+
+    def run():
+        return subprocess.run(
+            [str(tmp_path / "expand"), "-c", str(plain_cfg), "RELEASE"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+
+    assert run() == "from the zipapp"
+    os.utime(tmp_path / "expand_batch.py", (old + 200, old + 200))
+    assert run() == "/some/release/path"
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import pathlib
+
+import expand_telemetry
+from expand import main
+
+from .conftest import cli_args, pushd
+
+CFG = """\
+RELEASE=/common/ioc/motor/R1.0
+MOTOR(NAME=a)
+MOTOR(NAME=b)
+MOTOR(NAME=c)
+"""
+
+TEMPLATE = """\
+$$LOOP(MOTOR)
+$$LOOP(2)
+$$NAME $$INDEX
+$$ENDLOOP(2)
+$$INCLUDE(motor.inc)
+$$ENDLOOP(MOTOR)
+"""
+
+
+def test_telemetry(tmp_path: pathlib.Path, capsys):
+    """
+    Each output appends a record, and --report sums them up.
+    """
+    (tmp_path / "ioc-tst-motors.cfg").write_text(CFG)
+    (tmp_path / "template").write_text(TEMPLATE)
+    (tmp_path / "other").write_text("nothing\n")
+    (tmp_path / "motor.inc").write_text("inc\n")
+    log = tmp_path / "telemetry.jsonl"
+    args = ["expand", "--telemetry", str(log), "-c", "ioc-tst-motors.cfg"]
+    with pushd(tmp_path):
+        with cli_args(args + ["template", "one.out"]):
+            assert main() == 0
+        with cli_args(args + ["-o", "template", "two.out", "-o", "other", "o.out"]):
+            assert main() == 0
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [r["output"] for r in records] == ["one.out", "two.out", "o.out"]
+    first = records[0]
+    assert first["ioc"] == "ioc-tst-motors"
+    assert first["release"] == "/common/ioc/motor/R1.0"
+    assert first["iterations"] == 3 + 3 * 2
+    assert first["includes"] == 3
+    assert first["bytes"] == (tmp_path / "one.out").stat().st_size
+    assert first["passes"] == 2
+    assert first["wall"] >= first["config"] + first["expand"]
+    # One config read for both outputs of the -o run.
+    assert records[1]["config"] == records[2]["config"]
+    assert records[2]["iterations"] == 0
+
+    capsys.readouterr()
+    with cli_args(["expand", "--report", str(log), "--top", "1"]):
+        assert main() == 0
+    out = capsys.readouterr().out
+    assert "3 outputs, 0 from the cache" in out
+    assert "Slowest IOCs (1 of 1)" in out
+    assert "Slowest templates (1 of 2)" in out
+    assert "     3 " in out and "  ioc-tst-motors\n" in out
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert expand_telemetry.percentile(values, 50) == 50
+    assert expand_telemetry.percentile(values, 90) == 90
+    assert expand_telemetry.percentile([7.0], 99) == 7.0
@@ -0,0 +1,105 @@
+"""
+Tests for expand --watch
+"""
+
+import io
+import os
+import pathlib
+import shutil
+
+import pytest
+
+from expand_watch import watcher
+
+from .conftest import pushd
+
+TEST_IOC = pathlib.Path(__file__).parent / "ioc-tst-unittest"
+
+
+def touch_later(path: pathlib.Path, text: str):
+    """
+    Rewrite path, making sure that its mtime visibly changes.
+    """
+    mtime = path.stat().st_mtime_ns
+    path.write_text(text)
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+
+@pytest.fixture
+def ioc_top(tmp_path: pathlib.Path) -> pathlib.Path:
+    shutil.copytree(TEST_IOC, tmp_path / "ioc-tst-unittest")
+    return tmp_path / "ioc-tst-unittest"
+
+
+def test_watch_reexpands_only_affected(ioc_top: pathlib.Path):
+    children = ioc_top / "children"
+    templates = ioc_top / "iocBoot" / "templates"
+    include = templates / "extra.txt"
+    include.write_text("included one\n")
+    st_cmd = templates / "st.cmd"
+    st_cmd.write_text(st_cmd.read_text() + f"$$INCLUDE({include})\n")
+    build = children / "build" / "iocBoot"
+
+    log = io.StringIO()
+    w = watcher(log=log)
+    with pushd(children):
+        # 3 IOCs with 9 outputs each
+        assert w.cycle() == 27
+        assert w.cycle() == 0
+        assert "included one" in (build / "ioc-tst-unittest2" / "st.cmd").read_text()
+
+        # Changing an include only redoes the outputs that included it
+        touch_later(include, "included two\n")
+        assert w.cycle() == 3
+        st = (build / "ioc-tst-unittest2" / "st.cmd").read_text()
+        assert "included two" in st
+
+        # Changing a cfg redoes everything for that IOC only
+        cfg = children / "ioc-tst-unittest1.cfg"
+        touch_later(cfg, cfg.read_text().replace("pytest", "watched"))
+        assert w.cycle() == 9
+        sub_req = build / "ioc-tst-unittest1" / "ioc-tst-unittest1.sub-req"
+        assert sub_req.read_text().splitlines()[1] == "watched"
+
+        # New cfgs are picked up
+        shutil.copy(cfg, children / "ioc-tst-unittest4.cfg")
+        assert w.cycle() == 9
+        assert w.cycle() == 0
+    assert "Expanded 3 output(s)" in log.getvalue()
+
+
+def test_watch_residual_programs(ioc_top: pathlib.Path):
+    """
+    A cfg change that only touches substituted values is rendered from the
+    residual programs, and anything else is expanded again, with the same
+    results as expanding from scratch.
+    """
+    children = ioc_top / "children"
+    templates = ioc_top / "iocBoot" / "templates"
+    (templates / "ioc.sub-req").write_text(
+        "$$ENGINEER\n$$IF(DEBUG)debug $$PREFIX\n$$ENDIF(DEBUG)$$LOCATION\n"
+    )
+    cfg = children / "ioc-tst-unittest1.cfg"
+    sub_req = children / "build" / "iocBoot" / "ioc-tst-unittest1"
+    sub_req = sub_req / "ioc-tst-unittest1.sub-req"
+
+    w = watcher(log=io.StringIO())
+    with pushd(children):
+        w.cycle()
+        assert sub_req.read_text() == "Unit test\npytest\n"
+
+        touch_later(cfg, cfg.read_text().replace("pytest", "replayed"))
+        assert w.cycle() == 9
+        assert w.replayed == 9
+        assert sub_req.read_text() == "Unit test\nreplayed\n"
+
+        touch_later(cfg, cfg.read_text() + "DEBUG = 1\n")
+        assert w.cycle() == 9
+        assert w.replayed == 9
+        assert sub_req.read_text() == "Unit test\ndebug IOC:TST:UNITTEST1\nreplayed\n"
+
+        # The new program has holes inside the $$IF branch too.
+        touch_later(cfg, cfg.read_text().replace("UNITTEST1", "NEW"))
+        assert w.cycle() == 9
+        assert w.replayed == 18
+        assert sub_req.read_text() == "Unit test\ndebug IOC:TST:NEW\nreplayed\n"
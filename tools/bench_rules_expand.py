@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Time complete RULES_EXPAND builds of a children directory with many IOCs.
+
+For each size N this generates N synthetic cfgs next to a copy of the
+tests/ioc-tst-unittest templates, and times make in four situations: a clean
+build, a no-op rebuild, a rebuild after touching one cfg, and a clean build
+with make -jK.  Every expand process is counted through a small wrapper
+script passed to make as EXPAND, split into the parse-time "expand -c X.cfg
+RELEASE" queries and the expansions run by recipes.
+
+The time make spends parsing (including those queries) is measured with
+"make -n" on the clean tree, which does everything but run the recipes; the
+recipe time is what the clean build takes beyond that.
+
+With --append the record is added to a JSON lines file so that changes to
+RULES_EXPAND and expand.py can be compared over time.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = pathlib.Path(__file__).resolve().parent.parent
+UNITTEST = TOP / "tests" / "ioc-tst-unittest"
+
+CFG_TEMPLATE = """\
+RELEASE = $$UP(PATH)
+ENGINEER = "Bench Mark"
+LOCATION = "bench"
+PREFIX = "IOC:BENCH:{num:04d}"
+"""
+CFG_INSTANCE = "MOTOR(NAME=BENCH:{num:04d}:MMS:{axis:02d},PORT=ttyS{axis})\n"
+
+WRAPPER = """\
+#!/bin/sh
+echo "$*" >> {log}
+exec {expand} "$@"
+"""
+
+
+def make_tree(root: pathlib.Path, size: int, instances: int) -> pathlib.Path:
+    """
+    Set up an ioc-tst-unittest style tree with size cfgs in its children
+    directory, returning the children directory.
+    """
+    tree = root / "ioc-bench"
+    shutil.copytree(UNITTEST, tree, ignore=shutil.ignore_patterns("*.cfg"))
+    children = tree / "children"
+    children.mkdir(exist_ok=True)
+    for num in range(size):
+        with open(children / f"ioc-bench-{num:04d}.cfg", "w") as fd:
+            fd.write(CFG_TEMPLATE.format(num=num))
+            for axis in range(instances):
+                fd.write(CFG_INSTANCE.format(num=num, axis=axis))
+    with open(children / "Makefile", "w") as fd:
+        fd.write("IOC_CFG += $(wildcard *.cfg)\n")
+        fd.write(f"include {TOP / 'RULES_EXPAND'}\n")
+    return children
+
+
+class counting_expand:
+    """
+    A wrapper script for expand that logs each of its command lines.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.log = root / "expand-launches.log"
+        self.path = root / "expand-counting"
+        with open(self.path, "w") as fd:
+            fd.write(WRAPPER.format(log=self.log, expand=TOP / "expand"))
+        self.path.chmod(0o755)
+
+    def reset(self):
+        self.log.write_text("")
+
+    def counts(self) -> dict:
+        queries = expansions = 0
+        for line in self.log.read_text().splitlines():
+            if " -o " in f" {line} " or " -O " in f" {line} ":
+                expansions += 1
+            else:
+                queries += 1
+        return {
+            "launches": queries + expansions,
+            "queries": queries,
+            "expansions": expansions,
+        }
+
+
+def run_make(children: pathlib.Path, wrapper: counting_expand, args) -> dict:
+    wrapper.reset()
+    start = time.perf_counter()
+    subprocess.run(
+        ["make", f"EXPAND={wrapper.path}"] + args,
+        cwd=children,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    result = {"seconds": time.perf_counter() - start}
+    result.update(wrapper.counts())
+    return result
+
+
+def bench_size(root, size, instances, target, jobs) -> dict:
+    children = make_tree(root, size, instances)
+    wrapper = counting_expand(root)
+    build = children / "build"
+
+    parse = run_make(children, wrapper, ["-n", target])
+    clean = run_make(children, wrapper, [target])
+    noop = run_make(children, wrapper, [target])
+    # Make sure the touched cfg is newer than its outputs, even on
+    # filesystems with coarse timestamps, by backdating everything else.
+    past = time.time() - 10
+    for dirpath, dirnames, filenames in os.walk(children):
+        for name in dirnames + filenames:
+            os.utime(os.path.join(dirpath, name), (past, past))
+    sorted(children.glob("*.cfg"))[size // 2].touch()
+    touch = run_make(children, wrapper, [target])
+    shutil.rmtree(build)
+    parallel = run_make(children, wrapper, [f"-j{jobs}", target])
+    shutil.rmtree(root / "ioc-bench")
+    return {
+        "iocs": size,
+        "parse": parse,
+        "clean": clean,
+        "recipe_seconds": max(0.0, clean["seconds"] - parse["seconds"]),
+        "noop": noop,
+        "touch_one": touch,
+        "parallel": dict(parallel, jobs=jobs),
+    }
+
+
+def git_revision() -> str:
+    try:
+        proc = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=TOP,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return ""
+    return proc.stdout.strip()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes",
+        default="10,100,500",
+        help="comma separated numbers of IOCs (default: 10,100,500)",
+    )
+    parser.add_argument(
+        "--instances", type=int, default=8, help="MOTOR instances per cfg"
+    )
+    parser.add_argument(
+        "--target", default="expand", help="make target to build (default: expand)"
+    )
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--append", help="JSON lines file to add the record to")
+    args = parser.parse_args()
+
+    if shutil.which("make") is None:
+        print("make not found", file=sys.stderr)
+        return 1
+    results = []
+    for size in (int(n) for n in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = bench_size(
+                pathlib.Path(tmp), size, args.instances, args.target, args.jobs
+            )
+        results.append(result)
+        print(
+            f"{size:>5} IOCs: clean {result['clean']['seconds']:7.2f} s "
+            f"(parse {result['parse']['seconds']:6.2f} s, "
+            f"{result['clean']['launches']} expands)  "
+            f"no-op {result['noop']['seconds']:6.2f} s  "
+            f"touch one {result['touch_one']['seconds']:6.2f} s "
+            f"({result['touch_one']['expansions']} expanded)  "
+            f"-j{args.jobs} {result['parallel']['seconds']:7.2f} s"
+        )
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "make": subprocess.run(
+            ["make", "--version"], capture_output=True, text=True
+        ).stdout.splitlines()[0],
+        "host": platform.node(),
+        "target": args.target,
+        "results": results,
+    }
+    if args.append:
+        with open(args.append, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
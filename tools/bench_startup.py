@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Measure the startup cost of expand for the common "expand -c X.cfg RELEASE"
+query, which RULES_EXPAND runs once per IOC every time make parses.
+
+Each run times a few interpreter invocations (plain, minimal-startup flags as
+used by the expand wrapper, and expand.pyz if it has been built) and collects
+the "python -X importtime" breakdown.  With --append the record is added to
+a JSON lines file so that the numbers can be tracked over time.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = pathlib.Path(__file__).resolve().parent.parent
+MINIMAL_FLAGS = ["-E", "-s"]  # What the expand wrapper passes.
+
+
+def time_command(args, runs: int, cwd: str) -> dict:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return {
+        "min_ms": 1000 * min(samples),
+        "median_ms": 1000 * statistics.median(samples),
+        "runs": runs,
+    }
+
+
+def import_times(args, cwd: str, top: int) -> dict:
+    """
+    Parse the -X importtime report into a total and the slowest imports.
+    """
+    proc = subprocess.run(args, cwd=cwd, check=True, capture_output=True, text=True)
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            continue  # the header line
+        modules.append((fields[2].strip(), self_us, cumulative_us))
+    modules.sort(key=lambda mod: mod[1], reverse=True)
+    return {
+        "total_self_us": sum(mod[1] for mod in modules),
+        "module_count": len(modules),
+        "slowest": [
+            {"module": name, "self_us": self_us, "cumulative_us": cumulative_us}
+            for name, self_us, cumulative_us in modules[:top]
+        ],
+    }
+
+
+def git_revision() -> str:
+    try:
+        proc = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=TOP,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return ""
+    return proc.stdout.strip()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--python", default=sys.executable)
+    parser.add_argument(
+        "--config", help="cfg file to query (default: a small generated one)"
+    )
+    parser.add_argument("--key", default="RELEASE")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--append", help="JSON lines file to add the record to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.config is None:
+            config = os.path.join(tmp, "ioc-bench-startup.cfg")
+            with open(config, "w") as fd:
+                fd.write("RELEASE=/some/release/path\nARCH=linux-x86_64\n")
+        else:
+            config = os.path.abspath(args.config)
+        query = ["-c", config, args.key]
+        variants = {
+            "default": [args.python, str(TOP / "expand.py")] + query,
+            "minimal": [args.python] + MINIMAL_FLAGS + [str(TOP / "expand.py")] + query,
+        }
+        if (TOP / "expand.pyz").exists():
+            variants["zipapp"] = (
+                [args.python] + MINIMAL_FLAGS + [str(TOP / "expand.pyz")] + query
+            )
+        variants["baseline"] = [args.python] + MINIMAL_FLAGS + ["-c", "pass"]
+
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "timings": {
+                name: time_command(cmd, args.runs, tmp)
+                for name, cmd in variants.items()
+            },
+            "importtime": import_times(
+                [args.python, "-X", "importtime"]
+                + MINIMAL_FLAGS
+                + [str(TOP / "expand.py")]
+                + query,
+                tmp,
+                args.top,
+            ),
+        }
+
+    for name, timing in record["timings"].items():
+        print(
+            f"{name:>10}: min {timing['min_ms']:7.2f} ms  "
+            f"median {timing['median_ms']:7.2f} ms"
+        )
+    total_us = record["importtime"]["total_self_us"]
+    print(f"import time (self, minimal flags): {total_us} us")
+    for mod in record["importtime"]["slowest"]:
+        print(f"    {mod['self_us']:>8} us  {mod['module']}")
+    if args.append:
+        with open(args.append, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Build expand.pyz: a zipapp of expand.py holding only precompiled bytecode.
+
+The expand wrapper prefers expand.pyz over expand.py when it is newer, which
+saves the interpreter from reading and compiling (or stat-ing and validating
+a __pycache__ entry for) the source on every call.  The bytecode is only
+valid for the interpreter that builds it, so build it with the same python
+that the expand wrapper runs:
+
+    make expand.pyz PYTHON=/cds/group/pcds/pyps/conda/py39/envs/pcds-5.9.1/bin/python
+"""
+
+import argparse
+import importlib.util
+import marshal
+import pathlib
+import zipfile
+
+MAIN = """\
+import sys
+
+from expand import main
+
+sys.exit(main())
+"""
+
+
+def pyc_bytes(source: str, filename: str) -> bytes:
+    """
+    Compile source into the contents of an unchecked .pyc file.
+
+    There is no source in the archive for zipimport to validate against, so
+    the timestamp and size fields are simply left at zero.
+    """
+    code = compile(source, filename, "exec", dont_inherit=True)
+    header = importlib.util.MAGIC_NUMBER + bytes(12)
+    return header + marshal.dumps(code)
+
+
+def build(output: pathlib.Path, sources: list) -> None:
+    tmp = output.with_name(output.name + ".tmp")
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("__main__.pyc", pyc_bytes(MAIN, f"{output.name}/__main__.py"))
+        for src in sources:
+            zf.writestr(
+                src.stem + ".pyc",
+                pyc_bytes(src.read_text(), f"{output.name}/{src.name}"),
+            )
+    tmp.replace(output)
+
+
+def main() -> int:
+    top = pathlib.Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-o", "--output", type=pathlib.Path, default=top / "expand.pyz")
+    args = parser.parse_args()
+    sources = [top / "expand.py"] + sorted(top.glob("expand_*.py"))
+    build(args.output, sources)
+    print(f"Wrote {args.output} ({', '.join(src.name for src in sources)})")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())